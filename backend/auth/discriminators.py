@@ -0,0 +1,42 @@
+'''
+Business: Race-free O(1) discriminator allocation for IncordesIDs (User#0001)
+Args: cursor inside the registration transaction, username
+Returns: Zero-padded discriminator or DiscriminatorsExhausted when all 9999 are taken
+'''
+
+MAX_DISCRIMINATOR = 9999
+
+class DiscriminatorsExhausted(Exception):
+    pass
+
+# Row-locked per-username counter: concurrent registrations of one name queue on
+# a single row instead of racing on MAX(discriminator)
+NEXT_QUERY = """INSERT INTO username_discriminators (username, next_discriminator) VALUES (%s, 2)
+                ON CONFLICT (username) DO UPDATE
+                SET next_discriminator = username_discriminators.next_discriminator + 1
+                RETURNING next_discriminator - 1 AS discriminator"""
+
+# Past 9999 the counter is spent; look for a gap through the (username, discriminator) index
+FREE_SLOT_QUERY = """SELECT lpad(s.n::text, 4, '0') AS discriminator
+                     FROM generate_series(1, %s) AS s(n)
+                     WHERE NOT EXISTS (
+                         SELECT 1 FROM users u
+                         WHERE u.username = %s AND u.discriminator = lpad(s.n::text, 4, '0')
+                     )
+                     LIMIT 1"""
+
+def format_discriminator(value: int) -> str:
+    return str(value).zfill(4)
+
+def allocate_discriminator(cursor, username: str) -> str:
+    cursor.execute(NEXT_QUERY, (username,))
+    value = cursor.fetchone()['discriminator']
+    if value <= MAX_DISCRIMINATOR:
+        return format_discriminator(value)
+
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"discriminator:{username}",))
+    cursor.execute(FREE_SLOT_QUERY, (MAX_DISCRIMINATOR, username))
+    row = cursor.fetchone()
+    if not row:
+        raise DiscriminatorsExhausted(username)
+    return row['discriminator']
@@ -5,100 +5,109 @@ Returns: JWT token and user data with unique IncordesID
 '''
 
 import json
-import os
-import psycopg2
 from psycopg2.extras import RealDictCursor
-import bcrypt
 import jwt
-import hashlib
-from datetime import datetime, timedelta
-import random
 import re
 from typing import Dict, Any
 
-DATABASE_URL = os.environ.get('DATABASE_URL')
-JWT_SECRET = 'incordes_secret_key_2024_change_in_production'
+from db import get_connection, release_connection
+from responses import json_response, raw_response, preflight_response, get_header
+import passwords
+import presence
+from ready import load_ready
+from discriminators import allocate_discriminator, DiscriminatorsExhausted
+import tokens
+import metrics
 
-def generate_discriminator(cursor, username: str) -> str:
-    cursor.execute(
-        "SELECT discriminator FROM users WHERE username = %s ORDER BY discriminator DESC LIMIT 1",
-        (username,)
-    )
-    result = cursor.fetchone()
-    
-    if not result:
-        return '0001'
-    
-    last_disc = int(result['discriminator'])
-    new_disc = last_disc + 1
-    
-    if new_disc > 9999:
-        new_disc = random.randint(1, 9999)
-    
-    return str(new_disc).zfill(4)
+DISCRIMINATOR_ATTEMPTS = 3
 
+def client_ip(event: Dict[str, Any]) -> str:
+    '''
+    The address the API gateway saw. X-Forwarded-For is client-controlled except for
+    its right-most hop, appended by the proxy in front of us, so only that is a fallback.
+    '''
+    source_ip = ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp')
+    if source_ip:
+        return source_ip
+    forwarded = get_header(event, 'X-Forwarded-For')
+    return forwarded.split(',')[-1].strip() if forwarded else ''
+
+@metrics.instrumented
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return preflight_response('GET, POST, OPTIONS', 'Content-Type, X-Auth-Token')
+    
+    body = json.loads(event.get('body') or '{}') if method == 'POST' else {}
+    action = body.get('action')
+    metrics.set_action(action)
+    
+    if action in ('register', 'login'):
+        retry_after = passwords.check_throttle(client_ip(event), str(body.get('email', '')).strip().lower())
+        if retry_after:
+            return json_response(event, 429, {'error': 'Too many attempts, try again later'}, headers={'Retry-After': str(retry_after)})
     
-    conn = psycopg2.connect(DATABASE_URL)
+    conn = get_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
         if method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            action = body.get('action')
-            
             if action == 'register':
                 email = body.get('email', '').strip().lower()
                 password = body.get('password', '')
                 username = body.get('username', '').strip()
                 
                 if not email or not password or not username:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Email, password and username required'})
-                    }
+                    return json_response(event, 400, {'error': 'Email, password and username required'})
                 
                 if not re.match(r'^[a-zA-Z0-9_]{3,20}$', username):
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Username must be 3-20 characters, alphanumeric and underscore only'})
-                    }
+                    return json_response(event, 400, {'error': 'Username must be 3-20 characters, alphanumeric and underscore only'})
                 
                 cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
                 if cursor.fetchone():
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Email already registered'})
-                    }
+                    return json_response(event, 400, {'error': 'Email already registered'})
                 
-                discriminator = generate_discriminator(cursor, username)
-                incordes_id = f"{username}#{discriminator}"
+                # bcrypt runs in the hashing pool without holding a database connection
+                cursor.close()
+                release_connection(conn)
+                conn = cursor = None
+                try:
+                    password_hash = passwords.hash_password(password)
+                except passwords.HashingBusy:
+                    return json_response(event, 503, {'error': 'Server busy, try again'}, headers={'Retry-After': '1'})
+                conn = get_connection()
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                
+                user = None
+                for _ in range(DISCRIMINATOR_ATTEMPTS):
+                    try:
+                        discriminator = allocate_discriminator(cursor, username)
+                    except DiscriminatorsExhausted:
+                        return json_response(event, 409, {'error': 'All tags for this username are taken, choose another username'})
+                    incordes_id = f"{username}#{discriminator}"
+                    
+                    cursor.execute(
+                        """INSERT INTO users (email, password_hash, username, discriminator, incordes_id, tag, status, theme, locale, last_seen_at)
+                           VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+                           ON CONFLICT DO NOTHING
+                           RETURNING id, incordes_id, username, email, avatar_url, status, theme""",
+                        (email, password_hash, username, discriminator, incordes_id, discriminator, 'online', 'dark', 'ru')
+                    )
+                    user = cursor.fetchone()
+                    if user:
+                        break
+                    
+                    cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
+                    if cursor.fetchone():
+                        return json_response(event, 400, {'error': 'Email already registered'})
                 
-                password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+                if not user:
+                    return json_response(event, 409, {'error': 'Could not allocate a tag, try again'})
                 
-                cursor.execute(
-                    """INSERT INTO users (email, password_hash, username, discriminator, incordes_id, tag, status, theme, locale)
-                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id, incordes_id, username, email, avatar_url, status, theme""",
-                    (email, password_hash, username, discriminator, incordes_id, discriminator, 'online', 'dark', 'ru')
-                )
-                user = dict(cursor.fetchone())
+                user = dict(user)
                 conn.commit()
+                presence.heartbeat(user['id'])
                 
                 cursor.execute(
                     "INSERT INTO user_settings (user_id) VALUES (%s)",
@@ -106,138 +115,128 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 )
                 conn.commit()
                 
-                token = jwt.encode({
-                    'user_id': user['id'],
-                    'incordes_id': user['incordes_id'],
-                    'exp': datetime.utcnow() + timedelta(days=30)
-                }, JWT_SECRET, algorithm='HS256')
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'token': token,
-                        'user': user
-                    })
-                }
+                token = tokens.issue_token(user)
+                
+                return json_response(event, 200, {
+                    'token': token,
+                    'user': user
+                })
             
             elif action == 'login':
                 email = body.get('email', '').strip().lower()
                 password = body.get('password', '')
                 
                 if not email or not password:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Email and password required'})
-                    }
+                    return json_response(event, 400, {'error': 'Email and password required'})
                 
                 cursor.execute(
-                    "SELECT id, password_hash, incordes_id, username, email, avatar_url, banner_url, bio, status, theme FROM users WHERE email = %s",
+                    "SELECT id, password_hash, incordes_id, username, email, avatar_url, banner_url, bio, status, theme, token_version FROM users WHERE email = %s",
                     (email,)
                 )
                 user = cursor.fetchone()
                 
                 if not user:
-                    return {
-                        'statusCode': 401,
-                        'headers': {'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Invalid credentials'})
-                    }
+                    passwords.record_failure(email)
+                    return json_response(event, 401, {'error': 'Invalid credentials'})
                 
                 user_dict = dict(user)
                 
-                password_valid = False
-                need_hash_update = False
-                
-                if user_dict['password_hash'].startswith('$2'):
-                    password_valid = bcrypt.checkpw(password.encode('utf-8'), user_dict['password_hash'].encode('utf-8'))
-                else:
-                    sha256_hash = hashlib.sha256(password.encode()).hexdigest()
-                    password_valid = sha256_hash == user_dict['password_hash']
-                    need_hash_update = password_valid
+                cursor.close()
+                release_connection(conn)
+                conn = cursor = None
+                try:
+                    password_valid, new_password_hash = passwords.verify_password(password, user_dict['password_hash'])
+                except passwords.HashingBusy:
+                    return json_response(event, 503, {'error': 'Server busy, try again'}, headers={'Retry-After': '1'})
                 
                 if not password_valid:
-                    return {
-                        'statusCode': 401,
-                        'headers': {'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Invalid credentials'})
-                    }
-                
-                if need_hash_update:
-                    new_password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+                    passwords.record_failure(email)
+                    return json_response(event, 401, {'error': 'Invalid credentials'})
+                
+                passwords.clear_failures(email)
+                conn = get_connection()
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                
+                if new_password_hash:
                     cursor.execute("UPDATE users SET password_hash = %s WHERE id = %s", (new_password_hash, user_dict['id']))
                 
-                cursor.execute("UPDATE users SET status = %s WHERE id = %s", ('online', user_dict['id']))
+                presence.heartbeat(user_dict['id'])
+                presence.flush(cursor)
                 conn.commit()
                 
                 del user_dict['password_hash']
                 
-                token = jwt.encode({
-                    'user_id': user_dict['id'],
-                    'incordes_id': user_dict['incordes_id'],
-                    'exp': datetime.utcnow() + timedelta(days=30)
-                }, JWT_SECRET, algorithm='HS256')
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'token': token,
-                        'user': user_dict
-                    })
-                }
+                token = tokens.issue_token(user_dict)
+                del user_dict['token_version']
+                
+                return json_response(event, 200, {
+                    'token': token,
+                    'user': user_dict
+                })
+            
+            elif action == 'heartbeat':
+                status = body.get('status', 'online')
+                
+                if status not in presence.STATUSES:
+                    return json_response(event, 400, {'error': 'Invalid status'})
+                
+                try:
+                    payload = tokens.verify_token(body.get('token') or '', cursor)
+                except jwt.InvalidTokenError:
+                    return json_response(event, 401, {'error': 'Invalid token'})
+                
+                presence.heartbeat(payload['user_id'], status)
+                presence.flush(cursor)
+                conn.commit()
+                
+                return json_response(event, 200, {
+                    'status': status,
+                    'heartbeat_interval': presence.PRESENCE_TTL // 3
+                })
+            
+            elif action == 'ready':
+                try:
+                    payload = tokens.verify_token(body.get('token') or '', cursor)
+                except jwt.InvalidTokenError:
+                    return json_response(event, 401, {'error': 'Invalid token'})
+                
+                ready = load_ready(cursor, payload['user_id'])
+                if not ready:
+                    return json_response(event, 401, {'error': 'User not found'})
+                
+                return raw_response(event, 200, ready)
             
             elif action == 'verify':
                 token = body.get('token')
                 if not token:
-                    return {
-                        'statusCode': 401,
-                        'headers': {'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Token required'})
-                    }
+                    return json_response(event, 401, {'error': 'Token required'})
                 
                 try:
-                    payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
-                    user_id = payload['user_id']
-                    
-                    cursor.execute(
-                        "SELECT id, incordes_id, username, email, avatar_url, banner_url, bio, status, theme FROM users WHERE id = %s",
-                        (user_id,)
-                    )
-                    user = cursor.fetchone()
-                    
-                    if not user:
-                        return {
-                            'statusCode': 401,
-                            'headers': {'Access-Control-Allow-Origin': '*'},
-                            'body': json.dumps({'error': 'User not found'})
-                        }
-                    
-                    return {
-                        'statusCode': 200,
-                        'headers': {'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'user': dict(user)})
-                    }
+                    payload = tokens.verify_token(token, cursor)
                 except jwt.ExpiredSignatureError:
-                    return {
-                        'statusCode': 401,
-                        'headers': {'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Token expired'})
-                    }
+                    return json_response(event, 401, {'error': 'Token expired'})
+                except jwt.InvalidTokenError:
+                    return json_response(event, 401, {'error': 'Invalid token'})
+                
+                user = dict(tokens.cached_user(payload['user_id'], cursor))
+                del user['token_version']
+                return json_response(event, 200, {'user': user})
+            
+            elif action == 'revoke':
+                try:
+                    payload = tokens.verify_token(body.get('token') or '', cursor)
                 except jwt.InvalidTokenError:
-                    return {
-                        'statusCode': 401,
-                        'headers': {'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Invalid token'})
-                    }
-        
-        return {
-            'statusCode': 405,
-            'headers': {'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
+                    return json_response(event, 401, {'error': 'Invalid token'})
+                
+                tokens.revoke_user_tokens(cursor, payload['user_id'])
+                conn.commit()
+                
+                return json_response(event, 200, {'success': True})
+    
+        return json_response(event, 405, {'error': 'Method not allowed'})
     
     finally:
-        cursor.close()
-        conn.close()
\ No newline at end of file
+        if cursor:
+            cursor.close()
+        if conn:
+            release_connection(conn)
\ No newline at end of file
@@ -0,0 +1,144 @@
+'''
+Business: Password hashing offloaded to a bounded worker pool, adaptive bcrypt cost and attempt throttling
+Args: BCRYPT_ROUNDS or BCRYPT_TARGET_MS, HASH_WORKERS, HASH_QUEUE_LIMIT, LOGIN_* throttle env variables
+Returns: bcrypt hashes, verification results with rehash-on-login, Retry-After seconds for throttled clients
+'''
+
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, Optional, Tuple
+
+import bcrypt
+
+from metrics import phase
+
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', os.cpu_count() or 2))
+HASH_QUEUE_LIMIT = int(os.environ.get('HASH_QUEUE_LIMIT', HASH_WORKERS * 4))
+BCRYPT_TARGET_MS = float(os.environ.get('BCRYPT_TARGET_MS', 250))
+MIN_ROUNDS = 10
+# Calibration never picks a cost below this, however slow the container measured
+ROUNDS_FLOOR = 12
+MAX_ROUNDS = 15
+
+LOGIN_IP_LIMIT = int(os.environ.get('LOGIN_IP_LIMIT', 30))
+LOGIN_ACCOUNT_FAILURE_LIMIT = int(os.environ.get('LOGIN_ACCOUNT_FAILURE_LIMIT', 5))
+LOGIN_WINDOW = float(os.environ.get('LOGIN_WINDOW', 60))
+THROTTLE_MAX_KEYS = 10000
+
+class HashingBusy(Exception):
+    pass
+
+_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='bcrypt')
+_slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_LIMIT)
+_rounds: Optional[int] = int(os.environ['BCRYPT_ROUNDS']) if os.environ.get('BCRYPT_ROUNDS') else None
+_rounds_lock = threading.Lock()
+
+_throttle_lock = threading.Lock()
+_ip_attempts: Dict[str, Deque[float]] = {}
+_account_failures: Dict[str, Deque[float]] = {}
+
+def _calibrate() -> None:
+    '''
+    Cost factor whose hash time fits BCRYPT_TARGET_MS on this machine, never
+    below ROUNDS_FLOOR. Measured once per container at MIN_ROUNDS; every extra
+    round doubles the work. BCRYPT_ROUNDS skips the measurement.
+    '''
+    global _rounds
+    with _rounds_lock:
+        if _rounds is not None:
+            return
+        started = time.perf_counter()
+        bcrypt.hashpw(b'calibration', bcrypt.gensalt(rounds=MIN_ROUNDS))
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        rounds = MIN_ROUNDS
+        while rounds < MAX_ROUNDS and elapsed_ms * 2 <= BCRYPT_TARGET_MS:
+            rounds += 1
+            elapsed_ms *= 2
+        _rounds = max(rounds, ROUNDS_FLOOR)
+
+def target_rounds() -> int:
+    '''
+    Calibrated cost, or ROUNDS_FLOOR while the calibration started at import
+    is still running, so no login waits on the measurement.
+    '''
+    return _rounds if _rounds is not None else ROUNDS_FLOOR
+
+def _submit(fn, *args):
+    if not _slots.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        with phase('hash'):
+            return _executor.submit(fn, *args).result()
+    finally:
+        _slots.release()
+
+def _hash(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds)).decode('utf-8')
+
+def _verify(password: str, stored_hash: str, rounds: int) -> Tuple[bool, Optional[str]]:
+    if stored_hash.startswith('$2'):
+        valid = bcrypt.checkpw(password.encode('utf-8'), stored_hash.encode('utf-8'))
+        # Only ever upgrade: containers may calibrate differently and must not ping-pong or downgrade hashes
+        needs_rehash = valid and int(stored_hash.split('$')[2]) < rounds
+    else:
+        valid = hashlib.sha256(password.encode()).hexdigest() == stored_hash
+        needs_rehash = valid
+    return valid, (_hash(password, rounds) if needs_rehash else None)
+
+if _rounds is None:
+    threading.Thread(target=_calibrate, name='bcrypt-calibration', daemon=True).start()
+
+def hash_password(password: str) -> str:
+    return _submit(_hash, password, target_rounds())
+
+def verify_password(password: str, stored_hash: str) -> Tuple[bool, Optional[str]]:
+    '''
+    Returns (valid, new_hash). new_hash is set when the stored hash is a legacy
+    SHA-256 digest or uses a lower bcrypt cost than the current target.
+    '''
+    return _submit(_verify, password, stored_hash, target_rounds())
+
+def _prune(window: Deque[float], now: float) -> None:
+    while window and now - window[0] > LOGIN_WINDOW:
+        window.popleft()
+
+def _retry_after(window: Deque[float], now: float) -> int:
+    return max(1, int(LOGIN_WINDOW - (now - window[0])) + 1)
+
+def check_throttle(client_ip: str, account: str) -> Optional[int]:
+    '''
+    Counts the attempt against the client IP and returns Retry-After seconds when
+    the IP or the account (by recent failures) is over its limit, before any hashing.
+    '''
+    now = time.monotonic()
+    with _throttle_lock:
+        if account:
+            failures = _account_failures.get(account)
+            if failures is not None:
+                _prune(failures, now)
+                if len(failures) >= LOGIN_ACCOUNT_FAILURE_LIMIT:
+                    return _retry_after(failures, now)
+
+        if len(_ip_attempts) > THROTTLE_MAX_KEYS:
+            for table in (_ip_attempts, _account_failures):
+                for key in [key for key, window in table.items() if not window or now - window[-1] > LOGIN_WINDOW]:
+                    del table[key]
+
+        attempts = _ip_attempts.setdefault(client_ip, deque())
+        _prune(attempts, now)
+        if len(attempts) >= LOGIN_IP_LIMIT:
+            return _retry_after(attempts, now)
+        attempts.append(now)
+    return None
+
+def record_failure(account: str) -> None:
+    with _throttle_lock:
+        _account_failures.setdefault(account, deque()).append(time.monotonic())
+
+def clear_failures(account: str) -> None:
+    with _throttle_lock:
+        _account_failures.pop(account, None)
@@ -0,0 +1,43 @@
+'''
+Business: One-call "ready" bootstrap payload for client startup
+Args: verified user id
+Returns: User, settings, servers with channels, DMs and read states as one JSON document
+'''
+
+from typing import Optional
+
+# Whole payload is assembled by Postgres in a single statement and returned as JSON text
+READY_QUERY = """SELECT json_build_object(
+    'user', (SELECT json_build_object(
+                 'id', u.id, 'incordes_id', u.incordes_id, 'username', u.username, 'email', u.email,
+                 'avatar_url', u.avatar_url, 'banner_url', u.banner_url, 'bio', u.bio,
+                 'status', u.status, 'theme', u.theme)
+             FROM users u WHERE u.id = %(user_id)s),
+    'settings', (SELECT row_to_json(us) FROM user_settings us WHERE us.user_id = %(user_id)s),
+    'servers', COALESCE((SELECT json_agg(json_build_object(
+                    'id', s.id, 'server_id', s.server_id, 'name', s.name, 'icon_url', s.icon_url,
+                    'owner_id', s.owner_id, 'snapshot_version', s.snapshot_version,
+                    'channels', COALESCE((SELECT json_agg(c ORDER BY c.position)
+                                          FROM channels c WHERE c.server_id = s.id), '[]'))
+                    ORDER BY sm.joined_at DESC)
+                 FROM server_members sm JOIN servers s ON s.id = sm.server_id
+                 WHERE sm.user_id = %(user_id)s), '[]'),
+    'dms', COALESCE((SELECT json_agg(json_build_object(
+                    'id', c.id, 'channel_id', c.channel_id,
+                    'recipient', json_build_object(
+                        'id', r.id, 'username', r.username, 'discriminator', r.discriminator,
+                        'incordes_id', r.incordes_id, 'avatar_url', r.avatar_url)))
+                 FROM dm_participants p
+                 JOIN channels c ON c.id = p.channel_id
+                 JOIN users r ON r.id = CASE WHEN p.user_low = %(user_id)s THEN p.user_high ELSE p.user_low END
+                 WHERE p.user_low = %(user_id)s OR p.user_high = %(user_id)s), '[]'),
+    'read_states', COALESCE((SELECT json_agg(json_build_object(
+                    'channel_id', rs.channel_id, 'last_read_message_id', rs.last_read_message_id,
+                    'last_read_at', rs.last_read_at))
+                 FROM read_states rs WHERE rs.user_id = %(user_id)s), '[]')
+)::text AS ready, EXISTS (SELECT 1 FROM users WHERE id = %(user_id)s) AS found"""
+
+def load_ready(cursor, user_id: int) -> Optional[str]:
+    cursor.execute(READY_QUERY, {'user_id': user_id})
+    row = cursor.fetchone()
+    return row['ready'] if row['found'] else None
@@ -0,0 +1,110 @@
+'''
+Business: Shared HTTP response builder for the function handlers
+Args: event (for Accept-Encoding), status code, JSON-serializable data or prebuilt JSON text
+Returns: Function gateway response dicts with CORS headers and optional br/zstd/gzip body
+'''
+
+import base64
+import gzip
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+from typing import Dict, Any, Optional, Tuple
+
+from metrics import phase
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESS_MIN_BYTES = 1024
+CORS_HEADERS = {'Access-Control-Allow-Origin': '*'}
+READ_TOKEN_HEADER = 'X-Read-Token'
+
+def _default(value):
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (bytes, memoryview)):
+        return bytes(value).decode('utf-8', 'replace')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(data: Any) -> str:
+    '''
+    orjson when installed (serializes datetime natively), stdlib json otherwise.
+    '''
+    with phase('serialize'):
+        if orjson:
+            return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        return json.dumps(data, default=_default, ensure_ascii=False, separators=(',', ':'))
+
+def get_header(event: Dict[str, Any], name: str) -> str:
+    headers = (event or {}).get('headers') or {}
+    return headers.get(name) or headers.get(name.lower()) or ''
+
+def compress_body(body: str, accept_encoding: str) -> Tuple[str, Optional[str]]:
+    '''
+    Returns (body, content_encoding). Compressed bodies are base64 encoded for
+    the function gateway; small payloads are sent as-is.
+    '''
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+
+    accepted = {token.split(';')[0].strip().lower() for token in (accept_encoding or '').split(',')}
+    raw = body.encode('utf-8')
+    if brotli and 'br' in accepted:
+        compressed, encoding = brotli.compress(raw, quality=4), 'br'
+    elif zstandard and 'zstd' in accepted:
+        compressed, encoding = zstandard.ZstdCompressor(level=3).compress(raw), 'zstd'
+    elif 'gzip' in accepted:
+        compressed, encoding = gzip.compress(raw, compresslevel=6), 'gzip'
+    else:
+        return body, None
+    return base64.b64encode(compressed).decode('ascii'), encoding
+
+def raw_response(event: Dict[str, Any], status: int, body: str, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    response_headers = {**CORS_HEADERS, **(headers or {})}
+    if body:
+        response_headers.setdefault('Content-Type', 'application/json')
+    with phase('compress'):
+        body, encoding = compress_body(body, get_header(event, 'Accept-Encoding'))
+    if encoding:
+        response_headers['Content-Encoding'] = encoding
+        response_headers['Vary'] = 'Accept-Encoding'
+
+    response = {'statusCode': status, 'headers': response_headers, 'body': body}
+    if encoding:
+        response['isBase64Encoded'] = True
+    return response
+
+def json_response(event: Dict[str, Any], status: int, data: Any = None, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    return raw_response(event, status, '' if data is None else dumps(data), headers)
+
+def read_token_headers(token: Optional[str]) -> Dict[str, str]:
+    if not token:
+        return {}
+    return {READ_TOKEN_HEADER: token, 'Access-Control-Expose-Headers': READ_TOKEN_HEADER}
+
+def preflight_response(methods: str, allow_headers: str) -> Dict[str, Any]:
+    return {
+        'statusCode': 200,
+        'headers': {
+            **CORS_HEADERS,
+            'Access-Control-Allow-Methods': methods,
+            'Access-Control-Allow-Headers': allow_headers,
+            'Access-Control-Max-Age': '86400'
+        },
+        'body': ''
+    }
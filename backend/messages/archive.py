@@ -0,0 +1,80 @@
+'''
+Business: Read-back of archived (detached) monthly message partitions from compressed files
+Args: MESSAGES_ARCHIVE_DIR env variable, layout <dir>/<partition>/<channel_id>.ndjson.gz
+Returns: History rows in the same shape as the live history query, newest first
+'''
+
+import gzip
+import json
+import os
+import time
+from datetime import datetime
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+ARCHIVE_DIR = os.environ.get('MESSAGES_ARCHIVE_DIR')
+DATETIME_FIELDS = ('created_at', 'edited_at')
+PARTITIONS_CACHE_TTL = 60
+
+# Archived partitions holding rows of one channel, newest first
+CHANNEL_PARTITIONS_QUERY = """SELECT a.partition_name FROM messages_archive_channels ac 
+                              JOIN messages_archive a ON a.partition_name = ac.partition_name 
+                              WHERE ac.channel_id = %s AND a.range_start <= %s 
+                              ORDER BY a.range_start DESC"""
+
+_partitions_cache = {'expires': 0.0, 'partitions': []}
+
+def channel_file(partition_name: str, channel_id) -> str:
+    return os.path.join(ARCHIVE_DIR, partition_name, f"{int(channel_id)}.ndjson.gz")
+
+def encode_row(row: Dict[str, Any]) -> str:
+    return json.dumps(
+        {key: value.isoformat() if isinstance(value, datetime) else value for key, value in row.items()},
+        ensure_ascii=False
+    )
+
+def decode_row(line: str) -> Dict[str, Any]:
+    row = json.loads(line)
+    for field in DATETIME_FIELDS:
+        if row.get(field):
+            row[field] = datetime.fromisoformat(row[field])
+    return row
+
+def channel_rows(partition_name: str, channel_id) -> Iterator[Dict[str, Any]]:
+    path = channel_file(partition_name, channel_id)
+    if not os.path.exists(path):
+        return
+    with gzip.open(path, 'rt', encoding='utf-8') as archive_file:
+        for line in archive_file:
+            yield decode_row(line)
+
+def archived_partitions(cursor) -> List[Tuple[str, datetime]]:
+    now = time.monotonic()
+    if _partitions_cache['expires'] < now:
+        cursor.execute("SELECT partition_name, range_start FROM messages_archive ORDER BY range_start DESC")
+        _partitions_cache['partitions'] = [(row['partition_name'], row['range_start']) for row in cursor.fetchall()]
+        _partitions_cache['expires'] = now + PARTITIONS_CACHE_TTL
+    return _partitions_cache['partitions']
+
+def read_older(cursor, channel_id, before: Optional[Tuple[datetime, int]], limit: int) -> List[Dict[str, Any]]:
+    '''
+    Continue a newest-first history page into archived partitions. Only partitions
+    messages_archive_channels lists for this channel are opened, so a channel that
+    was never archived costs one index probe and no file access. Files are
+    written sorted by (created_at DESC, id DESC), so reading stops after `limit` rows.
+    '''
+    if not ARCHIVE_DIR or limit <= 0:
+        return []
+    partitions = archived_partitions(cursor)
+    if not partitions or (before and partitions[-1][1] > before[0]):
+        return []
+
+    cursor.execute(CHANNEL_PARTITIONS_QUERY, (channel_id, before[0] if before else datetime.max))
+    rows = []
+    for partition in cursor.fetchall():
+        for row in channel_rows(partition['partition_name'], channel_id):
+            if before and (row['created_at'], row['id']) >= before:
+                continue
+            rows.append(row)
+            if len(rows) >= limit:
+                return rows
+    return rows
@@ -0,0 +1,88 @@
+'''
+Business: Direct message channels keyed by the canonical participant pair
+Args: the two user ids of a conversation, or one user id for the conversation list
+Returns: The DM channel for a pair (created on first open) and the user's DMs by latest message
+'''
+
+from typing import Dict, Any, List, Optional
+
+from snowflake import next_key
+
+DM_PAGE_SIZE = 50
+PREVIEW_LENGTH = 100
+
+LOOKUP_QUERY = """SELECT c.id, c.channel_id FROM dm_participants p
+                  JOIN channels c ON c.id = p.channel_id
+                  WHERE p.user_low = %(low)s AND p.user_high = %(high)s"""
+
+# Channel and pair rows are created together only when the pair has no channel
+# yet; a concurrent open of the same pair makes the pair insert a no-op
+CREATE_QUERY = """WITH channel AS (
+                      INSERT INTO channels (channel_id, name, type, is_dm)
+                      SELECT %(key)s, 'Direct Message', 'direct', TRUE
+                      WHERE NOT EXISTS (SELECT 1 FROM dm_participants WHERE user_low = %(low)s AND user_high = %(high)s)
+                      AND (SELECT COUNT(*) FROM users WHERE id IN (%(low)s, %(high)s)) = 2
+                      RETURNING id, channel_id
+                  ), pair AS (
+                      INSERT INTO dm_participants (channel_id, user_low, user_high)
+                      SELECT id, %(low)s, %(high)s FROM channel
+                      ON CONFLICT (user_low, user_high) DO NOTHING
+                      RETURNING channel_id
+                  )
+                  SELECT channel.id, channel.channel_id FROM channel JOIN pair ON pair.channel_id = channel.id"""
+
+# The last message comes from the current month's partition; the older months are
+# only scanned (Append runs its branches in order) for DMs quiet this month
+LIST_QUERY = f"""SELECT c.id, c.channel_id,
+                        json_build_object('id', r.id, 'username', r.username, 'discriminator', r.discriminator,
+                                          'incordes_id', r.incordes_id, 'avatar_url', r.avatar_url) AS recipient,
+                        CASE WHEN last.id IS NULL THEN NULL ELSE json_build_object(
+                            'id', last.id, 'message_id', last.message_id, 'user_id', last.user_id,
+                            'content', left(last.content, {PREVIEW_LENGTH}), 'created_at', last.created_at)
+                        END AS last_message
+                 FROM dm_participants p
+                 JOIN channels c ON c.id = p.channel_id
+                 JOIN users r ON r.id = CASE WHEN p.user_low = %(user_id)s THEN p.user_high ELSE p.user_low END
+                 LEFT JOIN LATERAL (
+                     (SELECT m.id, m.message_id, m.user_id, m.content, m.created_at FROM messages m
+                      WHERE m.channel_id = c.id AND m.created_at >= date_trunc('month', LOCALTIMESTAMP)
+                      AND m.created_at < date_trunc('month', LOCALTIMESTAMP) + INTERVAL '1 month'
+                      ORDER BY m.created_at DESC, m.id DESC
+                      LIMIT 1)
+                     UNION ALL
+                     (SELECT m.id, m.message_id, m.user_id, m.content, m.created_at FROM messages m
+                      WHERE m.channel_id = c.id AND m.created_at < date_trunc('month', LOCALTIMESTAMP)
+                      ORDER BY m.created_at DESC, m.id DESC
+                      LIMIT 1)
+                     LIMIT 1
+                 ) last ON true
+                 WHERE p.user_low = %(user_id)s OR p.user_high = %(user_id)s
+                 ORDER BY COALESCE(last.created_at, p.created_at) DESC, c.id DESC
+                 LIMIT %(limit)s"""
+
+def open_dm(conn, cursor, user_id: int, friend_id: int) -> Optional[Dict[str, Any]]:
+    '''
+    Returns the DM channel for the pair, creating it on first use, or None when
+    the friend does not exist. Commits when a channel was created.
+    '''
+    pair = {'low': min(user_id, friend_id), 'high': max(user_id, friend_id)}
+    cursor.execute(LOOKUP_QUERY, pair)
+    channel = cursor.fetchone()
+    if channel:
+        return dict(channel)
+
+    cursor.execute(CREATE_QUERY, {**pair, 'key': next_key("DM")})
+    channel = cursor.fetchone()
+    if channel:
+        conn.commit()
+        return dict(channel)
+
+    # Lost the race to a concurrent open (drop our orphaned channel row) or the friend is unknown
+    conn.rollback()
+    cursor.execute(LOOKUP_QUERY, pair)
+    channel = cursor.fetchone()
+    return dict(channel) if channel else None
+
+def list_dms(cursor, user_id: int, limit: int = DM_PAGE_SIZE) -> List[Dict[str, Any]]:
+    cursor.execute(LIST_QUERY, {'user_id': user_id, 'limit': limit})
+    return [dict(row) for row in cursor.fetchall()]
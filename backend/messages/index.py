@@ -4,140 +4,495 @@ Args: event with httpMethod, body, headers (Authorization)
 Returns: Messages, DM channels
 '''
 
+import base64
 import json
 import os
+import select
+import time
 import psycopg2
+from psycopg2 import sql
 from psycopg2.extras import RealDictCursor
-import jwt
+from datetime import datetime, timedelta
 from typing import Dict, Any
 
-DATABASE_URL = os.environ.get('DATABASE_URL')
-JWT_SECRET = 'incordes_secret_key_2024_change_in_production'
+import archive
+from db import get_connection, get_read_connection, release_connection, read_token, parse_lsn
+from responses import json_response, preflight_response, get_header, read_token_headers, READ_TOKEN_HEADER
+from snowflake import next_key, WorkerIdsExhausted, LEASE_RETRY_DELAY
+from tokens import user_id_from_header
+import read_state
+import dms
+import reactions
+import rate_limits
+import metrics
+from search import search_messages
 
-def verify_token(auth_header: str):
-    if not auth_header or not auth_header.startswith('Bearer '):
+MAX_PAGE_SIZE = 100
+LONG_POLL_MAX_WAIT = 25
+MAX_BATCH_SIZE = 500
+NOTIFY_CHANNEL_PREFIX = 'messages_channel_'
+GATEWAY_NOTIFY_CHANNEL = 'gateway_messages'
+NOTIFY_PAYLOAD_LIMIT = 7900
+# created_at is the send transaction's start, so a send can commit behind a row a client
+# already synced past. Every sync re-reads this many seconds and drops ids the client has
+SYNC_OVERLAP = float(os.environ.get('SYNC_OVERLAP_SECONDS', 10))
+SYNC_SEEN_LIMIT = int(os.environ.get('SYNC_SEEN_LIMIT', 100))
+
+HISTORY_QUERY = """SELECT m.id, m.message_id, m.channel_id, m.user_id, m.content, m.created_at, 
+                          m.attachments, m.embeds, m.edited_at, m.referenced_message_id, 
+                          u.username, u.discriminator, u.incordes_id, u.avatar_url, 
+                          """ + reactions.SUMMARY_SQL + """ AS reactions 
+                   FROM messages m 
+                   JOIN users u ON m.user_id = u.id 
+                   WHERE m.channel_id = %s {where} 
+                   ORDER BY m.created_at {order}, m.id {order} 
+                   LIMIT %s"""
+
+OLDER = 'AND m.created_at <= %s AND (m.created_at, m.id) < (%s, %s)'
+OLDER_OR_SAME = 'AND m.created_at <= %s AND (m.created_at, m.id) <= (%s, %s)'
+NEWER = 'AND m.created_at >= %s AND (m.created_at, m.id) > (%s, %s)'
+SYNC_WINDOW = 'AND m.created_at >= %s'
+# The first page reads the current month's partition and widens only when it comes back short
+CURRENT_MONTH = """AND m.created_at >= date_trunc('month', LOCALTIMESTAMP) 
+                   AND m.created_at < date_trunc('month', LOCALTIMESTAMP) + INTERVAL '1 month'"""
+BEFORE_CURRENT_MONTH = "AND m.created_at < date_trunc('month', LOCALTIMESTAMP)"
+
+# Ids a plain message cursor has already delivered inside the overlap window
+SEEN_QUERY = """SELECT id, created_at FROM messages 
+                WHERE channel_id = %s AND created_at >= %s AND (created_at, id) <= (%s, %s) 
+                ORDER BY created_at DESC, id DESC 
+                LIMIT %s"""
+
+# One round trip per send or batch: bulk insert from arrays, author join and NOTIFY.
+# The gateway event carries the whole message unless it would exceed the NOTIFY
+# payload limit, in which case the gateway loads it by id
+SEND_QUERY = """WITH inserted AS (
+                    INSERT INTO messages (message_id, channel_id, user_id, content) 
+                    SELECT new.message_id, new.channel_id, %s, new.content 
+                    FROM unnest(%s::varchar[], %s::int[], %s::text[]) WITH ORDINALITY 
+                         AS new(message_id, channel_id, content, ord) 
+                    ORDER BY new.ord 
+                    RETURNING id, message_id, channel_id, user_id, content, created_at
+                )
+                SELECT i.id, i.message_id, i.channel_id, i.content, i.created_at, 
+                       u.username, u.discriminator, u.incordes_id, u.avatar_url, 
+                       pg_notify('{prefix}' || i.channel_id, i.id::text) AS notified, 
+                       pg_notify('{gateway}', CASE WHEN octet_length(e.payload) < {payload_limit} THEN e.payload 
+                                 ELSE json_build_object('channel_id', i.channel_id, 'id', i.id)::text END) AS dispatched 
+                FROM inserted i 
+                JOIN users u ON u.id = i.user_id 
+                CROSS JOIN LATERAL (SELECT json_build_object( 
+                    'channel_id', i.channel_id, 
+                    'message', json_build_object( 
+                        'id', i.id, 'message_id', i.message_id, 'channel_id', i.channel_id, 
+                        'user_id', i.user_id, 'content', i.content, 'created_at', i.created_at, 
+                        'author', json_build_object('username', u.username, 'discriminator', u.discriminator, 
+                                                    'incordes_id', u.incordes_id, 'avatar_url', u.avatar_url)) 
+                )::text AS payload) e 
+                ORDER BY i.id""".format(prefix=NOTIFY_CHANNEL_PREFIX, gateway=GATEWAY_NOTIFY_CHANNEL, 
+                                        payload_limit=NOTIFY_PAYLOAD_LIMIT)
+
+def encode_cursor(row) -> str:
+    raw = f"{row['created_at'].isoformat()}|{row['id']}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor_value: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor_value.encode('ascii')).decode('utf-8')
+        created_at, message_pk = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(message_pk)
+    except (ValueError, UnicodeError):
         return None
-    token = auth_header.split(' ')[1]
+
+def encode_sync_cursor(floor, seen) -> str:
+    raw = f"sync|{floor.isoformat()}|{','.join(str(message_pk) for message_pk in sorted(seen))}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_sync_cursor(cursor_value: str):
+    '''
+    A `since` value is either a sync cursor (window floor plus the ids already
+    delivered at or after it) or a plain message cursor, which counts every
+    message up to it as delivered. Returns (floor, seen ids, message position).
+    '''
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
-        return payload.get('user_id')
-    except:
+        raw = base64.urlsafe_b64decode(cursor_value.encode('ascii')).decode('utf-8')
+        if raw.startswith('sync|'):
+            _, floor, ids = raw.split('|', 2)
+            return datetime.fromisoformat(floor), {int(value) for value in ids.split(',') if value}, None
+    except (ValueError, UnicodeError):
+        return None
+    position = decode_cursor(cursor_value)
+    if not position:
         return None
+    return position[0] - timedelta(seconds=SYNC_OVERLAP), None, position
+
+def fetch_since(cursor, channel_id, viewer_id, limit: int, since):
+    '''
+    Messages the client has not seen yet, oldest window first. Reads everything from
+    the window floor and filters out delivered ids, so a late commit behind the
+    client's newest message is still picked up. Returns (rows newest first,
+    has_more, next sync cursor).
+    '''
+    floor, seen, position = since
+    if position:
+        cursor.execute(SEEN_QUERY, (channel_id, floor, position[0], position[1], SYNC_SEEN_LIMIT))
+        seen_rows = cursor.fetchall()
+        seen = {row['id'] for row in seen_rows}
+        if len(seen_rows) == SYNC_SEEN_LIMIT:
+            # Everything at or below the message cursor is delivered, so the floor can
+            # move past the oldest timestamp instead of splitting its group
+            floor = seen_rows[-1]['created_at'] + timedelta(microseconds=1)
+            seen = {row['id'] for row in seen_rows if row['created_at'] >= floor}
+    
+    cursor.execute(
+        HISTORY_QUERY.format(where=SYNC_WINDOW, order='ASC'),
+        (viewer_id, channel_id, floor, limit + len(seen) + 1)
+    )
+    window = cursor.fetchall()
+    fresh = [row for row in window if row['id'] not in seen]
+    has_more = len(fresh) > limit
+    fresh = fresh[:limit]
+    
+    delivered_ids = seen | {row['id'] for row in fresh}
+    delivered = [row for row in window if row['id'] in delivered_ids]
+    if delivered:
+        floor = max(floor, delivered[-1]['created_at'] - timedelta(seconds=SYNC_OVERLAP))
+    kept = [row for row in delivered if row['created_at'] >= floor]
+    if len(kept) > SYNC_SEEN_LIMIT:
+        # Never split a created_at group (a send_batch shares one): rows cut off inside
+        # the window would come back on every sync. The whole oldest kept group stays
+        start = len(kept) - SYNC_SEEN_LIMIT
+        while start > 0 and kept[start - 1]['created_at'] == kept[start]['created_at']:
+            start -= 1
+        kept = kept[start:]
+        floor = kept[0]['created_at']
+    # Delivered ids past the end of a truncated window have not been read back; keep them
+    next_seen = {row['id'] for row in kept} | (seen - {row['id'] for row in window})
+    
+    return list(reversed(fresh)), has_more, encode_sync_cursor(floor, next_seen)
+
+def fetch_history(cursor, channel_id, viewer_id, limit: int, before=None, after=None, around=None):
+    '''
+    Keyset pagination over (created_at, id) so every page is an index range scan
+    on idx_messages_channel_created regardless of how deep into history it is.
+    Every query carries a plain created_at bound so monthly partitions are pruned:
+    cursor pages by their cursor, the first page by the current month, widened to
+    older months only when that month is short. Pages that run past the oldest
+    live partition continue into the archive.
+    Messages are always returned newest first, with reaction counts for viewer_id.
+    '''
+    if around:
+        older_limit = limit // 2
+        cursor.execute(
+            HISTORY_QUERY.format(where=OLDER_OR_SAME, order='DESC'),
+            (viewer_id, channel_id, around[0], around[0], around[1], older_limit + 1)
+        )
+        older = cursor.fetchall()
+        if len(older) <= older_limit:
+            older += archive.read_older(cursor, channel_id, (around[0], around[1] + 1), older_limit + 1 - len(older))
+        cursor.execute(
+            HISTORY_QUERY.format(where=NEWER, order='ASC'),
+            (viewer_id, channel_id, around[0], around[0], around[1], limit - older_limit)
+        )
+        newer = cursor.fetchall()
+        has_more = len(older) > older_limit
+        return list(reversed(newer)) + older[:older_limit], has_more
+    
+    if after:
+        cursor.execute(
+            HISTORY_QUERY.format(where=NEWER, order='ASC'),
+            (viewer_id, channel_id, after[0], after[0], after[1], limit + 1)
+        )
+        rows = cursor.fetchall()
+        return list(reversed(rows[:limit])), len(rows) > limit
+    
+    if before:
+        cursor.execute(
+            HISTORY_QUERY.format(where=OLDER, order='DESC'),
+            (viewer_id, channel_id, before[0], before[0], before[1], limit + 1)
+        )
+    else:
+        cursor.execute(HISTORY_QUERY.format(where=CURRENT_MONTH, order='DESC'), (viewer_id, channel_id, limit + 1))
+    rows = cursor.fetchall()
+    
+    if not before and len(rows) <= limit:
+        cursor.execute(
+            HISTORY_QUERY.format(where=BEFORE_CURRENT_MONTH, order='DESC'),
+            (viewer_id, channel_id, limit + 1 - len(rows))
+        )
+        rows += cursor.fetchall()
+    
+    if len(rows) <= limit:
+        oldest = (rows[-1]['created_at'], rows[-1]['id']) if rows else before
+        rows += archive.read_older(cursor, channel_id, oldest, limit + 1 - len(rows))
+    return rows[:limit], len(rows) > limit
+
+def notify_channel_name(channel_id) -> str:
+    return f"{NOTIFY_CHANNEL_PREFIX}{int(channel_id)}"
+
+def format_sent_message(row) -> Dict[str, Any]:
+    message = dict(row)
+    message.pop('notified', None)
+    message.pop('dispatched', None)
+    message['author'] = {
+        key: message.pop(key) for key in ('username', 'discriminator', 'incordes_id', 'avatar_url')
+    }
+    message['reactions'] = []
+    message['cursor'] = encode_cursor(message)
+    return message
+
+def rate_limited_response(event, limited):
+    scope, retry_after = limited
+    return json_response(event, 429, {
+        'error': 'You are sending messages too quickly',
+        'scope': scope,
+        'retry_after': retry_after
+    }, headers={'Retry-After': str(retry_after)})
+
+def wait_for_messages(conn, channel_id, viewer_id, since, limit: int, wait: float):
+    '''
+    Long-poll for messages the `since` cursor has not delivered. LISTEN is issued before
+    the first read so a NOTIFY from a concurrent send cannot slip between the read and the wait.
+    '''
+    listen_channel = sql.Identifier(notify_channel_name(channel_id))
+    conn.autocommit = True
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        cursor.execute(sql.SQL('LISTEN {}').format(listen_channel))
+        rows, has_more, next_cursor = fetch_since(cursor, channel_id, viewer_id, limit, since)
+        deadline = time.monotonic() + wait
+        
+        while not rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if select.select([conn], [], [], remaining) == ([], [], []):
+                break
+            conn.poll()
+            if conn.notifies:
+                conn.notifies.clear()
+                rows, has_more, next_cursor = fetch_since(cursor, channel_id, viewer_id, limit, since)
+        
+        return rows, has_more, next_cursor
+    finally:
+        # The connection goes back to the pool: it must not stay subscribed on any path
+        try:
+            cursor.execute(sql.SQL('UNLISTEN {}').format(listen_channel))
+            cursor.close()
+            conn.autocommit = False
+        except psycopg2.Error:
+            conn.close()
+        conn.notifies.clear()
+
+def wants_replica(method: str, params: Dict[str, Any], body: Dict[str, Any]) -> bool:
+    '''
+    Reads a replica may serve. Unread counts flush pending acks and long polls
+    LISTEN for new messages, so both stay on the primary.
+    '''
+    if method == 'POST':
+        return body.get('action') == 'search'
+    return method == 'GET' and not params.get('unread') and not params.get('wait')
 
+@metrics.instrumented
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return preflight_response('GET, POST, PUT, DELETE, OPTIONS', f'Content-Type, Authorization, {READ_TOKEN_HEADER}')
     
-    user_id = verify_token(event.get('headers', {}).get('Authorization', ''))
+    user_id = user_id_from_header(event.get('headers', {}).get('Authorization', ''))
     if not user_id:
-        return {
-            'statusCode': 401,
-            'headers': {'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Unauthorized'})
-        }
+        return json_response(event, 401, {'error': 'Unauthorized'})
     
-    conn = psycopg2.connect(DATABASE_URL)
+    params = event.get('queryStringParameters', {}) or {}
+    body = json.loads(event.get('body', '{}')) if method == 'POST' else {}
+    read_only = wants_replica(method, params, body)
+    if read_only:
+        conn = get_read_connection(parse_lsn(get_header(event, READ_TOKEN_HEADER)))
+    else:
+        conn = get_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
+        # Buffered acks are written by the user's next request on the primary; acks
+        # themselves keep coalescing until ACK_FLUSH_INTERVAL
+        if not read_only and body.get('action') != 'ack' and read_state.has_pending(user_id):
+            read_state.flush(cursor, user_id=user_id)
+            conn.commit()
+        
         if method == 'POST':
-            body = json.loads(event.get('body', '{}'))
             action = body.get('action')
+            metrics.set_action(action)
             
             if action == 'send':
                 channel_id = body.get('channel_id')
                 content = body.get('content', '')
                 
+                limited = rate_limits.check_send(conn, cursor, user_id, [int(channel_id)])
+                if limited:
+                    return rate_limited_response(event, limited)
+                
                 cursor.execute(
-                    """INSERT INTO messages (message_id, channel_id, user_id, content) 
-                       VALUES (%s, %s, %s, %s) 
-                       RETURNING id, message_id, content, created_at""",
-                    (f"M{int(os.urandom(4).hex(), 16)}", channel_id, user_id, content)
+                    SEND_QUERY,
+                    (user_id, [next_key("M")], [int(channel_id)], [content])
                 )
-                message = dict(cursor.fetchone())
+                message = format_sent_message(cursor.fetchone())
                 conn.commit()
                 
+                return json_response(event, 200, message, headers=read_token_headers(read_token(conn)))
+            
+            elif action == 'send_batch':
+                items = body.get('messages') or []
+                
+                if not items or len(items) > MAX_BATCH_SIZE:
+                    return json_response(event, 400, {'error': f'Batch must contain 1-{MAX_BATCH_SIZE} messages'})
+                
+                if any(not item.get('channel_id') or not item.get('content') for item in items):
+                    return json_response(event, 400, {'error': 'Every message needs channel_id and content'})
+                
+                try:
+                    limited = rate_limits.check_send(
+                        conn, cursor, user_id, [int(item['channel_id']) for item in items], batch=True
+                    )
+                except ValueError as e:
+                    return json_response(event, 400, {'error': str(e)})
+                if limited:
+                    return rate_limited_response(event, limited)
+                
                 cursor.execute(
-                    "SELECT username, discriminator, incordes_id, avatar_url FROM users WHERE id = %s",
-                    (user_id,)
+                    SEND_QUERY,
+                    (
+                        user_id,
+                        [next_key("M") for _ in items],
+                        [int(item['channel_id']) for item in items],
+                        [item['content'] for item in items]
+                    )
                 )
-                author = dict(cursor.fetchone())
-                message['author'] = author
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(message)
-                }
+                messages = [format_sent_message(row) for row in cursor.fetchall()]
+                conn.commit()
+                
+                return json_response(event, 200, {'messages': messages}, headers=read_token_headers(read_token(conn)))
+            
+            elif action == 'ack':
+                channel_id = body.get('channel_id')
+                position = decode_cursor(body.get('cursor') or '')
+                
+                if not str(channel_id or '').isdigit() or not position:
+                    return json_response(event, 400, {'error': 'channel_id and message cursor required'})
+                
+                read_state.ack(user_id, int(channel_id), position)
+                read_state.flush(cursor)
+                conn.commit()
+                
+                return json_response(event, 200, {'success': True})
+            
+            elif action in ('add_reaction', 'remove_reaction'):
+                message_id = body.get('message_id')
+                if not message_id:
+                    return json_response(event, 400, {'error': 'message_id required'})
+                
+                apply_reaction = reactions.add_reaction if action == 'add_reaction' else reactions.remove_reaction
+                try:
+                    result = apply_reaction(cursor, message_id, body.get('emoji'), user_id)
+                except ValueError as e:
+                    return json_response(event, 400, {'error': str(e)})
+                conn.commit()
+                
+                if not result['found']:
+                    return json_response(event, 404, {'error': 'Message not found'})
+                
+                return json_response(event, 200, {
+                    'message_id': int(message_id),
+                    'emoji': body['emoji'].strip(),
+                    'count': result['count']
+                })
+            
+            elif action == 'search':
+                if not (body.get('query') or '').strip():
+                    return json_response(event, 400, {'error': 'Search query required'})
+                
+                try:
+                    results = search_messages(cursor, user_id, body)
+                except ValueError as e:
+                    return json_response(event, 400, {'error': str(e)})
+                
+                return json_response(event, 200, results)
             
             elif action == 'get_dm':
                 friend_id = body.get('friend_id')
                 
-                cursor.execute(
-                    """SELECT c.* FROM channels c 
-                       WHERE c.is_dm = TRUE 
-                       AND ((c.user_id = %s AND c.server_id = %s) OR (c.user_id = %s AND c.server_id = %s))
-                       LIMIT 1""",
-                    (user_id, friend_id, friend_id, user_id)
-                )
-                channel = cursor.fetchone()
+                try:
+                    friend_id = int(friend_id)
+                except (TypeError, ValueError):
+                    return json_response(event, 400, {'error': 'friend_id required'})
+                if friend_id == user_id:
+                    return json_response(event, 400, {'error': 'Cannot open a DM with yourself'})
                 
+                channel = dms.open_dm(conn, cursor, user_id, friend_id)
                 if not channel:
-                    cursor.execute(
-                        """INSERT INTO channels (channel_id, name, type, is_dm, user_id, server_id) 
-                           VALUES (%s, %s, %s, %s, %s, %s) 
-                           RETURNING id, channel_id""",
-                        (f"DM{int(os.urandom(4).hex(), 16)}", 'Direct Message', 'direct', True, user_id, friend_id)
-                    )
-                    channel = cursor.fetchone()
-                    conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(dict(channel))
-                }
+                    return json_response(event, 404, {'error': 'User not found'})
+                
+                return json_response(event, 200, channel, headers=read_token_headers(read_token(conn)))
         
         elif method == 'GET':
-            params = event.get('queryStringParameters', {}) or {}
             channel_id = params.get('channel_id')
-            limit = int(params.get('limit', 50))
+            
+            if params.get('unread'):
+                metrics.set_action('unread')
+                read_state.flush(cursor, user_id=user_id)
+                conn.commit()
+                counts = read_state.unread_counts(cursor, user_id, params.get('server_id'))
+                
+                return json_response(event, 200, {'channels': counts, 'unread_cap': read_state.UNREAD_CAP})
+            
+            if params.get('dms'):
+                metrics.set_action('dms')
+                limit = max(1, min(int(params.get('limit', dms.DM_PAGE_SIZE)), MAX_PAGE_SIZE))
+                return json_response(event, 200, {'dms': dms.list_dms(cursor, user_id, limit)})
+            
+            limit = max(1, min(int(params.get('limit', 50)), MAX_PAGE_SIZE))
             
             if channel_id:
-                cursor.execute(
-                    """SELECT m.*, u.username, u.discriminator, u.incordes_id, u.avatar_url 
-                       FROM messages m 
-                       JOIN users u ON m.user_id = u.id 
-                       WHERE m.channel_id = %s 
-                       ORDER BY m.created_at DESC 
-                       LIMIT %s""",
-                    (channel_id, limit)
-                )
-                messages = [dict(row) for row in cursor.fetchall()]
+                metrics.set_action('history')
+                cursors = {}
+                for key in ('before', 'after', 'around', 'since'):
+                    if params.get(key):
+                        cursors[key] = (decode_sync_cursor if key == 'since' else decode_cursor)(params[key])
+                        if not cursors[key]:
+                            return json_response(event, 400, {'error': f'Invalid {key} cursor'})
+                
+                if len(cursors) > 1:
+                    return json_response(event, 400, {'error': 'Only one of before, after, around, since is allowed'})
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'messages': messages})
-                }
+                next_cursor = None
+                if 'since' in cursors:
+                    since = cursors.pop('since')
+                    wait = max(0.0, min(float(params.get('wait', 0)), LONG_POLL_MAX_WAIT))
+                    if wait:
+                        rows, has_more, next_cursor = wait_for_messages(conn, channel_id, user_id, since, limit, wait)
+                    else:
+                        rows, has_more, next_cursor = fetch_since(cursor, channel_id, user_id, limit, since)
+                else:
+                    rows, has_more = fetch_history(cursor, channel_id, user_id, limit, **cursors)
+                messages = [dict(row) for row in rows]
+                
+                if not next_cursor and has_more and messages:
+                    edge = messages[0] if 'after' in cursors else messages[-1]
+                    next_cursor = encode_cursor(edge)
+                
+                for message in messages:
+                    message['cursor'] = encode_cursor(message)
+                
+                return json_response(event, 200, {'messages': messages, 'next_cursor': next_cursor})
         
-        return {
-            'statusCode': 405,
-            'headers': {'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
+        return json_response(event, 405, {'error': 'Method not allowed'})
+    
+    except WorkerIdsExhausted:
+        conn.rollback()
+        return json_response(event, 503, {'error': 'Server busy, try again'}, headers={
+            'Retry-After': str(int(LEASE_RETRY_DELAY))
+        })
     
     finally:
         cursor.close()
-        conn.close()
+        release_connection(conn)
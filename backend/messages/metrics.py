@@ -0,0 +1,203 @@
+'''
+Business: Request instrumentation - timed cursors, phase timers, Server-Timing, sampled slow-query log, per-action histograms
+Args: SLOW_QUERY_MS, SLOW_QUERY_SAMPLE, METRICS_TOKEN, METRICS_LOG_INTERVAL env variables
+Returns: Server-Timing header on every response, JSON log lines, cumulative histograms at GET ?metrics=1 (X-Metrics-Token)
+'''
+
+import json
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, Any, Optional
+
+import psycopg2.extensions
+from psycopg2 import sql
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+SLOW_QUERY_SAMPLE = float(os.environ.get('SLOW_QUERY_SAMPLE', 0.25))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_LOG_INTERVAL = float(os.environ.get('METRICS_LOG_INTERVAL', 300))
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+LOGGED_QUERY_LENGTH = 500
+# Actions come from request bodies; unknown names beyond the cap share one histogram
+MAX_ACTIONS = 64
+MAX_ACTION_LENGTH = 32
+
+_local = threading.local()
+_lock = threading.Lock()
+_histograms: Dict[str, Dict[str, Any]] = {}
+_last_log = time.monotonic()
+
+class RequestStats:
+    __slots__ = ('action', 'started', 'queries', 'db_ms', 'phases')
+
+    def __init__(self, action: str):
+        self.action = action
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_ms = 0.0
+        self.phases: Dict[str, float] = {}
+
+def current() -> Optional[RequestStats]:
+    return getattr(_local, 'request', None)
+
+def set_action(action) -> None:
+    request = current()
+    if request is not None and action:
+        request.action = str(action)[:MAX_ACTION_LENGTH]
+
+@contextmanager
+def phase(name: str):
+    request = current()
+    if request is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        request.phases[name] = request.phases.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+def log_event(event: Dict[str, Any]) -> None:
+    print(json.dumps(event, default=str, separators=(',', ':')), flush=True)
+
+def _statement_text(cursor, query) -> str:
+    if isinstance(query, sql.Composable):
+        query = query.as_string(cursor)
+    elif isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    return re.sub(r'\s+', ' ', query).strip()[:LOGGED_QUERY_LENGTH]
+
+def _record_query(cursor, query, started: float) -> None:
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    request = current()
+    if request is not None:
+        request.queries += 1
+        request.db_ms += elapsed_ms
+    # Parameters are never logged: they carry message content, emails and hashes
+    if elapsed_ms >= SLOW_QUERY_MS and random.random() < SLOW_QUERY_SAMPLE:
+        log_event({
+            'event': 'slow_query',
+            'action': request.action if request else None,
+            'ms': round(elapsed_ms, 2),
+            'rows': cursor.rowcount,
+            'query': _statement_text(cursor, query),
+        })
+
+class TimedCursorMixin:
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            _record_query(self, query, started)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            _record_query(self, query, started)
+
+_timed_factories: Dict[type, type] = {}
+
+def timed_factory(factory: type) -> type:
+    timed = _timed_factories.get(factory)
+    if timed is None:
+        timed = type(f'Timed{factory.__name__}', (TimedCursorMixin, factory), {})
+        _timed_factories[factory] = timed
+    return timed
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    '''
+    Connection class for the pool: every cursor, whatever its cursor_factory,
+    comes back wrapped so its queries are counted and timed.
+    '''
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = timed_factory(factory)
+        return super().cursor(*args, **kwargs)
+
+def server_timing(request: RequestStats, total_ms: float) -> str:
+    entries = [f'db;dur={request.db_ms:.1f};desc="{request.queries} queries"']
+    entries += [f'{name};dur={ms:.1f}' for name, ms in request.phases.items()]
+    entries.append(f'total;dur={total_ms:.1f}')
+    return ', '.join(entries)
+
+def _observe(request: RequestStats, total_ms: float, status: int) -> None:
+    bucket = next((i for i, bound in enumerate(BUCKETS_MS) if total_ms <= bound), len(BUCKETS_MS))
+    with _lock:
+        action = request.action if request.action in _histograms or len(_histograms) < MAX_ACTIONS else 'other'
+        histogram = _histograms.get(action)
+        if histogram is None:
+            histogram = _histograms[action] = {
+                'count': 0, 'errors': 0, 'sum_ms': 0.0, 'db_ms': 0.0, 'queries': 0,
+                'buckets': [0] * (len(BUCKETS_MS) + 1)
+            }
+        histogram['count'] += 1
+        histogram['errors'] += 1 if status >= 500 else 0
+        histogram['sum_ms'] += total_ms
+        histogram['db_ms'] += request.db_ms
+        histogram['queries'] += request.queries
+        histogram['buckets'][bucket] += 1
+
+def snapshot() -> Dict[str, Any]:
+    from db import pool_stats
+
+    with _lock:
+        histograms = {action: {**h, 'buckets': list(h['buckets'])} for action, h in _histograms.items()}
+    return {'buckets_ms': list(BUCKETS_MS), 'actions': histograms, 'pool': pool_stats()}
+
+def _maybe_log_snapshot() -> None:
+    global _last_log
+    now = time.monotonic()
+    with _lock:
+        if now - _last_log < METRICS_LOG_INTERVAL:
+            return
+        _last_log = now
+    log_event({'event': 'metrics', **snapshot()})
+
+def _metrics_request(event: Dict[str, Any]) -> bool:
+    if not METRICS_TOKEN or event.get('httpMethod') != 'GET':
+        return False
+    if not (event.get('queryStringParameters') or {}).get('metrics'):
+        return False
+    headers = event.get('headers') or {}
+    return (headers.get('X-Metrics-Token') or headers.get('x-metrics-token')) == METRICS_TOKEN
+
+def instrumented(handler):
+    '''
+    Wraps a function handler: times the request, adds Server-Timing and feeds
+    the per-action histogram. Handlers name the action with set_action().
+    '''
+    @wraps(handler)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        if _metrics_request(event):
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json'},
+                'body': json.dumps(snapshot(), default=str)
+            }
+
+        request = RequestStats(event.get('httpMethod', 'GET'))
+        _local.request = request
+        status = 500
+        try:
+            response = handler(event, context)
+            status = response.get('statusCode', 200)
+        finally:
+            _local.request = None
+            total_ms = (time.perf_counter() - request.started) * 1000
+            _observe(request, total_ms, status)
+
+        headers = response.setdefault('headers', {})
+        headers['Server-Timing'] = server_timing(request, total_ms)
+        headers['Timing-Allow-Origin'] = '*'
+        _maybe_log_snapshot()
+        return response
+    return wrapper
@@ -0,0 +1,146 @@
+'''
+Business: Token-bucket send limits - per-user budget, a separate per-user batch budget and per-channel slowmode (channels.rate_limit)
+Args: USER_SEND_BURST, USER_SEND_RATE, BATCH_SEND_BURST, BATCH_SEND_RATE, SLOWMODE_CACHE_TTL env variables
+Returns: None when the send may proceed, otherwise (scope, Retry-After seconds)
+'''
+
+import math
+import os
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+USER_SEND_BURST = float(os.environ.get('USER_SEND_BURST', 10))
+USER_SEND_RATE = float(os.environ.get('USER_SEND_RATE', 2))
+# send_batch is for bots relaying many messages; it draws on its own, larger budget
+BATCH_SEND_BURST = float(os.environ.get('BATCH_SEND_BURST', 500))
+BATCH_SEND_RATE = float(os.environ.get('BATCH_SEND_RATE', 100))
+SLOWMODE_CACHE_TTL = float(os.environ.get('SLOWMODE_CACHE_TTL', 60))
+PRUNE_INTERVAL = 600
+LOCAL_MAX_BUCKETS = 50000
+
+# Conditional upsert: refill by elapsed time and take `cost` tokens only when the
+# bucket holds all of them, so a bucket never goes into debt
+CONSUME_QUERY = """INSERT INTO rate_limit_buckets AS b (bucket_key, tokens, refilled_at)
+                   VALUES (%(key)s, %(capacity)s - %(cost)s, now())
+                   ON CONFLICT (bucket_key) DO UPDATE
+                   SET tokens = LEAST(%(capacity)s, b.tokens + EXTRACT(EPOCH FROM now() - b.refilled_at) * %(rate)s) - %(cost)s,
+                       refilled_at = now()
+                   WHERE LEAST(%(capacity)s, b.tokens + EXTRACT(EPOCH FROM now() - b.refilled_at) * %(rate)s) >= %(cost)s
+                   RETURNING tokens"""
+
+STATE_QUERY = """SELECT tokens, EXTRACT(EPOCH FROM now() - refilled_at) AS elapsed
+                 FROM rate_limit_buckets WHERE bucket_key = %s"""
+
+# Buckets idle long enough to be full again carry no information
+PRUNE_QUERY = """DELETE FROM rate_limit_buckets WHERE refilled_at < now() - INTERVAL '1 hour'"""
+
+_lock = threading.Lock()
+_local: Dict[str, List[float]] = {}
+_slowmode: Dict[int, Tuple[int, float]] = {}
+_last_prune = time.monotonic()
+
+class Bucket:
+    __slots__ = ('key', 'scope', 'capacity', 'rate', 'cost')
+
+    def __init__(self, key: str, scope: str, capacity: float, rate: float, cost: float):
+        self.key = key
+        self.scope = scope
+        self.capacity = capacity
+        self.rate = rate
+        self.cost = cost
+
+    def retry_after(self, available: float) -> int:
+        return max(1, math.ceil((self.cost - available) / self.rate))
+
+def _slowmode_seconds(cursor, channel_ids) -> Dict[int, int]:
+    now = time.monotonic()
+    with _lock:
+        cached = {cid: _slowmode[cid][0] for cid in channel_ids
+                  if cid in _slowmode and now - _slowmode[cid][1] < SLOWMODE_CACHE_TTL}
+    missing = [cid for cid in channel_ids if cid not in cached]
+    if missing:
+        cursor.execute("SELECT id, COALESCE(rate_limit, 0) AS rate_limit FROM channels WHERE id = ANY(%s)", (missing,))
+        fetched = {row['id']: row['rate_limit'] for row in cursor.fetchall()}
+        with _lock:
+            for cid in missing:
+                _slowmode[cid] = (fetched.get(cid, 0), now)
+                cached[cid] = fetched.get(cid, 0)
+    return cached
+
+def _buckets(cursor, user_id: int, channel_ids: List[int], batch: bool) -> List[Bucket]:
+    per_channel = Counter(channel_ids)
+    buckets = []
+    for channel_id, seconds in sorted(_slowmode_seconds(cursor, list(per_channel)).items()):
+        if seconds > 0:
+            buckets.append(Bucket(f"slowmode:{channel_id}:{user_id}", 'slowmode', 1.0, 1.0 / seconds, per_channel[channel_id]))
+    if batch:
+        buckets.append(Bucket(f"batch:{user_id}", 'batch', BATCH_SEND_BURST, BATCH_SEND_RATE, len(channel_ids)))
+    else:
+        buckets.append(Bucket(f"user:{user_id}", 'user', USER_SEND_BURST, USER_SEND_RATE, len(channel_ids)))
+    return buckets
+
+def _local_available(bucket: Bucket, now: float) -> float:
+    tokens, updated = _local.get(bucket.key, (bucket.capacity, now))
+    return min(bucket.capacity, tokens + (now - updated) * bucket.rate)
+
+def _set_local(bucket: Bucket, tokens: float, now: float) -> None:
+    if len(_local) >= LOCAL_MAX_BUCKETS:
+        _local.clear()
+    _local[bucket.key] = [tokens, now]
+
+def check_send(conn, cursor, user_id: int, channel_ids: List[int], batch: bool = False) -> Optional[Tuple[str, int]]:
+    '''
+    Charges one token per message against the user's budget (the batch budget
+    for send_batch) and the slowmode bucket of every channel written to. A send
+    is admitted only when every bucket holds its whole cost. Floods are rejected
+    by the in-process buckets without touching Postgres; admitted sends charge
+    the shared rate_limit_buckets rows inside the caller's transaction, so every
+    warm instance enforces the same limit. A refusal rolls the transaction back.
+    Raises ValueError when a bucket could never pay for the send, even full.
+    '''
+    buckets = _buckets(cursor, user_id, channel_ids, batch)
+    for bucket in buckets:
+        if bucket.cost > bucket.capacity:
+            raise ValueError(f'At most {int(bucket.capacity)} messages fit the {bucket.scope} limit')
+    now = time.monotonic()
+    with _lock:
+        for bucket in buckets:
+            available = _local_available(bucket, now)
+            if available < bucket.cost:
+                return bucket.scope, bucket.retry_after(available)
+
+    charged = []
+    for bucket in buckets:
+        params = {'key': bucket.key, 'capacity': bucket.capacity, 'rate': bucket.rate, 'cost': bucket.cost}
+        cursor.execute(CONSUME_QUERY, params)
+        row = cursor.fetchone()
+        if row:
+            charged.append((bucket, row['tokens']))
+            continue
+
+        # Other instances spent the tokens: resync the local bucket from the shared row
+        conn.rollback()
+        cursor.execute(STATE_QUERY, (bucket.key,))
+        state = cursor.fetchone()
+        conn.commit()
+        available = min(bucket.capacity, state['tokens'] + float(state['elapsed']) * bucket.rate) if state else bucket.capacity
+        with _lock:
+            _set_local(bucket, available, now)
+        return bucket.scope, bucket.retry_after(available)
+
+    with _lock:
+        for bucket, tokens in charged:
+            _set_local(bucket, tokens, now)
+    _prune(cursor)
+    return None
+
+def _prune(cursor) -> None:
+    global _last_prune
+    now = time.monotonic()
+    with _lock:
+        if now - _last_prune < PRUNE_INTERVAL:
+            return
+        _last_prune = now
+    cursor.execute(PRUNE_QUERY)
@@ -0,0 +1,92 @@
+'''
+Business: Message reactions stored one row per (message, emoji, user) with sharded counters
+Args: message id, emoji and the reacting user
+Returns: Updated reaction count; per-message aggregates for the history query
+'''
+
+import random
+from typing import Dict, Any
+
+# Each (message, emoji) counter is split over COUNTER_SHARDS rows and a writer
+# picks one at random, so a hot message spreads its updates over several row locks
+COUNTER_SHARDS = 16
+MAX_EMOJI_LENGTH = 64
+
+# Correlated per row of a history page (aliased m); the first parameter is the viewer
+SUMMARY_SQL = """COALESCE((SELECT json_agg(json_build_object('emoji', r.emoji, 'count', r.count, 'me', r.me) ORDER BY r.first_at)
+                           FROM (SELECT rc.emoji, SUM(rc.count) AS count, MIN(rc.created_at) AS first_at,
+                                        EXISTS (SELECT 1 FROM message_reactions mr
+                                                WHERE mr.message_id = m.id AND mr.emoji = rc.emoji AND mr.user_id = %s) AS me
+                                 FROM reaction_counts rc
+                                 WHERE rc.message_id = m.id
+                                 GROUP BY rc.emoji
+                                 HAVING SUM(rc.count) > 0) r), '[]')"""
+
+# Same visibility rule as search and read acks: a member of the channel's server or a DM participant.
+# A message the user cannot see is reported as not found
+VISIBLE_QUERY = """SELECT EXISTS (
+                       SELECT 1 FROM messages m
+                       JOIN channels c ON c.id = m.channel_id
+                       WHERE m.id = %(message_id)s
+                       AND (EXISTS (SELECT 1 FROM server_members sm
+                                    WHERE sm.server_id = c.server_id AND sm.user_id = %(user_id)s)
+                            OR EXISTS (SELECT 1 FROM dm_participants p
+                                       WHERE p.channel_id = c.id AND %(user_id)s IN (p.user_low, p.user_high)))
+                   ) AS found"""
+
+ADD_QUERY = f"""WITH visible AS ({VISIBLE_QUERY}), changed AS (
+                   INSERT INTO message_reactions (message_id, emoji, user_id)
+                   SELECT %(message_id)s, %(emoji)s, %(user_id)s
+                   WHERE (SELECT found FROM visible)
+                   ON CONFLICT DO NOTHING
+                   RETURNING message_id
+               ), counted AS (
+                   INSERT INTO reaction_counts (message_id, emoji, shard, count)
+                   SELECT message_id, %(emoji)s, %(shard)s, 1 FROM changed
+                   ON CONFLICT (message_id, emoji, shard) DO UPDATE SET count = reaction_counts.count + 1
+                   RETURNING 1
+               )
+               SELECT (SELECT found FROM visible) AS found,
+                      COALESCE((SELECT SUM(count) FROM reaction_counts
+                                WHERE message_id = %(message_id)s AND emoji = %(emoji)s), 0)
+                          + (SELECT COUNT(*) FROM counted) AS count"""
+
+REMOVE_QUERY = f"""WITH visible AS ({VISIBLE_QUERY}), changed AS (
+                      DELETE FROM message_reactions
+                      WHERE message_id = %(message_id)s AND emoji = %(emoji)s AND user_id = %(user_id)s
+                      AND (SELECT found FROM visible)
+                      RETURNING message_id
+                  ), counted AS (
+                      INSERT INTO reaction_counts (message_id, emoji, shard, count)
+                      SELECT message_id, %(emoji)s, %(shard)s, -1 FROM changed
+                      ON CONFLICT (message_id, emoji, shard) DO UPDATE SET count = reaction_counts.count - 1
+                      RETURNING 1
+                  )
+                  SELECT (SELECT found FROM visible) AS found,
+                         COALESCE((SELECT SUM(count) FROM reaction_counts
+                                   WHERE message_id = %(message_id)s AND emoji = %(emoji)s), 0)
+                             - (SELECT COUNT(*) FROM counted) AS count"""
+
+def validate_emoji(emoji) -> str:
+    if not isinstance(emoji, str) or not emoji.strip() or len(emoji) > MAX_EMOJI_LENGTH:
+        raise ValueError(f'emoji must be 1-{MAX_EMOJI_LENGTH} characters')
+    return emoji.strip()
+
+def _apply(cursor, query: str, message_id: int, emoji: str, user_id: int) -> Dict[str, Any]:
+    cursor.execute(query, {
+        'message_id': int(message_id),
+        'emoji': validate_emoji(emoji),
+        'user_id': user_id,
+        'shard': random.randrange(COUNTER_SHARDS)
+    })
+    return dict(cursor.fetchone())
+
+def add_reaction(cursor, message_id: int, emoji: str, user_id: int) -> Dict[str, Any]:
+    '''
+    Returns {'found', 'count'}; found is False for messages the user cannot see.
+    Reacting twice with the same emoji is a no-op.
+    '''
+    return _apply(cursor, ADD_QUERY, message_id, emoji, user_id)
+
+def remove_reaction(cursor, message_id: int, emoji: str, user_id: int) -> Dict[str, Any]:
+    return _apply(cursor, REMOVE_QUERY, message_id, emoji, user_id)
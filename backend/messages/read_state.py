@@ -0,0 +1,123 @@
+'''
+Business: Per-channel read state with coalesced acks and bulk unread/mention counts
+Args: ACK_FLUSH_INTERVAL env variable (seconds between batched read state writes)
+Returns: Unread and mention counts for every channel of the user's servers
+
+Acks wait in instance memory for up to ACK_FLUSH_INTERVAL. They are written
+early by the user's next request that holds a primary connection. An
+instance recycled before that drops them, and the read marker stays at the
+last flushed position: a few seconds of read messages show as unread again.
+'''
+
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Tuple
+
+ACK_FLUSH_INTERVAL = float(os.environ.get('ACK_FLUSH_INTERVAL', 5))
+UNREAD_CAP = 100
+
+# Conditional upsert: a late or duplicate ack can never move the read marker backwards.
+# Acks for channels that do not exist or that the user cannot see are dropped here,
+# so one bad ack cannot fail the batch holding everyone else's
+FLUSH_QUERY = """INSERT INTO read_states (user_id, channel_id, last_read_at, last_read_message_id, updated_at)
+                 SELECT a.user_id, a.channel_id, a.last_read_at, a.message_id, CURRENT_TIMESTAMP
+                 FROM unnest(%s::int[], %s::int[], %s::timestamp[], %s::int[])
+                      AS a(user_id, channel_id, last_read_at, message_id)
+                 JOIN channels c ON c.id = a.channel_id
+                 WHERE EXISTS (SELECT 1 FROM server_members sm
+                               WHERE sm.server_id = c.server_id AND sm.user_id = a.user_id)
+                 OR EXISTS (SELECT 1 FROM dm_participants p
+                            WHERE p.channel_id = c.id AND a.user_id IN (p.user_low, p.user_high))
+                 ON CONFLICT (user_id, channel_id) DO UPDATE
+                 SET last_read_at = EXCLUDED.last_read_at,
+                     last_read_message_id = EXCLUDED.last_read_message_id,
+                     updated_at = CURRENT_TIMESTAMP
+                 WHERE (read_states.last_read_at, read_states.last_read_message_id)
+                     < (EXCLUDED.last_read_at, EXCLUDED.last_read_message_id)"""
+
+# Unread messages are counted up to UNREAD_CAP per channel through the
+# (channel_id, created_at, id) index, so the cost is bounded per channel
+UNREAD_QUERY = f"""SELECT c.id AS channel_id, c.server_id, rs.last_read_message_id,
+                          counts.unread_count, counts.mention_count
+                   FROM server_members sm
+                   JOIN channels c ON c.server_id = sm.server_id AND c.type = 'text'
+                   LEFT JOIN read_states rs ON rs.user_id = sm.user_id AND rs.channel_id = c.id
+                   CROSS JOIN LATERAL (
+                       SELECT COUNT(*) AS unread_count,
+                              COUNT(*) FILTER (WHERE unread.content LIKE %(mention)s) AS mention_count
+                       FROM (
+                           SELECT m.content FROM messages m
+                           WHERE m.channel_id = c.id
+                           AND m.user_id <> sm.user_id
+                           AND m.created_at >= COALESCE(rs.last_read_at, sm.joined_at)
+                           AND (m.created_at, m.id) > (COALESCE(rs.last_read_at, sm.joined_at), COALESCE(rs.last_read_message_id, 0))
+                           LIMIT {UNREAD_CAP}
+                       ) unread
+                   ) counts
+                   WHERE sm.user_id = %(user_id)s {{server_filter}}"""
+
+_lock = threading.Lock()
+# user_id -> channel_id -> newest acked (created_at, id)
+_pending: Dict[int, Dict[int, Tuple[datetime, int]]] = {}
+_last_flush = time.monotonic()
+
+def _merge(user_id: int, channel_id: int, position: Tuple[datetime, int]) -> None:
+    channels = _pending.setdefault(user_id, {})
+    if channel_id not in channels or channels[channel_id] < position:
+        channels[channel_id] = position
+
+def ack(user_id: int, channel_id: int, position: Tuple[datetime, int]) -> None:
+    with _lock:
+        _merge(user_id, channel_id, position)
+
+def has_pending(user_id: int) -> bool:
+    with _lock:
+        return user_id in _pending
+
+def flush(cursor, force: bool = False, user_id: int = None) -> int:
+    '''
+    Write pending acks in one multi-row upsert at most once per ACK_FLUSH_INTERVAL,
+    so rapid scrolling collapses into a single write per channel. With user_id
+    only that user's acks are written, so their unread counts are exact.
+    '''
+    global _last_flush
+    now = time.monotonic()
+    with _lock:
+        if user_id is not None:
+            users = [int(user_id)] if int(user_id) in _pending else []
+        elif force or now - _last_flush >= ACK_FLUSH_INTERVAL:
+            users = list(_pending)
+            _last_flush = now
+        else:
+            users = []
+        batch = [(uid, channel_id, position) for uid in users for channel_id, position in _pending.pop(uid).items()]
+
+    if not batch:
+        return 0
+
+    try:
+        cursor.execute(
+            FLUSH_QUERY,
+            (
+                [uid for uid, _, _ in batch],
+                [channel_id for _, channel_id, _ in batch],
+                [position[0] for _, _, position in batch],
+                [position[1] for _, _, position in batch]
+            )
+        )
+    except Exception:
+        # Keep the acks for the next flush; newer acks that arrived meanwhile win
+        with _lock:
+            for uid, channel_id, position in batch:
+                _merge(uid, channel_id, position)
+        raise
+    return len(batch)
+
+def unread_counts(cursor, user_id: int, server_id=None) -> List[Dict[str, Any]]:
+    cursor.execute(
+        UNREAD_QUERY.format(server_filter='AND sm.server_id = %(server_id)s' if server_id else ''),
+        {'user_id': user_id, 'server_id': server_id, 'mention': f"%<@{int(user_id)}>%"}
+    )
+    return [dict(row) for row in cursor.fetchall()]
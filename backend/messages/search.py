@@ -0,0 +1,139 @@
+'''
+Business: Full-text message search over the GIN-indexed messages.content_tsv column
+Args: search text plus optional channel, server, author and date range filters
+Returns: Ranked or newest-first hits with highlighted snippets and a keyset cursor
+'''
+
+import base64
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+TS_CONFIG = 'simple'
+SEARCH_PAGE_SIZE = 25
+SORTS = ('relevance', 'recent')
+# Relevance ranks only this many of the newest matches, so common terms cost the same as rare ones
+RANK_CANDIDATES = 1000
+
+# Channels the user can read: server channels they are a member of and their DMs
+VISIBLE_CHANNELS = """SELECT c.id FROM channels c
+                      JOIN server_members sm ON sm.server_id = c.server_id AND sm.user_id = %(user_id)s
+                      WHERE NOT COALESCE(c.is_dm, FALSE)
+                      UNION ALL
+                      SELECT p.channel_id FROM dm_participants p
+                      WHERE p.user_low = %(user_id)s OR p.user_high = %(user_id)s"""
+
+SORT_COLUMNS = {
+    'relevance': 'h.rank',
+    'recent': 'h.created_at',
+}
+
+# Candidates are the newest matches, bounded before anything is ranked: recent takes one page,
+# relevance takes RANK_CANDIDATES and sorts those by ts_rank_cd. ts_headline only runs for the page
+SEARCH_QUERY = """WITH candidates AS (
+                    SELECT m.id, m.message_id, m.channel_id, m.user_id, m.content, m.created_at, m.content_tsv
+                    FROM messages m, websearch_to_tsquery('{config}', %(q)s) query
+                    WHERE m.content_tsv @@ query
+                    AND m.channel_id IN ({visible}) {filters}
+                    ORDER BY m.created_at DESC, m.id DESC
+                    LIMIT %(candidates)s
+                 ),
+                 hits AS (
+                    SELECT c.id, c.message_id, c.channel_id, c.user_id, c.content, c.created_at,
+                           ts_rank_cd(c.content_tsv, query)::float8 AS rank
+                    FROM candidates c, websearch_to_tsquery('{config}', %(q)s) query
+                 )
+                 SELECT h.id, h.message_id, h.channel_id, h.created_at, h.rank,
+                        ts_headline('{config}', h.content, websearch_to_tsquery('{config}', %(q)s),
+                                    'StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=30') AS snippet,
+                        u.username, u.discriminator, u.incordes_id, u.avatar_url
+                 FROM (SELECT * FROM hits h {rank_filter} 
+                       ORDER BY {sort_column} DESC, h.id DESC 
+                       LIMIT %(limit)s) h
+                 JOIN users u ON u.id = h.user_id
+                 ORDER BY {sort_column} DESC, h.id DESC"""
+
+def encode_search_cursor(hit: Dict[str, Any], sort: str) -> str:
+    key = hit['created_at'].isoformat() if sort == 'recent' else repr(hit['rank'])
+    return base64.urlsafe_b64encode(f"{sort}|{key}|{hit['id']}".encode('utf-8')).decode('ascii')
+
+def decode_search_cursor(cursor_value: str, sort: str) -> Optional[Tuple[Any, int]]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor_value.encode('ascii')).decode('utf-8')
+        cursor_sort, key, message_pk = raw.split('|', 2)
+        if cursor_sort != sort:
+            return None
+        key = datetime.fromisoformat(key) if sort == 'recent' else float(key)
+        return key, int(message_pk)
+    except (ValueError, UnicodeError):
+        return None
+
+def build_filters(body: Dict[str, Any], after: Optional[Tuple[Any, int]], sort: str) -> Tuple[List[str], Dict[str, Any]]:
+    filters = []
+    params = {}
+
+    if body.get('channel_id'):
+        filters.append('AND m.channel_id = %(channel_id)s')
+        params['channel_id'] = int(body['channel_id'])
+    if body.get('server_id'):
+        filters.append('AND m.channel_id IN (SELECT id FROM channels WHERE server_id = %(server_id)s)')
+        params['server_id'] = int(body['server_id'])
+    if body.get('author_id'):
+        filters.append('AND m.user_id = %(author_id)s')
+        params['author_id'] = int(body['author_id'])
+    if body.get('from'):
+        filters.append('AND m.created_at >= %(from)s')
+        params['from'] = datetime.fromisoformat(body['from'])
+    if body.get('to'):
+        filters.append('AND m.created_at < %(to)s')
+        params['to'] = datetime.fromisoformat(body['to'])
+    # A relevance cursor pages through the ranked candidates instead; see search_messages
+    if after and sort == 'recent':
+        filters.append('AND (m.created_at, m.id) < (%(after_key)s, %(after_id)s)')
+        params['after_key'], params['after_id'] = after
+
+    return filters, params
+
+def search_messages(cursor, user_id: int, body: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Relevance results cover the newest RANK_CANDIDATES matches; recent pages through all of them.
+    Raises ValueError for malformed filters or cursors so the handler can answer 400.
+    '''
+    sort = body.get('sort', 'relevance')
+    if sort not in SORTS:
+        raise ValueError('Invalid sort')
+
+    after = None
+    if body.get('cursor'):
+        after = decode_search_cursor(body['cursor'], sort)
+        if not after:
+            raise ValueError('Invalid cursor')
+
+    limit = max(1, min(int(body.get('limit', SEARCH_PAGE_SIZE)), SEARCH_PAGE_SIZE))
+    sort_column = SORT_COLUMNS[sort]
+    filters, params = build_filters(body, after, sort)
+    rank_filter = ''
+    if after and sort == 'relevance':
+        rank_filter = 'WHERE (h.rank, h.id) < (%(after_key)s, %(after_id)s)'
+        params['after_key'], params['after_id'] = after
+
+    cursor.execute(
+        SEARCH_QUERY.format(
+            config=TS_CONFIG,
+            visible=VISIBLE_CHANNELS,
+            filters=' '.join(filters),
+            rank_filter=rank_filter,
+            sort_column=sort_column
+        ),
+        {'q': body['query'], 'user_id': user_id, 'limit': limit + 1,
+         'candidates': RANK_CANDIDATES if sort == 'relevance' else limit + 1, **params}
+    )
+    rows = [dict(row) for row in cursor.fetchall()]
+
+    next_cursor = encode_search_cursor(rows[limit - 1], sort) if len(rows) > limit else None
+    results = rows[:limit]
+    for hit in results:
+        hit['author'] = {
+            key: hit.pop(key) for key in ('username', 'discriminator', 'incordes_id', 'avatar_url')
+        }
+
+    return {'results': results, 'next_cursor': next_cursor}
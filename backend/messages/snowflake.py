@@ -0,0 +1,194 @@
+'''
+Business: Time-ordered snowflake identifiers for messages, channels, servers and DMs
+Args: SNOWFLAKE_LEASE_TTL env variable; SNOWFLAKE_WORKER_ID pins the worker for single-process tools only
+Returns: 64-bit ids (41 bits ms timestamp, 10 bits worker, 12 bits sequence), worker ids leased from Postgres;
+         WorkerIdsExhausted when every worker id is held by a live instance
+'''
+
+import atexit
+import os
+import signal
+import sys
+import threading
+import time
+from typing import Optional
+
+import psycopg2
+from psycopg2.pool import PoolError
+
+from db import get_connection, release_connection
+
+EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+ID_WIDTH = 19  # digits in the largest 63-bit id, keeps string ids sortable
+
+PINNED_WORKER_ID = int(os.environ['SNOWFLAKE_WORKER_ID']) & MAX_WORKER_ID if os.environ.get('SNOWFLAKE_WORKER_ID') else None
+# Short leases so ids of instances that die without releasing come back quickly during a scale-out
+LEASE_TTL = float(os.environ.get('SNOWFLAKE_LEASE_TTL', 300))
+LEASE_RENEW_AFTER = LEASE_TTL / 4
+# Stop using a lease this long before it runs out, to absorb clock skew between hosts
+LEASE_MARGIN = 60
+LEASE_RETRY_DELAY = 5
+LEASE_HOLDER = f"{os.getpid()}-{os.urandom(8).hex()}"
+
+# Renews our own worker id while it is still ours, otherwise takes the longest-expired free one
+LEASE_QUERY = """WITH candidate AS (
+                     SELECT worker_id FROM snowflake_workers
+                     WHERE holder = %(holder)s OR leased_until < now()
+                     ORDER BY holder = %(holder)s DESC, leased_until
+                     LIMIT 1
+                     FOR UPDATE SKIP LOCKED
+                 )
+                 UPDATE snowflake_workers w
+                 SET holder = %(holder)s, leased_until = now() + %(ttl)s * interval '1 second'
+                 FROM candidate c
+                 WHERE w.worker_id = c.worker_id
+                 RETURNING w.worker_id"""
+
+RELEASE_QUERY = """UPDATE snowflake_workers SET holder = NULL, leased_until = '-infinity'
+                   WHERE worker_id = %(worker_id)s AND holder = %(holder)s"""
+
+class WorkerIdsExhausted(Exception):
+    pass
+
+_lease_lock = threading.Lock()
+_worker_id: Optional[int] = None
+_renew_at = 0.0
+_valid_until = 0.0
+
+_lock = threading.Lock()
+_last_ms = -1
+_sequence = 0
+_backfill_sequence = 0
+
+def _now_ms() -> int:
+    return int(time.time() * 1000) - EPOCH_MS
+
+def _lease_worker() -> int:
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(LEASE_QUERY, {'holder': LEASE_HOLDER, 'ttl': LEASE_TTL})
+            row = cursor.fetchone()
+        conn.commit()
+    finally:
+        release_connection(conn)
+    if row is None:
+        raise WorkerIdsExhausted('All snowflake worker ids are leased')
+    return row[0]
+
+def release_worker() -> None:
+    '''
+    Hands the leased worker id back on shutdown so the next cold start can take
+    it at once. Best effort: a lease that cannot be released expires after LEASE_TTL.
+    '''
+    global _worker_id, _renew_at, _valid_until
+    with _lease_lock:
+        worker, _worker_id = _worker_id, None
+        _renew_at = _valid_until = 0.0
+    if worker is None:
+        return
+    try:
+        conn = get_connection()
+    except (psycopg2.Error, PoolError):
+        return
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(RELEASE_QUERY, {'worker_id': worker, 'holder': LEASE_HOLDER})
+        conn.commit()
+    except psycopg2.Error:
+        pass
+    finally:
+        release_connection(conn)
+
+def _exit_on_term(signum, frame):
+    # SystemExit runs the atexit hooks, the default SIGTERM action skips them
+    sys.exit(128 + signum)
+
+def _release_on_shutdown() -> None:
+    atexit.register(release_worker)
+    try:
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, _exit_on_term)
+    except ValueError:
+        pass  # imported outside the main thread; atexit still covers a normal exit
+
+def worker_id() -> int:
+    '''
+    Worker id unique among live instances: leased from snowflake_workers at
+    cold start, renewed every LEASE_TTL / 4 and released on shutdown. If a
+    renewal fails the current lease is used until it is about to expire, then
+    id generation fails rather than risk a worker id another instance has taken
+    over. Raises WorkerIdsExhausted when no worker id is free.
+    '''
+    global _worker_id, _renew_at, _valid_until
+    if PINNED_WORKER_ID is not None:
+        return PINNED_WORKER_ID
+
+    now = time.time()
+    if now < _renew_at:
+        return _worker_id
+    with _lease_lock:
+        now = time.time()
+        if now >= _renew_at:
+            try:
+                _worker_id = _lease_worker()
+                _renew_at = now + LEASE_RENEW_AFTER
+                _valid_until = now + LEASE_TTL - LEASE_MARGIN
+            except (psycopg2.Error, WorkerIdsExhausted):
+                if now >= _valid_until:
+                    raise
+                _renew_at = now + LEASE_RETRY_DELAY
+        return _worker_id
+
+if PINNED_WORKER_ID is None:
+    _release_on_shutdown()
+
+def next_id() -> int:
+    global _last_ms, _sequence
+    worker = worker_id()
+    with _lock:
+        now = _now_ms()
+        if now < _last_ms:
+            # Clock moved backwards: stay on the last timestamp instead of reusing ids
+            now = _last_ms
+
+        if now == _last_ms:
+            _sequence = (_sequence + 1) & MAX_SEQUENCE
+            if _sequence == 0:
+                # Sequence exhausted for this millisecond, spin until the next one
+                while now <= _last_ms:
+                    now = _now_ms()
+        else:
+            _sequence = 0
+
+        _last_ms = now
+        return (now << (WORKER_BITS + SEQUENCE_BITS)) | (worker << SEQUENCE_BITS) | _sequence
+
+def next_key(prefix: str) -> str:
+    '''
+    Prefixed, zero-padded id for the VARCHAR *_id columns. Fixed width keeps
+    lexical order equal to creation order, so new keys append to the B-tree.
+    '''
+    return f"{prefix}{next_id():0{ID_WIDTH}d}"
+
+def key_at(prefix: str, timestamp: float) -> str:
+    '''
+    Key for a row that was created in the past (history imports): the id carries
+    that row's own time, so key order matches created_at order. Times before
+    EPOCH_MS clamp to the epoch. The sequence keeps counting across calls
+    instead of restarting each millisecond, since backfilled times repeat.
+    '''
+    global _backfill_sequence
+    worker = worker_id()
+    with _lock:
+        _backfill_sequence = (_backfill_sequence + 1) & MAX_SEQUENCE
+        sequence = _backfill_sequence
+    ms = max(0, int(timestamp * 1000) - EPOCH_MS)
+    return f"{prefix}{(ms << (WORKER_BITS + SEQUENCE_BITS)) | (worker << SEQUENCE_BITS) | sequence:0{ID_WIDTH}d}"
+
+def id_timestamp(snowflake: int) -> float:
+    return ((snowflake >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH_MS) / 1000
@@ -0,0 +1,162 @@
+'''
+Business: Shared JWT issuing and cached verification with token-version revocation and key rotation
+Args: JWT_KEYS env variable "kid:secret,kid:secret" (first key signs), JWT_ACCEPT_LEGACY, TOKEN_CACHE_*, USER_CACHE_* env variables
+Returns: Verified token payloads and user ids, served from an LRU+TTL cache keyed by token hash
+'''
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional
+
+import jwt
+from psycopg2.extras import RealDictCursor
+
+from db import get_connection, release_connection
+
+LEGACY_SECRET = 'incordes_secret_key_2024_change_in_production'
+TOKEN_LIFETIME = timedelta(days=30)
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+TOKEN_CACHE_TTL = float(os.environ.get('TOKEN_CACHE_TTL', 300))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 30))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+USER_FIELDS = 'id, incordes_id, username, email, avatar_url, banner_url, bio, status, theme, token_version'
+
+def _load_keys() -> Dict[str, str]:
+    keys = {}
+    for entry in (os.environ.get('JWT_KEYS') or '').split(','):
+        if ':' in entry:
+            kid, secret = entry.split(':', 1)
+            keys[kid.strip()] = secret.strip()
+    # The in-source secret is public: it only ever applies when JWT_KEYS is not configured
+    return keys or {'k0': LEGACY_SECRET}
+
+KEYS = _load_keys()
+SIGNING_KID = next(iter(KEYS))
+# Kid-less tokens predate key rotation and are verified with the 'k0' key. Without JWT_KEYS that is
+# still the secret they were signed with; once keys are configured they need JWT_ACCEPT_LEGACY
+ACCEPT_LEGACY = (
+    KEYS.get('k0') == LEGACY_SECRET
+    or os.environ.get('JWT_ACCEPT_LEGACY', '').lower() in ('1', 'true', 'yes')
+)
+
+_lock = threading.Lock()
+_tokens: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+_users: 'OrderedDict[int, Dict[str, Any]]' = OrderedDict()
+
+def issue_token(user: Dict[str, Any]) -> str:
+    return jwt.encode({
+        'user_id': user['id'],
+        'incordes_id': user['incordes_id'],
+        'ver': user.get('token_version', 0),
+        'exp': datetime.utcnow() + TOKEN_LIFETIME
+    }, KEYS[SIGNING_KID], algorithm='HS256', headers={'kid': SIGNING_KID})
+
+def _decode(token: str) -> Dict[str, Any]:
+    kid = jwt.get_unverified_header(token).get('kid')
+    if not kid:
+        if not ACCEPT_LEGACY:
+            raise jwt.InvalidTokenError('Token has no key id')
+        kid = 'k0'
+    secret = KEYS.get(kid)
+    if not secret:
+        raise jwt.InvalidTokenError('Unknown signing key')
+    return jwt.decode(token, secret, algorithms=['HS256'])
+
+def _fetch_user(user_id: int, cursor=None) -> Optional[Dict[str, Any]]:
+    if cursor is not None:
+        cursor.execute(f"SELECT {USER_FIELDS} FROM users WHERE id = %s", (user_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+    conn = get_connection()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as own_cursor:
+            own_cursor.execute(f"SELECT {USER_FIELDS} FROM users WHERE id = %s", (user_id,))
+            row = own_cursor.fetchone()
+        conn.commit()
+    finally:
+        release_connection(conn)
+    return dict(row) if row else None
+
+def cached_user(user_id: int, cursor=None) -> Optional[Dict[str, Any]]:
+    '''
+    User row (including token_version) refreshed at most every USER_CACHE_TTL
+    seconds per user, so revocation costs one read per user per interval.
+    Callers already holding a connection pass their RealDictCursor; otherwise
+    a pooled connection is borrowed for the read.
+    '''
+    now = time.monotonic()
+    with _lock:
+        entry = _users.get(user_id)
+        if entry:
+            _users.move_to_end(user_id)
+    if entry and now - entry['fetched_at'] < USER_CACHE_TTL:
+        return entry['user']
+
+    user = _fetch_user(user_id, cursor)
+    with _lock:
+        _users[user_id] = {'user': user, 'fetched_at': now}
+        _users.move_to_end(user_id)
+        while len(_users) > USER_CACHE_SIZE:
+            _users.popitem(last=False)
+    return user
+
+def verify_token(token: str, cursor=None) -> Dict[str, Any]:
+    '''
+    Returns the token payload or raises jwt.InvalidTokenError (ExpiredSignatureError
+    for expired tokens). Valid tokens are cached for TOKEN_CACHE_TTL seconds.
+    cursor, when given, is used for the token_version check on a user-cache miss.
+    '''
+    key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    now = time.monotonic()
+    with _lock:
+        entry = _tokens.get(key)
+        if entry:
+            _tokens.move_to_end(key)
+
+    if entry and now - entry['verified_at'] < TOKEN_CACHE_TTL:
+        payload = entry['payload']
+        if payload['exp'] <= time.time():
+            raise jwt.ExpiredSignatureError('Signature has expired')
+    else:
+        payload = _decode(token)
+        with _lock:
+            _tokens[key] = {'payload': payload, 'verified_at': now}
+            _tokens.move_to_end(key)
+            while len(_tokens) > TOKEN_CACHE_SIZE:
+                _tokens.popitem(last=False)
+
+    user = cached_user(payload['user_id'], cursor)
+    if not user or payload.get('ver', 0) != user['token_version']:
+        with _lock:
+            _tokens.pop(key, None)
+        raise jwt.InvalidTokenError('Token revoked')
+    return payload
+
+def user_id_from_header(auth_header: str) -> Optional[int]:
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None
+    try:
+        return verify_token(auth_header.split(' ', 1)[1])['user_id']
+    except jwt.InvalidTokenError:
+        return None
+
+def revoke_user_tokens(cursor, user_id: int) -> int:
+    '''
+    Invalidates every token issued to the user. Other warm instances notice
+    within USER_CACHE_TTL seconds.
+    '''
+    cursor.execute(
+        "UPDATE users SET token_version = token_version + 1 WHERE id = %s RETURNING token_version",
+        (user_id,)
+    )
+    version = cursor.fetchone()['token_version']
+    with _lock:
+        _users.pop(user_id, None)
+        for key in [key for key, entry in _tokens.items() if entry['payload']['user_id'] == user_id]:
+            del _tokens[key]
+    return version
@@ -0,0 +1,248 @@
+'''
+Business: Shared Postgres connection pools that survive warm function invocations, with replica read routing
+Args: DATABASE_URL, DATABASE_REPLICA_URLS, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_HEALTHCHECK_INTERVAL,
+      DB_REPLICA_MAX_LAG, DB_REPLICA_CHECK_INTERVAL env variables
+Returns: Healthy pooled psycopg2 connections (primary, or a caught-up replica for reads), LSN read tokens, pool statistics
+'''
+
+import os
+import threading
+import time
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from typing import Dict, Any, List, Optional
+
+from metrics import InstrumentedConnection, phase
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+POOL_MAX = int(os.environ.get('DB_POOL_MAX', 5))
+HEALTHCHECK_INTERVAL = float(os.environ.get('DB_POOL_HEALTHCHECK_INTERVAL', 30))
+REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 5))
+REPLICA_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 5))
+
+# Replay position and lag in one round trip; an idle primary sends no WAL, so a
+# standby that has replayed everything it received counts as zero lag
+REPLICA_STATUS_QUERY = """SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn()
+                                   ELSE pg_current_wal_lsn() END - '0/0'::pg_lsn AS lsn,
+                              CASE WHEN NOT pg_is_in_recovery()
+                                        OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                   ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END AS lag"""
+
+_pool = None
+_pool_lock = threading.Lock()
+_last_used: Dict[int, float] = {}
+# Checked-out replica connections and the pool they must go back to
+_owners: Dict[int, ThreadedConnectionPool] = {}
+_next_replica = 0
+_stats = {
+    'connections_opened': 0,
+    'connections_reused': 0,
+    'connections_discarded': 0,
+    'healthchecks': 0,
+    'healthcheck_failures': 0,
+    'replica_reads': 0,
+    'primary_fallbacks': 0,
+}
+
+class Replica:
+    def __init__(self, index: int, url: str):
+        self.name = f'replica{index}'
+        self.url = url
+        self.pool: Optional[ThreadedConnectionPool] = None
+        self.lock = threading.Lock()
+        self.checked_at = float('-inf')
+        self.healthy = True
+        self.lsn = 0
+        self.lag: Optional[float] = None
+
+    def get_pool(self) -> ThreadedConnectionPool:
+        if self.pool is None or self.pool.closed:
+            with self.lock:
+                if self.pool is None or self.pool.closed:
+                    self.pool = ThreadedConnectionPool(POOL_MIN, POOL_MAX, self.url,
+                                                       connection_factory=InstrumentedConnection)
+        return self.pool
+
+    def mark(self, healthy: bool, lsn: int = 0, lag: Optional[float] = None) -> None:
+        self.healthy = healthy
+        self.lsn = max(self.lsn, lsn)
+        self.lag = lag
+        self.checked_at = time.monotonic()
+
+REPLICAS: List[Replica] = [Replica(index, url) for index, url in enumerate(REPLICA_URLS)]
+
+def get_pool() -> ThreadedConnectionPool:
+    '''
+    Module-level pool kept alive between warm invocations. DB_POOL_MIN connections
+    are opened eagerly and kept idle; bursts may open up to DB_POOL_MAX, extra
+    connections are closed when they are released.
+    '''
+    global _pool
+    if _pool is None or _pool.closed:
+        with _pool_lock:
+            if _pool is None or _pool.closed:
+                _pool = ThreadedConnectionPool(POOL_MIN, POOL_MAX, DATABASE_URL,
+                                               connection_factory=InstrumentedConnection)
+                _last_used.clear()
+    return _pool
+
+def _is_healthy(conn) -> bool:
+    if conn.closed:
+        return False
+
+    last_used = _last_used.get(id(conn))
+    if last_used is None:
+        _stats['connections_opened'] += 1
+        return True
+
+    _stats['connections_reused'] += 1
+    if time.monotonic() - last_used < HEALTHCHECK_INTERVAL:
+        return True
+
+    _stats['healthchecks'] += 1
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        _stats['healthcheck_failures'] += 1
+        return False
+
+def _discard(pool: ThreadedConnectionPool, conn) -> None:
+    _last_used.pop(id(conn), None)
+    _owners.pop(id(conn), None)
+    _stats['connections_discarded'] += 1
+    try:
+        pool.putconn(conn, close=True)
+    except PoolError:
+        pass
+
+def get_connection():
+    with phase('connect'):
+        pool = get_pool()
+        for _ in range(POOL_MAX + 1):
+            conn = pool.getconn()
+            if _is_healthy(conn):
+                return conn
+            _discard(pool, conn)
+    raise psycopg2.OperationalError('No healthy database connection available')
+
+def parse_lsn(token: str) -> int:
+    '''
+    'X/Y' WAL position (as sent back in X-Read-Token) to a comparable integer; 0 when absent or malformed.
+    '''
+    try:
+        high, low = token.split('/')
+        return (int(high, 16) << 32) + int(low, 16)
+    except (AttributeError, ValueError):
+        return 0
+
+def read_token(conn) -> Optional[str]:
+    '''
+    Primary WAL position after a committed write. The client sends it back with
+    its next reads, which then only go to replicas that have replayed it.
+    '''
+    if not REPLICAS:
+        return None
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_current_wal_lsn()::text")
+        token = cursor.fetchone()[0]
+    conn.commit()
+    return token
+
+def _check_replica(replica: Replica, conn) -> None:
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(REPLICA_STATUS_QUERY)
+            lsn, lag = cursor.fetchone()
+        conn.rollback()
+    except psycopg2.Error:
+        replica.mark(False)
+        return
+    lag = None if lag is None else float(lag)
+    replica.mark(lag is not None and lag <= REPLICA_MAX_LAG, int(lsn or 0), lag)
+
+def _replica_connection(replica: Replica, min_lsn: int):
+    try:
+        pool = replica.get_pool()
+        conn = pool.getconn()
+    except (psycopg2.Error, PoolError):
+        replica.mark(False)
+        return None
+    _owners[id(conn)] = pool
+    if not _is_healthy(conn):
+        replica.mark(False)
+        _discard(pool, conn)
+        return None
+
+    # Status is re-read when it is due, or when the cached position is behind the
+    # client's token - the replica may well have caught up since the last check
+    if time.monotonic() - replica.checked_at >= REPLICA_CHECK_INTERVAL or replica.lsn < min_lsn:
+        _check_replica(replica, conn)
+    if replica.healthy and replica.lsn >= min_lsn:
+        return conn
+    release_connection(conn)
+    return None
+
+def get_read_connection(min_lsn: int = 0):
+    '''
+    Connection for read-only work: the next replica (round robin) within
+    DB_REPLICA_MAX_LAG that has replayed min_lsn, or the primary when none qualifies.
+    Unhealthy replicas are skipped until DB_REPLICA_CHECK_INTERVAL has passed.
+    '''
+    global _next_replica
+    if REPLICAS:
+        with phase('connect'):
+            _next_replica = start = (_next_replica + 1) % len(REPLICAS)
+            for offset in range(len(REPLICAS)):
+                replica = REPLICAS[(start + offset) % len(REPLICAS)]
+                if not replica.healthy and time.monotonic() - replica.checked_at < REPLICA_CHECK_INTERVAL:
+                    continue
+                conn = _replica_connection(replica, min_lsn)
+                if conn is not None:
+                    _stats['replica_reads'] += 1
+                    return conn
+        _stats['primary_fallbacks'] += 1
+    return get_connection()
+
+def release_connection(conn) -> None:
+    pool = _owners.pop(id(conn), None) or get_pool()
+    broken = conn.closed or conn.info.transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN
+
+    if not broken and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+
+    if broken:
+        _discard(pool, conn)
+        return
+
+    if len(pool._pool) >= POOL_MIN:
+        _last_used.pop(id(conn), None)
+    else:
+        _last_used[id(conn)] = time.monotonic()
+    pool.putconn(conn)
+
+def pool_stats() -> Dict[str, Any]:
+    pool = get_pool()
+    return {
+        'min': POOL_MIN,
+        'max': POOL_MAX,
+        'idle': len(pool._pool),
+        'in_use': len(pool._used),
+        **_stats,
+        'replicas': [{
+            'name': replica.name,
+            'healthy': replica.healthy,
+            'lag': replica.lag,
+            'lsn': replica.lsn,
+            'idle': len(replica.pool._pool) if replica.pool else 0,
+            'in_use': len(replica.pool._used) if replica.pool else 0,
+        } for replica in REPLICAS],
+    }
@@ -4,61 +4,159 @@ Args: event with httpMethod, body, headers (Authorization)
 Returns: Server data, channels, members, invite codes
 '''
 
+import base64
 import json
-import os
-import psycopg2
 from psycopg2.extras import RealDictCursor
-import jwt
 import secrets
 import string
 from typing import Dict, Any
 
-DATABASE_URL = os.environ.get('DATABASE_URL')
-JWT_SECRET = 'incordes_secret_key_2024_change_in_production'
+from db import get_connection, get_read_connection, release_connection, read_token, parse_lsn
+from responses import json_response, preflight_response, get_header, read_token_headers, READ_TOKEN_HEADER
+from snowflake import next_key, WorkerIdsExhausted, LEASE_RETRY_DELAY
+from tokens import user_id_from_header
+import presence
+import invites
+import metrics
 
-def verify_token(auth_header: str):
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return None
-    token = auth_header.split(' ')[1]
+MEMBER_PAGE_SIZE = 100
+
+# Server row and channels in a single round trip; members are paged separately via ?members=
+SNAPSHOT_QUERY = """SELECT s.*, 
+                      COALESCE((SELECT json_agg(c ORDER BY c.position) 
+                                FROM channels c WHERE c.server_id = s.id), '[]') AS channels 
+                   FROM servers s 
+                   WHERE s.id = %s"""
+
+# Bumped when the snapshot body changes shape, so cached bodies from before never revalidate
+SNAPSHOT_FORMAT = 2
+
+def snapshot_etag(server_id, version) -> str:
+    return f'"{server_id}-{version}-{SNAPSHOT_FORMAT}"'
+
+MEMBER_COLUMNS = """u.id, u.username, u.discriminator, u.incordes_id, u.avatar_url, 
+                    {status} AS status, sm.presence_rank, sm.sort_name"""
+
+KEYSET = "(sm.presence_rank, sm.sort_name, sm.user_id) > (%(rank)s, %(name)s, %(id)s)"
+
+# Online members first, then alphabetical. The keyset (presence_rank, sort_name, user_id) is kept on
+# server_members by triggers (V0016), so each page is a range scan of idx_server_members_list
+MEMBERS_QUERY = f"""SELECT {MEMBER_COLUMNS} 
+                    FROM server_members sm 
+                    JOIN users u ON u.id = sm.user_id 
+                    WHERE sm.server_id = %(server_id)s AND {KEYSET} 
+                    ORDER BY sm.presence_rank, sm.sort_name, sm.user_id 
+                    LIMIT %(limit)s"""
+
+NAME_SEARCH_RANK = f"""(SELECT sm.user_id, sm.presence_rank, sm.sort_name FROM server_members sm 
+                         WHERE sm.server_id = %(server_id)s AND sm.presence_rank = {{rank}} 
+                         AND sm.sort_name LIKE %(prefix)s AND {KEYSET} 
+                         ORDER BY sm.sort_name, sm.user_id 
+                         LIMIT %(limit)s)"""
+
+# One branch per presence rank, so the prefix is a range of idx_server_members_list (sort_name is
+# COLLATE "C", V0019). Append reads the offline branch only when the online one is short
+MEMBER_NAME_SEARCH = f"""SELECT {MEMBER_COLUMNS} 
+                         FROM ({NAME_SEARCH_RANK.format(rank=0)} 
+                               UNION ALL 
+                               {NAME_SEARCH_RANK.format(rank=1)} 
+                               LIMIT %(limit)s) sm 
+                         JOIN users u ON u.id = sm.user_id 
+                         ORDER BY sm.presence_rank, sm.sort_name, sm.user_id"""
+
+# A '#' only occurs in IncordesIDs (username#discriminator): idx_users_incordes_id_prefix finds the
+# accounts and membership is a primary-key probe each
+MEMBER_TAG_SEARCH = f"""SELECT {MEMBER_COLUMNS} 
+                        FROM users u 
+                        JOIN server_members sm ON sm.server_id = %(server_id)s AND sm.user_id = u.id 
+                        WHERE lower(u.incordes_id) LIKE %(prefix)s AND {KEYSET} 
+                        ORDER BY sm.presence_rank, sm.sort_name, sm.user_id 
+                        LIMIT %(limit)s"""
+
+def members_query(prefix: str) -> str:
+    if not prefix:
+        query = MEMBERS_QUERY
+    elif '#' in prefix:
+        query = MEMBER_TAG_SEARCH
+    else:
+        query = MEMBER_NAME_SEARCH
+    return query.format(status=presence.status_sql('u'))
+
+def encode_member_cursor(member) -> str:
+    raw = f"{member['presence_rank']}|{member['id']}|{member['sort_name']}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_member_cursor(cursor_value: str):
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
-        return payload.get('user_id')
-    except:
+        raw = base64.urlsafe_b64decode(cursor_value.encode('ascii')).decode('utf-8')
+        rank, member_id, sort_name = raw.split('|', 2)
+        return int(rank), int(member_id), sort_name
+    except (ValueError, UnicodeError):
         return None
 
+def like_prefix(value: str) -> str:
+    escaped = value.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"{escaped}%"
+
+def fetch_members(cursor, server_id, limit: int, after=None, prefix: str = ''):
+    rank, member_id, sort_name = after or (-1, 0, '')
+    cursor.execute(
+        members_query(prefix),
+        {
+            'server_id': server_id,
+            'prefix': like_prefix(prefix),
+            'rank': rank,
+            'name': sort_name,
+            'id': member_id,
+            'limit': limit + 1
+        }
+    )
+    rows = [dict(row) for row in cursor.fetchall()]
+    next_cursor = encode_member_cursor(rows[limit - 1]) if len(rows) > limit else None
+    
+    members = rows[:limit]
+    for member in members:
+        del member['presence_rank']
+        del member['sort_name']
+    return members, next_cursor
+
 def generate_invite_code():
     return ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(8))
 
+@metrics.instrumented
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, Authorization',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return preflight_response('GET, POST, OPTIONS', f'Content-Type, Authorization, If-None-Match, {READ_TOKEN_HEADER}')
+    
+    # Invite previews are public: link unfurls and logged-out visitors hit them
+    invite_code = (event.get('queryStringParameters') or {}).get('invite')
+    if method == 'GET' and invite_code:
+        metrics.set_action('invite_preview')
+        invite = invites.preview(invite_code)
+        if not invite:
+            return json_response(event, 404, {'error': 'Invalid invite'})
+        return json_response(event, 200, invite, headers={
+            'Cache-Control': f"public, max-age={int(invites.INVITE_PREVIEW_TTL)}"
+        })
     
-    user_id = verify_token(event.get('headers', {}).get('Authorization', ''))
+    user_id = user_id_from_header(event.get('headers', {}).get('Authorization', ''))
     if not user_id:
-        return {
-            'statusCode': 401,
-            'headers': {'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Unauthorized'})
-        }
+        return json_response(event, 401, {'error': 'Unauthorized'})
     
-    conn = psycopg2.connect(DATABASE_URL)
+    # Every GET below is read-only; X-Read-Token keeps it on the primary until a replica has the client's last write
+    if method == 'GET':
+        conn = get_read_connection(parse_lsn(get_header(event, READ_TOKEN_HEADER)))
+    else:
+        conn = get_connection()
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
         if method == 'POST':
             body = json.loads(event.get('body', '{}'))
             action = body.get('action')
+            metrics.set_action(action)
             
             if action == 'create':
                 name = body.get('name', 'New Server')
@@ -66,19 +164,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 cursor.execute(
                     "INSERT INTO servers (server_id, name, icon_url, owner_id) VALUES (%s, %s, %s, %s) RETURNING id, server_id, name, icon_url, owner_id",
-                    (f"S{int(os.urandom(4).hex(), 16)}", name, icon_url, user_id)
+                    (next_key("S"), name, icon_url, user_id)
                 )
                 server = dict(cursor.fetchone())
                 server_id = server['id']
                 
                 cursor.execute(
                     "INSERT INTO channels (channel_id, server_id, name, type, position) VALUES (%s, %s, %s, %s, %s)",
-                    (f"C{int(os.urandom(4).hex(), 16)}", server_id, 'general', 'text', 0)
+                    (next_key("C"), server_id, 'general', 'text', 0)
                 )
                 
                 cursor.execute(
                     "INSERT INTO channels (channel_id, server_id, name, type, position) VALUES (%s, %s, %s, %s, %s)",
-                    (f"C{int(os.urandom(4).hex(), 16)}", server_id, 'General', 'voice', 1)
+                    (next_key("C"), server_id, 'General', 'voice', 1)
                 )
                 
                 cursor.execute(
@@ -88,11 +186,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 conn.commit()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(server)
-                }
+                return json_response(event, 200, server, headers=read_token_headers(read_token(conn)))
             
             elif action == 'create_channel':
                 server_id = body.get('server_id')
@@ -107,70 +201,25 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 cursor.execute(
                     "INSERT INTO channels (channel_id, server_id, name, type, position) VALUES (%s, %s, %s, %s, %s) RETURNING id, channel_id, name, type",
-                    (f"C{int(os.urandom(4).hex(), 16)}", server_id, name, channel_type, position)
+                    (next_key("C"), server_id, name, channel_type, position)
                 )
                 channel = dict(cursor.fetchone())
                 conn.commit()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(channel)
-                }
+                return json_response(event, 200, channel, headers=read_token_headers(read_token(conn)))
             
             elif action == 'join':
                 invite_code = body.get('invite_code')
                 
-                cursor.execute(
-                    "SELECT * FROM server_invites WHERE code = %s AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP) AND (max_uses = 0 OR uses < max_uses)",
-                    (invite_code,)
-                )
-                invite = cursor.fetchone()
-                
-                if not invite:
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Invalid invite'})
-                    }
-                
-                invite_dict = dict(invite)
-                server_id = invite_dict['server_id']
-                
-                cursor.execute(
-                    "SELECT id FROM server_members WHERE server_id = %s AND user_id = %s",
-                    (server_id, user_id)
-                )
-                if cursor.fetchone():
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Already a member'})
-                    }
-                
-                cursor.execute(
-                    "INSERT INTO server_members (server_id, user_id) VALUES (%s, %s)",
-                    (server_id, user_id)
-                )
-                
-                cursor.execute(
-                    "UPDATE server_invites SET uses = uses + 1 WHERE id = %s",
-                    (invite_dict['id'],)
-                )
-                
-                cursor.execute(
-                    "SELECT * FROM servers WHERE id = %s",
-                    (server_id,)
-                )
-                server = dict(cursor.fetchone())
-                
+                result = invites.redeem(cursor, invite_code, user_id)
                 conn.commit()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(server)
-                }
+                if result['already_member']:
+                    return json_response(event, 400, {'error': 'Already a member'})
+                if not result['server']:
+                    return json_response(event, 404, {'error': 'Invalid invite'})
+                
+                return json_response(event, 200, result['server'], headers=read_token_headers(read_token(conn)))
             
             elif action == 'create_invite':
                 server_id = body.get('server_id')
@@ -191,16 +240,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 invite = dict(cursor.fetchone())
                 conn.commit()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(invite)
-                }
+                return json_response(event, 200, invite)
         
         elif method == 'GET':
             params = event.get('queryStringParameters', {}) or {}
             
             if params.get('user_servers'):
+                metrics.set_action('user_servers')
                 cursor.execute(
                     """SELECT s.* FROM servers s 
                        JOIN server_members sm ON s.id = sm.server_id 
@@ -210,47 +256,70 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 )
                 servers = [dict(row) for row in cursor.fetchall()]
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'servers': servers})
-                }
+                return json_response(event, 200, {'servers': servers})
+            
+            if params.get('presence'):
+                metrics.set_action('presence')
+                user_ids = [value for value in (params.get('user_ids') or '').split(',') if value.strip().isdigit()]
+                
+                if len(user_ids) > MEMBER_PAGE_SIZE:
+                    return json_response(event, 400, {'error': f'At most {MEMBER_PAGE_SIZE} user_ids per request'})
+                
+                statuses = presence.bulk_presence(cursor, user_ids)
+                
+                return json_response(event, 200, {'presence': {str(uid): status for uid, status in statuses.items()}})
             
             server_id = params.get('server_id')
-            if server_id:
-                cursor.execute("SELECT * FROM servers WHERE id = %s", (server_id,))
-                server = dict(cursor.fetchone() or {})
+            if server_id and params.get('members'):
+                metrics.set_action('members')
+                limit = max(1, min(int(params.get('limit', MEMBER_PAGE_SIZE)), MEMBER_PAGE_SIZE))
+                after = None
+                if params.get('cursor'):
+                    after = decode_member_cursor(params['cursor'])
+                    if not after:
+                        return json_response(event, 400, {'error': 'Invalid cursor'})
                 
-                cursor.execute(
-                    "SELECT * FROM channels WHERE server_id = %s ORDER BY position",
-                    (server_id,)
+                members, next_cursor = fetch_members(
+                    cursor, server_id, limit, after, (params.get('q') or '').strip()
                 )
-                channels = [dict(row) for row in cursor.fetchall()]
                 
-                cursor.execute(
-                    """SELECT u.id, u.username, u.discriminator, u.incordes_id, u.avatar_url, u.status 
-                       FROM users u 
-                       JOIN server_members sm ON u.id = sm.user_id 
-                       WHERE sm.server_id = %s""",
-                    (server_id,)
-                )
-                members = [dict(row) for row in cursor.fetchall()]
+                return json_response(event, 200, {'members': members, 'next_cursor': next_cursor})
+            
+            if server_id:
+                metrics.set_action('snapshot')
+                etag_header = get_header(event, 'If-None-Match')
+                if etag_header:
+                    cursor.execute("SELECT snapshot_version FROM servers WHERE id = %s", (server_id,))
+                    version_row = cursor.fetchone()
+                    if version_row and etag_header == snapshot_etag(server_id, version_row['snapshot_version']):
+                        return json_response(event, 304, headers={
+                            'Access-Control-Expose-Headers': 'ETag',
+                            'ETag': etag_header,
+                            'Cache-Control': 'no-cache'
+                        })
+                
+                cursor.execute(SNAPSHOT_QUERY, (server_id,))
+                server = cursor.fetchone()
                 
-                server['channels'] = channels
-                server['members'] = members
+                if not server:
+                    return json_response(event, 404, {'error': 'Server not found'})
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(server)
-                }
+                server = dict(server)
+                
+                return json_response(event, 200, server, headers={
+                    'Access-Control-Expose-Headers': 'ETag',
+                    'ETag': snapshot_etag(server['id'], server['snapshot_version']),
+                    'Cache-Control': 'no-cache'
+                })
         
-        return {
-            'statusCode': 405,
-            'headers': {'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
+        return json_response(event, 405, {'error': 'Method not allowed'})
+    
+    except WorkerIdsExhausted:
+        conn.rollback()
+        return json_response(event, 503, {'error': 'Server busy, try again'}, headers={
+            'Retry-After': str(int(LEASE_RETRY_DELAY))
+        })
     
     finally:
         cursor.close()
-        conn.close()
+        release_connection(conn)
@@ -0,0 +1,102 @@
+'''
+Business: Invite redemption in one statement and cached invite previews
+Args: INVITE_PREVIEW_TTL env variable (seconds a preview is served from memory)
+Returns: Joined server row or the reason redemption failed; server name, icon and member count for a code
+'''
+
+import os
+import threading
+import time
+from typing import Dict, Any, Optional
+
+from psycopg2.extras import RealDictCursor
+
+from db import get_connection, release_connection
+
+INVITE_PREVIEW_TTL = float(os.environ.get('INVITE_PREVIEW_TTL', 30))
+PREVIEW_CACHE_SIZE = 5000
+
+VALID_INVITE = """(i.expires_at IS NULL OR i.expires_at > CURRENT_TIMESTAMP)"""
+
+# The invite row is locked first, so uses < max_uses is rechecked against the latest
+# version and concurrent redemptions can never overshoot it. Membership is inserted
+# before the use is claimed: the use is only counted when this call added the member.
+# DO UPDATE (not DO NOTHING) returns the row a concurrent redemption by the same
+# user committed, so that case reports already_member instead of an invalid invite
+REDEEM_QUERY = f"""WITH invite AS (
+                       SELECT i.id, i.server_id, (i.max_uses = 0 OR i.uses < i.max_uses) AS has_uses
+                       FROM server_invites i
+                       WHERE i.code = %(code)s AND {VALID_INVITE}
+                       FOR UPDATE
+                   ), joined AS (
+                       INSERT INTO server_members (server_id, user_id)
+                       SELECT server_id, %(user_id)s FROM invite WHERE has_uses
+                       ON CONFLICT (server_id, user_id) DO UPDATE SET user_id = EXCLUDED.user_id
+                       RETURNING server_id, (xmax = 0) AS inserted
+                   ), claimed AS (
+                       UPDATE server_invites i SET uses = i.uses + 1
+                       FROM invite, joined
+                       WHERE i.id = invite.id AND joined.inserted
+                       RETURNING i.id
+                   )
+                   SELECT COALESCE(NOT joined.inserted, EXISTS (
+                              SELECT 1 FROM server_members sm
+                              JOIN invite ON invite.server_id = sm.server_id
+                              WHERE sm.user_id = %(user_id)s
+                          )) AS already_member,
+                          CASE WHEN joined.inserted THEN to_json(s) END AS server
+                   FROM (SELECT 1) one
+                   LEFT JOIN joined ON true
+                   LEFT JOIN servers s ON s.id = joined.server_id"""
+
+PREVIEW_QUERY = f"""SELECT i.code, s.id AS server_id, s.name, s.icon_url,
+                           (SELECT COUNT(*) FROM server_members sm WHERE sm.server_id = s.id) AS member_count
+                    FROM server_invites i
+                    JOIN servers s ON s.id = i.server_id
+                    WHERE i.code = %s AND {VALID_INVITE}
+                    AND (i.max_uses = 0 OR i.uses < i.max_uses)"""
+
+_lock = threading.Lock()
+_previews: Dict[str, Dict[str, Any]] = {}
+
+def redeem(cursor, code: str, user_id: int) -> Dict[str, Any]:
+    '''
+    Returns {'already_member', 'server'}; server is set only
+    when this call added the user to the server.
+    '''
+    cursor.execute(REDEEM_QUERY, {'code': code, 'user_id': user_id})
+    result = dict(cursor.fetchone())
+    if result['server']:
+        with _lock:
+            _previews.pop(code, None)
+    return result
+
+def preview(code: str) -> Optional[Dict[str, Any]]:
+    '''
+    Invite preview, or None for unknown, expired and used-up codes. Cache hits
+    never touch the pool; misses are cached too so a dead link costs nothing either.
+    '''
+    now = time.monotonic()
+    with _lock:
+        entry = _previews.get(code)
+    if entry and now - entry['fetched_at'] < INVITE_PREVIEW_TTL:
+        return entry['preview']
+
+    conn = get_connection()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(PREVIEW_QUERY, (code,))
+            row = cursor.fetchone()
+        conn.commit()
+    finally:
+        release_connection(conn)
+    result = dict(row) if row else None
+
+    with _lock:
+        if len(_previews) >= PREVIEW_CACHE_SIZE:
+            for key in [key for key, cached in _previews.items() if now - cached['fetched_at'] >= INVITE_PREVIEW_TTL]:
+                del _previews[key]
+            if len(_previews) >= PREVIEW_CACHE_SIZE:
+                _previews.clear()
+        _previews[code] = {'preview': result, 'fetched_at': now}
+    return result
@@ -0,0 +1,114 @@
+'''
+Business: In-process presence map with TTL expiry and batched flushes to users.status
+Args: PRESENCE_TTL and PRESENCE_FLUSH_INTERVAL env variables (seconds)
+Returns: Effective user statuses; one UPDATE statement per flush interval
+'''
+
+import os
+import threading
+import time
+from typing import Dict, Any, Iterable
+
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', 90))
+FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', 15))
+STATUSES = ('online', 'idle', 'dnd', 'invisible')
+
+# Status as seen by other users: stale heartbeats count as offline without any write
+STATUS_SQL = f"""CASE WHEN {{alias}}.last_seen_at IS NULL
+                      OR {{alias}}.last_seen_at < CURRENT_TIMESTAMP - INTERVAL '{PRESENCE_TTL} seconds'
+                      OR {{alias}}.status = 'invisible'
+                      THEN 'offline' ELSE {{alias}}.status END"""
+
+FLUSH_QUERY = f"""WITH beat AS (
+                    UPDATE users u SET status = v.status, last_seen_at = CURRENT_TIMESTAMP
+                    FROM unnest(%s::int[], %s::varchar[]) AS v(id, status)
+                    WHERE u.id = v.id
+                    RETURNING u.id
+                 ), expired AS (
+                    UPDATE users SET status = 'offline'
+                    WHERE status <> 'offline'
+                    AND (last_seen_at IS NULL OR last_seen_at < CURRENT_TIMESTAMP - INTERVAL '{PRESENCE_TTL} seconds')
+                    AND id NOT IN (SELECT id FROM beat)
+                    RETURNING id
+                 )
+                 SELECT (SELECT COUNT(*) FROM beat) AS refreshed, (SELECT COUNT(*) FROM expired) AS expired"""
+
+_lock = threading.Lock()
+_presence: Dict[int, Dict[str, Any]] = {}
+_last_flush = time.monotonic()
+
+def status_sql(alias: str = 'u') -> str:
+    return STATUS_SQL.format(alias=alias)
+
+def heartbeat(user_id: int, status: str = 'online') -> None:
+    '''
+    Record a heartbeat in memory. The row is only written when the status
+    changed or the stored last_seen_at is about to go stale.
+    '''
+    now = time.monotonic()
+    with _lock:
+        entry = _presence.get(user_id)
+        if entry is None:
+            _presence[user_id] = {'status': status, 'seen': now, 'flushed_status': None, 'flushed_at': 0.0}
+        else:
+            entry['status'] = status
+            entry['seen'] = now
+
+def _expire(now: float) -> None:
+    for user_id in [uid for uid, entry in _presence.items() if now - entry['seen'] > PRESENCE_TTL]:
+        del _presence[user_id]
+
+def _pending(now: float):
+    for user_id, entry in _presence.items():
+        stale = now - entry['flushed_at'] > PRESENCE_TTL / 2
+        if stale or entry['status'] != entry['flushed_status']:
+            yield user_id, entry, entry['status']
+
+def flush(cursor, force: bool = False) -> Dict[str, int]:
+    '''
+    Write every pending status in one multi-row UPDATE and sweep expired users
+    offline in the same statement. Runs at most once per FLUSH_INTERVAL unless forced.
+    '''
+    global _last_flush
+    now = time.monotonic()
+    with _lock:
+        if not force and now - _last_flush < FLUSH_INTERVAL:
+            return {'refreshed': 0, 'expired': 0}
+        _last_flush = now
+        _expire(now)
+        pending = list(_pending(now))
+
+    cursor.execute(
+        FLUSH_QUERY,
+        ([user_id for user_id, _, _ in pending], [status for _, _, status in pending])
+    )
+    result = dict(cursor.fetchone())
+
+    with _lock:
+        for _, entry, status in pending:
+            entry['flushed_status'] = status
+            entry['flushed_at'] = now
+    return result
+
+def bulk_presence(cursor, user_ids: Iterable[int]) -> Dict[int, str]:
+    '''
+    Effective status for many users in one indexed lookup; heartbeats this
+    instance has not flushed yet take precedence over the stored value.
+    '''
+    ids = list({int(user_id) for user_id in user_ids})
+    if not ids:
+        return {}
+
+    cursor.execute(
+        f"SELECT u.id, {status_sql('u')} AS status FROM users u WHERE u.id = ANY(%s)",
+        (ids,)
+    )
+    statuses = {row['id']: row['status'] for row in cursor.fetchall()}
+
+    now = time.monotonic()
+    with _lock:
+        for user_id in ids:
+            entry = _presence.get(user_id)
+            if entry and now - entry['seen'] <= PRESENCE_TTL:
+                statuses[user_id] = 'offline' if entry['status'] == 'invisible' else entry['status']
+    return statuses
@@ -0,0 +1,88 @@
+'''
+Business: EXPLAIN (ANALYZE, BUFFERS) of hot read queries against the seeded benchmark database
+Args: --show (print full plans); DATABASE_URL (seeded by bench/seed.py)
+Returns: Plan summary per query; fails when a query that should be an index range scan sorts, seq-scans or filters
+         most of what it reads away
+'''
+
+import argparse
+import json
+import os
+import sys
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'servers'))
+
+from index import like_prefix, members_query
+
+# More rows than this discarded by a filter means the index only bounded the server, not the page
+FILTERED_LIMIT = 1000
+
+def walk(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from walk(child)
+
+def member_pages(cursor):
+    # The seed skews memberships toward low server ids: the first server is the largest
+    cursor.execute("SELECT min(id) AS id FROM servers")
+    server_id = cursor.fetchone()['id']
+    cursor.execute(
+        """SELECT presence_rank, sort_name, user_id FROM server_members
+           WHERE server_id = %s ORDER BY presence_rank, sort_name, user_id OFFSET 5000 LIMIT 1""",
+        (server_id,)
+    )
+    middle = cursor.fetchone()
+    base = {'server_id': server_id, 'prefix': '', 'limit': 101}
+    start = {**base, 'rank': -1, 'name': '', 'id': 0}
+    yield 'members first page', members_query(''), start
+    if not middle:
+        return
+    yield 'members deep page', members_query(''), {
+        **base, 'rank': middle['presence_rank'], 'name': middle['sort_name'], 'id': middle['user_id']
+    }
+    # Seeded names share the 'bench' prefix; a full name matches one member, a missing one none
+    cursor.execute("SELECT incordes_id FROM users WHERE id = %s", (middle['user_id'],))
+    tag = cursor.fetchone()['incordes_id'].lower()
+    yield 'members search name', members_query(middle['sort_name']), {**start, 'prefix': like_prefix(middle['sort_name'])}
+    yield 'members search miss', members_query('zz'), {**start, 'prefix': like_prefix('zz')}
+    yield 'members search tag', members_query(tag), {**start, 'prefix': like_prefix(tag)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Check plans of hot read queries on the bench seed')
+    parser.add_argument('--show', action='store_true')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    failed = False
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        for name, query, params in member_pages(cursor):
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query, params)
+            result = cursor.fetchone()['QUERY PLAN'][0]
+            nodes = list(walk(result['Plan']))
+            # Sorting the page itself (a search's union of presence ranks) is fine; sorting its input is not
+            sorts = [
+                node for node in nodes
+                if node['Node Type'] in ('Sort', 'Incremental Sort')
+                and any(child['Actual Rows'] > params['limit'] for child in node.get('Plans', ()))
+            ]
+            seq_scans = [node for node in nodes if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') == 'server_members']
+            filtered = [
+                node for node in nodes
+                if node.get('Rows Removed by Filter', 0) + node.get('Rows Removed by Index Recheck', 0) > FILTERED_LIMIT
+            ]
+            buffers = result['Plan'].get('Shared Hit Blocks', 0) + result['Plan'].get('Shared Read Blocks', 0)
+            verdict = 'ok' if not sorts and not seq_scans and not filtered else 'FULL SCAN'
+            failed = failed or verdict != 'ok'
+            print(f"{name:<22} {result['Execution Time']:>9.2f}ms  buffers {buffers:>7}  {verdict}")
+            if args.show or verdict != 'ok':
+                print(json.dumps(result['Plan'], indent=2))
+    conn.rollback()
+    conn.close()
+    if failed:
+        sys.exit('a query that should be an index range scan is not')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+'''
+Business: In-process latency benchmark for the auth, servers and messages handlers against a seeded database
+Args: --iterations, --warmup, --only, --save, --compare, --threshold; DATABASE_URL (seeded by bench/seed.py)
+Returns: p50/p95/p99 per scenario with queries and rows scanned per request; JSON baselines to diff between commits.
+         coldopen.legacy_chain sums the verify -> user_servers -> snapshot -> history requests one client
+         made before auth.ready, so the two cold opens can be compared
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), '..', 'backend')
+SAMPLE_SIZE = 1000
+STATS_FLUSH_WAIT = 1.2
+
+# Limits that would otherwise throttle a single benchmark client
+BENCH_ENV = {
+    'BCRYPT_ROUNDS': '10',
+    'LOGIN_IP_LIMIT': '1000000000',
+    'USER_SEND_BURST': '1000000000',
+    'USER_SEND_RATE': '1000000000',
+}
+
+SCENARIOS = {
+    'auth': ('register', 'login', 'verify', 'ready'),
+    'servers': ('create', 'join', 'snapshot', 'members'),
+    'messages': ('send', 'history'),
+}
+
+# The cold open before the ready call: the client waited on each of these requests in turn
+LEGACY_COLD_OPEN = (('auth', 'verify'), ('servers', 'user_servers'), ('servers', 'snapshot'), ('messages', 'history'))
+COLD_OPEN_SCENARIO = 'coldopen.legacy_chain'
+
+# Users with their newest server and its first text channel, as the old client picked them
+COLD_OPEN_QUERY = """SELECT u.id, u.email, u.incordes_id, u.token_version, s.server_id, c.id AS channel_id
+                     FROM users u
+                     CROSS JOIN LATERAL (SELECT sm.server_id FROM server_members sm WHERE sm.user_id = u.id
+                                         ORDER BY sm.joined_at DESC LIMIT 1) s
+                     CROSS JOIN LATERAL (SELECT c.id FROM channels c WHERE c.server_id = s.server_id AND c.type = 'text'
+                                         ORDER BY c.position LIMIT 1) c
+                     WHERE u.email LIKE 'bench%%@example.com'
+                     ORDER BY random() LIMIT %s"""
+
+SAMPLE_USERS_QUERY = """SELECT id, email, incordes_id, token_version FROM users
+                        WHERE email LIKE 'bench%%@example.com'
+                        ORDER BY random() LIMIT %s"""
+
+SAMPLE_CHANNELS_QUERY = """SELECT c.id, c.server_id FROM channels c
+                           WHERE c.type = 'text' AND c.server_id IS NOT NULL
+                           ORDER BY random() LIMIT %s"""
+
+def post(token, body):
+    # Every request comes from one address; BENCH_ENV lifts the per-IP login limit instead
+    headers = {}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    return {'httpMethod': 'POST', 'headers': headers, 'body': json.dumps(body)}
+
+def get(token, params):
+    return {'httpMethod': 'GET', 'headers': {'Authorization': f'Bearer {token}'}, 'queryStringParameters': params}
+
+def legacy_events(function: str, step: str, cold_open, count: int):
+    '''
+    Event i of every legacy step belongs to the same user, so step latencies add up per cold open.
+    '''
+    from tokens import issue_token
+
+    tokens = [issue_token({key: row[key] for key in ('id', 'email', 'incordes_id', 'token_version')}) for row in cold_open]
+    rows = [(cold_open[i % len(cold_open)], tokens[i % len(tokens)]) for i in range(count)]
+    if (function, step) == ('auth', 'verify'):
+        return [post(None, {'action': 'verify', 'token': token}) for _, token in rows]
+    if (function, step) == ('servers', 'user_servers'):
+        return [get(token, {'user_servers': '1'}) for _, token in rows]
+    if (function, step) == ('servers', 'snapshot'):
+        return [get(token, {'server_id': str(row['server_id'])}) for row, token in rows]
+    if (function, step) == ('messages', 'history'):
+        return [get(token, {'channel_id': str(row['channel_id']), 'limit': '50'}) for row, token in rows]
+    raise ValueError(f'unknown cold open step {function}.{step}')
+
+def build_events(function: str, scenario: str, cursor, users, channels, count: int, cold_open=None):
+    '''
+    One synthetic event per iteration; users and channels are random samples of the seeded data.
+    '''
+    from tokens import issue_token
+
+    if scenario.startswith('legacy_'):
+        return legacy_events(function, scenario[len('legacy_'):], cold_open, count)
+
+    tokens = [issue_token(dict(user)) for user in users]
+    run = int(time.time())
+    pick = lambda i: (users[i % len(users)], tokens[i % len(tokens)])
+
+    if (function, scenario) == ('auth', 'register'):
+        return [post(None, {'action': 'register', 'email': f'benchreg{run}_{i}@example.com',
+                            'password': 'benchmark', 'username': f'benchreg{i % 100}'}) for i in range(count)]
+    if (function, scenario) == ('auth', 'login'):
+        return [post(None, {'action': 'login', 'email': pick(i)[0]['email'], 'password': 'benchmark'}) for i in range(count)]
+    if (function, scenario) in (('auth', 'verify'), ('auth', 'ready')):
+        return [post(None, {'action': scenario, 'token': pick(i)[1]}) for i in range(count)]
+
+    if (function, scenario) == ('servers', 'create'):
+        return [post(pick(i)[1], {'action': 'create', 'name': f'Bench {run} {i}'}) for i in range(count)]
+    if (function, scenario) == ('servers', 'join'):
+        events = []
+        for i in range(count):
+            code = f'b{run % 100000:05d}{i:06d}'
+            cursor.execute(
+                "INSERT INTO server_invites (code, server_id, channel_id, inviter_id) VALUES (%s, %s, %s, %s)",
+                (code, channels[i % len(channels)]['server_id'], channels[i % len(channels)]['id'], users[0]['id'])
+            )
+            events.append(post(pick(i + 1)[1], {'action': 'join', 'invite_code': code}))
+        return events
+    if (function, scenario) == ('servers', 'snapshot'):
+        return [get(pick(i)[1], {'server_id': str(channels[i % len(channels)]['server_id'])}) for i in range(count)]
+    if (function, scenario) == ('servers', 'members'):
+        # The seed skews memberships toward low server ids: the first server is the largest
+        cursor.execute("SELECT min(id) AS id FROM servers")
+        largest = str(cursor.fetchone()['id'])
+        return [get(pick(i)[1], {'server_id': largest, 'members': '1'}) for i in range(count)]
+
+    if (function, scenario) == ('messages', 'send'):
+        return [post(pick(i)[1], {'action': 'send', 'channel_id': channels[i % len(channels)]['id'],
+                                  'content': f'bench message {i}'}) for i in range(count)]
+    if (function, scenario) == ('messages', 'history'):
+        return [get(pick(i)[1], {'channel_id': str(channels[i % len(channels)]['id']), 'limit': '50'})
+                for i in range(count)]
+    raise ValueError(f'unknown scenario {function}.{scenario}')
+
+def db_counters(cursor, statements: bool):
+    '''
+    Database-wide counters; the benchmark is the only client of the disposable database.
+    '''
+    cursor.execute("SELECT pg_stat_clear_snapshot()")
+    cursor.execute(
+        """SELECT tup_returned, tup_fetched, xact_commit + xact_rollback AS transactions
+           FROM pg_stat_database WHERE datname = current_database()"""
+    )
+    counters = dict(cursor.fetchone())
+    if statements:
+        cursor.execute("SELECT COALESCE(sum(calls), 0) AS calls FROM pg_stat_statements WHERE dbid = "
+                       "(SELECT oid FROM pg_database WHERE datname = current_database())")
+        counters['queries'] = int(cursor.fetchone()['calls'])
+    return counters
+
+def percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def latency_stats(latencies, statuses) -> dict:
+    return {
+        'iterations': len(latencies),
+        'statuses': statuses,
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+    }
+
+def summarize(latencies, statuses, before, after, statements: bool) -> dict:
+    # The two counter snapshots themselves run a few statements; they are not charged to the handler
+    per_request = lambda key, own=0: round((after[key] - before[key] - own) / len(latencies), 2)
+    return {
+        **latency_stats(latencies, statuses),
+        'queries_per_request': per_request('queries', 3) if statements else None,
+        'transactions_per_request': per_request('transactions'),
+        'rows_scanned_per_request': per_request('tup_returned'),
+        'rows_fetched_per_request': per_request('tup_fetched'),
+    }
+
+def combine_cold_open(steps) -> dict:
+    '''
+    One legacy cold open is the sum of its step latencies for the same user; the
+    per-request counters add up the same way.
+    '''
+    latencies = [sum(values) for values in zip(*(step['latencies'] for step in steps))]
+    statuses = {}
+    for step in steps:
+        for status, count in step['statuses'].items():
+            statuses[status] = statuses.get(status, 0) + count
+    total = lambda key: None if any(step[key] is None for step in steps) else round(sum(step[key] for step in steps), 2)
+    return {
+        **latency_stats(latencies, statuses),
+        'queries_per_request': total('queries_per_request'),
+        'transactions_per_request': total('transactions_per_request'),
+        'rows_scanned_per_request': total('rows_scanned_per_request'),
+        'rows_fetched_per_request': total('rows_fetched_per_request'),
+        'requests': len(steps),
+    }
+
+def run_function(function: str, scenarios, iterations: int, warmup: int, results, cold_open=None) -> None:
+    '''
+    Runs in a fresh process: every function directory has its own db, responses
+    and tokens modules, so they cannot share one interpreter.
+    '''
+    os.environ.update(BENCH_ENV)
+    sys.path.insert(0, os.path.join(BACKEND_DIR, function))
+    from index import handler
+
+    stats_conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    stats_conn.autocommit = True
+    cursor = stats_conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements') AS present")
+    statements = cursor.fetchone()['present']
+    cursor.execute(SAMPLE_USERS_QUERY, (SAMPLE_SIZE,))
+    users = cursor.fetchall()
+    cursor.execute(SAMPLE_CHANNELS_QUERY, (SAMPLE_SIZE,))
+    channels = cursor.fetchall()
+
+    for scenario in scenarios:
+        events = build_events(function, scenario, cursor, users, channels, warmup + iterations, cold_open)
+        for event in events[:warmup]:
+            handler(event, None)
+
+        time.sleep(STATS_FLUSH_WAIT)
+        before = db_counters(cursor, statements)
+        latencies = []
+        statuses = {}
+        for event in events[warmup:]:
+            started = time.perf_counter()
+            status = handler(event, None)['statusCode']
+            latencies.append((time.perf_counter() - started) * 1000)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        time.sleep(STATS_FLUSH_WAIT)
+        after = db_counters(cursor, statements)
+
+        stats = summarize(latencies, statuses, before, after, statements)
+        if scenario.startswith('legacy_'):
+            stats['latencies'] = latencies
+        results.put((f'{function}.{scenario}', stats))
+    stats_conn.close()
+    results.put(None)
+
+def cold_open_sample(count: int):
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute(COLD_OPEN_QUERY, (min(count, SAMPLE_SIZE),))
+        rows = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+    return rows
+
+def print_stats(name: str, stats: dict) -> None:
+    print(f"{name:<22} p50 {stats['p50_ms']:>8.2f}ms  p95 {stats['p95_ms']:>8.2f}ms  p99 {stats['p99_ms']:>8.2f}ms  "
+          f"queries {stats['queries_per_request']}  rows scanned {stats['rows_scanned_per_request']}  "
+          f"statuses {stats['statuses']}")
+
+def dataset_size() -> dict:
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """SELECT c.relname, c.reltuples::bigint FROM pg_class c
+               WHERE c.relname IN ('users', 'servers', 'channels', 'server_members')
+               UNION ALL
+               SELECT 'messages', COALESCE(sum(c.reltuples), 0)::bigint FROM pg_inherits i
+               JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'messages'::regclass"""
+        )
+        size = dict(cursor.fetchall())
+    conn.close()
+    return size
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(baseline: dict, current: dict, threshold: float) -> bool:
+    regressed = False
+    print(f"\n{'scenario':<22}{'p95 base':>10}{'p95 now':>10}{'change':>9}{'queries':>14}{'rows scanned':>20}")
+    for name, now in current['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if not base:
+            print(f"{name:<22}{'-':>10}{now['p95_ms']:>10.2f}{'new':>9}")
+            continue
+        change = (now['p95_ms'] - base['p95_ms']) / base['p95_ms'] if base['p95_ms'] else 0.0
+        flag = ' !' if change > threshold else ''
+        regressed = regressed or change > threshold
+        queries = f"{base['queries_per_request']}->{now['queries_per_request']}"
+        rows = f"{base['rows_scanned_per_request']:.0f}->{now['rows_scanned_per_request']:.0f}"
+        print(f"{name:<22}{base['p95_ms']:>10.2f}{now['p95_ms']:>10.2f}{change:>+9.0%}{queries:>14}{rows:>20}{flag}")
+    return not regressed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the function handlers in-process')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--only', nargs='*', help='scenarios to run, e.g. auth.login messages.history')
+    parser.add_argument('--save', help='write results as a JSON baseline to this path')
+    parser.add_argument('--compare', help='baseline JSON to diff against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='p95 regression that fails --compare')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'dataset': dataset_size(),
+        'scenarios': {},
+    }
+
+    cold_open = None
+    legacy_steps = {}
+    if not args.only or COLD_OPEN_SCENARIO in args.only:
+        cold_open = cold_open_sample(args.warmup + args.iterations)
+        if not cold_open:
+            sys.exit('no seeded user belongs to a server with a text channel; run bench/seed.py')
+
+    for function, scenarios in SCENARIOS.items():
+        selected = [s for s in scenarios if not args.only or f'{function}.{s}' in args.only]
+        if cold_open:
+            selected += [f'legacy_{step}' for step_function, step in LEGACY_COLD_OPEN if step_function == function]
+        if not selected:
+            continue
+        results = context.Queue()
+        process = context.Process(target=run_function,
+                                  args=(function, selected, args.iterations, args.warmup, results, cold_open))
+        process.start()
+        while True:
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                if process.is_alive():
+                    continue
+                break
+            if result is None:
+                break
+            name, stats = result
+            if 'latencies' in stats:
+                legacy_steps[name] = stats
+                continue
+            report['scenarios'][name] = stats
+            print_stats(name, stats)
+        process.join()
+        if process.exitcode:
+            sys.exit(f'{function} benchmark failed')
+
+    if cold_open:
+        steps = [legacy_steps[f'{function}.legacy_{step}'] for function, step in LEGACY_COLD_OPEN]
+        report['scenarios'][COLD_OPEN_SCENARIO] = combine_cold_open(steps)
+        print_stats(COLD_OPEN_SCENARIO, report['scenarios'][COLD_OPEN_SCENARIO])
+        if 'auth.ready' in report['scenarios']:
+            legacy, ready = report['scenarios'][COLD_OPEN_SCENARIO], report['scenarios']['auth.ready']
+            print(f"cold open p95 {legacy['p95_ms']:.2f}ms over {len(steps)} requests -> "
+                  f"{ready['p95_ms']:.2f}ms with auth.ready (network round trips not included)")
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w', encoding='utf-8') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+            baseline_file.write('\n')
+        print(f"\nsaved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        if not compare(baseline, report, args.threshold):
+            sys.exit(f'p95 regressed by more than {args.threshold:.0%}')
+
+if __name__ == '__main__':
+    main()
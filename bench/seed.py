@@ -0,0 +1,162 @@
+'''
+Business: Builds a disposable benchmark database - applies db_migrations and seeds realistic volumes
+Args: --migrate, --users, --servers, --memberships-per-user, --messages, --months, --chunk; DATABASE_URL
+Returns: Seeded users (password "benchmark"), servers with channels and skewed memberships, partitioned messages
+'''
+
+import argparse
+import glob
+import os
+import sys
+import time
+from datetime import date
+
+import bcrypt
+import psycopg2
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), '..', 'db_migrations')
+BENCH_PASSWORD = 'benchmark'
+# Handlers run the benchmark with BCRYPT_ROUNDS=10 so logins never rehash
+BENCH_BCRYPT_ROUNDS = 10
+TAGS_PER_USERNAME = 9000
+
+USERS_QUERY = f"""INSERT INTO users (email, password_hash, username, discriminator, tag, incordes_id, status, theme, locale)
+                  SELECT 'bench' || i || '@example.com', %(hash)s,
+                         'bench' || (i / {TAGS_PER_USERNAME}),
+                         lpad((i %% {TAGS_PER_USERNAME} + 1)::text, 4, '0'),
+                         lpad((i %% {TAGS_PER_USERNAME} + 1)::text, 4, '0'),
+                         'bench' || (i / {TAGS_PER_USERNAME}) || '#' || lpad((i %% {TAGS_PER_USERNAME} + 1)::text, 4, '0'),
+                         'offline', 'dark', 'ru'
+                  FROM generate_series(%(start)s, %(end)s) i"""
+
+SERVERS_QUERY = """INSERT INTO servers (server_id, name, owner_id)
+                   SELECT 'S' || lpad(i::text, 19, '0'), 'Bench server ' || i,
+                          (SELECT min(id) FROM users) + (random() * %(users)s)::int %% %(users)s
+                   FROM generate_series(%(start)s, %(end)s) i"""
+
+CHANNELS_QUERY = """INSERT INTO channels (channel_id, server_id, name, type, position)
+                    SELECT 'C' || lpad((s.id * 4 + c.position)::text, 19, '0'), s.id,
+                           CASE c.position WHEN 0 THEN 'general' WHEN 1 THEN 'random' WHEN 2 THEN 'off-topic' ELSE 'General' END,
+                           CASE WHEN c.position < 3 THEN 'text' ELSE 'voice' END, c.position
+                    FROM servers s CROSS JOIN generate_series(0, 3) AS c(position)
+                    WHERE NOT EXISTS (SELECT 1 FROM channels WHERE server_id = s.id)"""
+
+# Cubed random skews memberships toward low server ids: a few huge servers, a long tail of small ones
+MEMBERS_QUERY = """INSERT INTO server_members (server_id, user_id)
+                   SELECT (SELECT min(id) FROM servers) + floor(power(r.x, 3) * %(servers)s)::int, r.user_id
+                   FROM (SELECT u.id AS user_id, random() AS x
+                         FROM users u CROSS JOIN generate_series(1, %(per_user)s)
+                         WHERE u.id BETWEEN %(start)s AND %(end)s) r
+                   ON CONFLICT (server_id, user_id) DO NOTHING"""
+
+TEXT_CHANNELS_QUERY = """CREATE UNLOGGED TABLE IF NOT EXISTS bench_text_channels AS
+                         SELECT row_number() OVER (ORDER BY c.server_id, c.position) AS n, c.id
+                         FROM channels c WHERE c.type = 'text'"""
+
+MESSAGES_QUERY = """INSERT INTO messages (message_id, channel_id, user_id, content, created_at)
+                    SELECT 'MB' || lpad(r.i::text, 18, '0'), tc.id, r.user_id,
+                           (ARRAY['hey', 'anyone around?', 'lol', 'check this out https://example.com/' || r.i,
+                                  'good morning everyone', 'did you see the patch notes', 'gg',
+                                  'I think the build is broken again', 'brb', 'sounds good to me'])[1 + r.i %% 10],
+                           now() - random() * %(span)s::interval
+                    FROM (SELECT i, 1 + floor(power(random(), 2) * %(channels)s)::int AS n,
+                                 %(first_user)s + (random() * %(users)s)::int %% %(users)s AS user_id
+                          FROM generate_series(%(start)s, %(end)s) i) r
+                    JOIN bench_text_channels tc ON tc.n = r.n"""
+
+def migrate(conn) -> None:
+    for path in sorted(glob.glob(os.path.join(MIGRATIONS_DIR, 'V*.sql'))):
+        with open(path, encoding='utf-8') as migration, conn.cursor() as cursor:
+            cursor.execute(migration.read())
+        print(f"applied {os.path.basename(path)}")
+
+def chunked(total: int, size: int):
+    for start in range(1, total + 1, size):
+        yield start, min(total, start + size - 1)
+
+def timed(label: str, fn, *args) -> None:
+    started = time.monotonic()
+    fn(*args)
+    print(f"{label}: {time.monotonic() - started:.1f}s")
+
+def ensure_partitions(cursor, months: int) -> None:
+    current = date.today().replace(day=1)
+    for offset in range(months + 1):
+        index = current.year * 12 + current.month - 1 - offset
+        cursor.execute("SELECT create_messages_partition(%s)", (date(index // 12, index % 12 + 1, 1),))
+
+def seed(conn, args) -> None:
+    password_hash = bcrypt.hashpw(BENCH_PASSWORD.encode('utf-8'), bcrypt.gensalt(rounds=BENCH_BCRYPT_ROUNDS)).decode('utf-8')
+    with conn.cursor() as cursor:
+        def users():
+            for start, end in chunked(args.users, args.chunk):
+                cursor.execute(USERS_QUERY, {'hash': password_hash, 'start': start, 'end': end})
+            cursor.execute("INSERT INTO user_settings (user_id) SELECT id FROM users ON CONFLICT (user_id) DO NOTHING")
+            cursor.execute(
+                """INSERT INTO username_discriminators (username, next_discriminator)
+                   SELECT username, MAX(discriminator::int) + 1 FROM users GROUP BY username
+                   ON CONFLICT (username) DO UPDATE SET next_discriminator = EXCLUDED.next_discriminator"""
+            )
+        timed(f"{args.users} users", users)
+
+        cursor.execute("SELECT min(id), max(id) FROM users")
+        first_user, last_user = cursor.fetchone()
+        user_count = last_user - first_user + 1
+
+        def servers():
+            for start, end in chunked(args.servers, args.chunk):
+                cursor.execute(SERVERS_QUERY, {'users': user_count, 'start': start, 'end': end})
+            cursor.execute(CHANNELS_QUERY)
+            cursor.execute("INSERT INTO server_members (server_id, user_id) SELECT id, owner_id FROM servers ON CONFLICT DO NOTHING")
+        timed(f"{args.servers} servers", servers)
+
+        def members():
+            for start, end in chunked(user_count, args.chunk):
+                cursor.execute(MEMBERS_QUERY, {
+                    'servers': args.servers, 'per_user': args.memberships_per_user,
+                    'start': first_user + start - 1, 'end': first_user + end - 1
+                })
+        timed(f"{args.memberships_per_user} memberships per user", members)
+
+        def messages():
+            ensure_partitions(cursor, args.months)
+            cursor.execute("DROP TABLE IF EXISTS bench_text_channels")
+            cursor.execute(TEXT_CHANNELS_QUERY)
+            cursor.execute("SELECT count(*) FROM bench_text_channels")
+            channel_count = cursor.fetchone()[0]
+            for start, end in chunked(args.messages, args.chunk):
+                cursor.execute(MESSAGES_QUERY, {
+                    'span': f"{args.months * 30} days", 'channels': channel_count,
+                    'first_user': first_user, 'users': user_count, 'start': start, 'end': end
+                })
+                print(f"  messages {end}/{args.messages}")
+            cursor.execute("DROP TABLE bench_text_channels")
+        timed(f"{args.messages} messages", messages)
+
+        timed('analyze', cursor.execute, 'ANALYZE')
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate and seed a disposable benchmark database')
+    parser.add_argument('--migrate', action='store_true', help='apply db_migrations first (empty database)')
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--servers', type=int, default=10_000)
+    parser.add_argument('--memberships-per-user', type=int, default=5)
+    parser.add_argument('--messages', type=int, default=50_000_000)
+    parser.add_argument('--months', type=int, default=6)
+    parser.add_argument('--chunk', type=int, default=500_000)
+    args = parser.parse_args()
+
+    if 'bench' not in os.environ.get('DATABASE_URL', '') and not os.environ.get('BENCH_ALLOW_ANY_DATABASE'):
+        sys.exit('refusing to seed: DATABASE_URL should point at a disposable "bench" database')
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    try:
+        if args.migrate:
+            migrate(conn)
+        seed(conn, args)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+'''
+Business: Synthetic send flood against the messages handler to check that token buckets cap the DB write rate
+Args: --user-id, --channel-id (existing rows), --seconds, --processes, --threads; DATABASE_URL
+Returns: attempted/accepted/429 counts and messages actually inserted, fails if inserts exceed the bucket budget
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'messages'))
+
+import db
+import rate_limits
+import tokens
+
+def flood(token: str, channel_id: int, seconds: float, threads: int, results) -> None:
+    # Imported per process so every worker has its own in-process buckets, like a separate warm instance
+    from index import handler
+
+    counts = {'attempted': 0, 'accepted': 0, 'limited': 0, 'other': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+    event = {
+        'httpMethod': 'POST',
+        'headers': {'Authorization': f'Bearer {token}'},
+        'body': json.dumps({'action': 'send', 'channel_id': channel_id, 'content': 'flood'})
+    }
+
+    def worker():
+        while time.monotonic() < deadline:
+            # An exhausted connection pool raises instead of answering; count it rather than losing the thread
+            try:
+                status = handler(event, None)['statusCode']
+            except Exception:
+                status = None
+            key = 'accepted' if status == 200 else 'limited' if status == 429 else 'other'
+            with lock:
+                counts['attempted'] += 1
+                counts[key] += 1
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    results.put(counts)
+
+def main():
+    parser = argparse.ArgumentParser(description='Flood the send action and verify the write rate stays capped')
+    parser.add_argument('--user-id', type=int, required=True)
+    parser.add_argument('--channel-id', type=int, required=True)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--processes', type=int, default=2)
+    # More threads than pooled connections per process only measure pool exhaustion
+    parser.add_argument('--threads', type=int, default=db.POOL_MAX)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute("SELECT id, incordes_id, token_version FROM users WHERE id = %s", (args.user_id,))
+        user = cursor.fetchone()
+        cursor.execute("SELECT COALESCE(rate_limit, 0) AS rate_limit FROM channels WHERE id = %s", (args.channel_id,))
+        slowmode = cursor.fetchone()['rate_limit']
+        cursor.execute(
+            "DELETE FROM rate_limit_buckets WHERE bucket_key IN (%s, %s)",
+            (f"user:{args.user_id}", f"slowmode:{args.channel_id}:{args.user_id}")
+        )
+        cursor.execute("SELECT now() AS started_at")
+        started_at = cursor.fetchone()['started_at']
+    conn.commit()
+
+    token = tokens.issue_token(dict(user))
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=flood, args=(token, args.channel_id, args.seconds, args.threads, results))
+        for _ in range(args.processes)
+    ]
+    flood_started = time.monotonic()
+    for process in processes:
+        process.start()
+    totals = {'attempted': 0, 'accepted': 0, 'limited': 0, 'other': 0}
+    for _ in processes:
+        for key, value in results.get().items():
+            totals[key] += value
+    for process in processes:
+        process.join()
+    elapsed = time.monotonic() - flood_started
+
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT COUNT(*) FROM messages WHERE user_id = %s AND channel_id = %s AND created_at >= %s",
+            (args.user_id, args.channel_id, started_at)
+        )
+        inserted = cursor.fetchone()[0]
+    conn.close()
+
+    budget = rate_limits.USER_SEND_BURST + rate_limits.USER_SEND_RATE * elapsed
+    if slowmode:
+        budget = min(budget, 1 + elapsed / slowmode)
+    print(f"{args.processes} processes x {args.threads} threads for {elapsed:.1f}s")
+    print(f"attempted {totals['attempted']}, accepted {totals['accepted']}, "
+          f"429 {totals['limited']}, other {totals['other']}")
+    print(f"inserted {inserted} messages ({inserted / elapsed:.1f}/s), budget {budget:.0f}")
+
+    if inserted > budget + 1:
+        raise SystemExit(f'write rate not capped: {inserted} inserts for a budget of {budget:.0f}')
+
+if __name__ == '__main__':
+    main()
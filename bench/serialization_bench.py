@@ -0,0 +1,71 @@
+'''
+Business: Serialization benchmark for 1k-message history pages
+Args: --messages, --rounds
+Returns: Mean encode time for stdlib json, responses.dumps (orjson when installed) and gzip/brotli sizes
+'''
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'messages'))
+
+import responses
+
+def make_page(count: int):
+    started = datetime(2024, 6, 1, 12, 0, 0)
+    return {
+        'messages': [
+            {
+                'id': 5_000_000 - i,
+                'message_id': f"M{123456789012345678 - i:019d}",
+                'channel_id': 42,
+                'user_id': 1000 + i % 37,
+                'content': f"message number {i} with some typical chat text, a link https://example.com/{i} and emoji 🎉",
+                'created_at': started - timedelta(seconds=i * 7),
+                'attachments': [],
+                'embeds': [],
+                'reactions': [{'emoji': '👍', 'count': i % 5}] if i % 3 == 0 else [],
+                'edited_at': None,
+                'referenced_message_id': None,
+                'username': f"user{i % 37}",
+                'discriminator': f"{i % 9999:04d}",
+                'incordes_id': f"user{i % 37}#{i % 9999:04d}",
+                'avatar_url': None,
+            }
+            for i in range(count)
+        ],
+        'next_cursor': 'MjAyNC0wNi0wMVQxMjowMDowMHwxMjM0NQ==',
+    }
+
+def timed(fn, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        result = fn()
+    return (time.perf_counter() - started) / rounds * 1000, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    page = make_page(args.messages)
+    stdlib_ms, stdlib_body = timed(lambda: json.dumps(page, default=str), args.rounds)
+    builder_ms, body = timed(lambda: responses.dumps(page), args.rounds)
+    gzip_ms, gzipped = timed(lambda: gzip.compress(body.encode('utf-8'), compresslevel=6), args.rounds)
+
+    print(f"encoder: {'orjson' if responses.orjson else 'stdlib json'}")
+    print(f"json.dumps(default=str): {stdlib_ms:8.2f} ms  {len(stdlib_body):>9,} bytes")
+    print(f"responses.dumps:         {builder_ms:8.2f} ms  {len(body):>9,} bytes")
+    print(f"gzip level 6:            {gzip_ms:8.2f} ms  {len(gzipped):>9,} bytes")
+    if responses.brotli:
+        brotli_ms, compressed = timed(lambda: responses.brotli.compress(body.encode('utf-8'), quality=4), args.rounds)
+        print(f"brotli quality 4:        {brotli_ms:8.2f} ms  {len(compressed):>9,} bytes")
+
+if __name__ == '__main__':
+    main()
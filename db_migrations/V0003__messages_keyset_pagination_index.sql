@@ -0,0 +1,2 @@
+-- Composite index for keyset pagination of channel history
+CREATE INDEX IF NOT EXISTS idx_messages_channel_created ON messages(channel_id, created_at DESC, id DESC);
@@ -0,0 +1,38 @@
+-- Change counter for server snapshots (channels, members, server fields)
+ALTER TABLE servers ADD COLUMN IF NOT EXISTS snapshot_version BIGINT NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION bump_server_snapshot_version() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE servers SET snapshot_version = snapshot_version + 1 WHERE id = OLD.server_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND (TG_OP = 'INSERT' OR NEW.server_id IS DISTINCT FROM OLD.server_id) THEN
+        UPDATE servers SET snapshot_version = snapshot_version + 1 WHERE id = NEW.server_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bump_own_snapshot_version() RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.snapshot_version = OLD.snapshot_version THEN
+        NEW.snapshot_version := OLD.snapshot_version + 1;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_channels_snapshot_version ON channels;
+CREATE TRIGGER trg_channels_snapshot_version
+    AFTER INSERT OR UPDATE OR DELETE ON channels
+    FOR EACH ROW EXECUTE FUNCTION bump_server_snapshot_version();
+
+DROP TRIGGER IF EXISTS trg_server_members_snapshot_version ON server_members;
+CREATE TRIGGER trg_server_members_snapshot_version
+    AFTER INSERT OR UPDATE OR DELETE ON server_members
+    FOR EACH ROW EXECUTE FUNCTION bump_server_snapshot_version();
+
+DROP TRIGGER IF EXISTS trg_servers_snapshot_version ON servers;
+CREATE TRIGGER trg_servers_snapshot_version
+    BEFORE UPDATE ON servers
+    FOR EACH ROW EXECUTE FUNCTION bump_own_snapshot_version();
@@ -0,0 +1,3 @@
+-- Prefix search on username / IncordesID for the member list
+CREATE INDEX IF NOT EXISTS idx_users_username_prefix ON users (lower(username) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_users_incordes_id_prefix ON users (lower(incordes_id) text_pattern_ops);
@@ -0,0 +1,5 @@
+-- Presence heartbeats: last flushed heartbeat per user
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_seen_at TIMESTAMP;
+
+-- Sweep of expired presence only visits users that are not already offline
+CREATE INDEX IF NOT EXISTS idx_users_presence_sweep ON users(last_seen_at) WHERE status <> 'offline';
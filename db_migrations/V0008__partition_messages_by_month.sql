@@ -0,0 +1,65 @@
+-- Range-partition messages by month on created_at
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+
+CREATE TABLE messages (
+    id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+    message_id VARCHAR(50) NOT NULL,
+    channel_id INTEGER REFERENCES channels(id),
+    user_id INTEGER REFERENCES users(id),
+    content TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    attachments JSONB DEFAULT '[]',
+    embeds JSONB DEFAULT '[]',
+    reactions JSONB DEFAULT '[]',
+    edited_at TIMESTAMP,
+    referenced_message_id INTEGER,
+    content_tsv tsvector GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED,
+    PRIMARY KEY (id, created_at),
+    UNIQUE (message_id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+-- Creates the partition holding month_start (idempotent), e.g. messages_y2025m01
+CREATE OR REPLACE FUNCTION create_messages_partition(month_start DATE) RETURNS TEXT AS $$
+DECLARE
+    range_start DATE := date_trunc('month', month_start)::date;
+    partition_name TEXT := 'messages_' || to_char(range_start, '"y"YYYY"m"MM');
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+        partition_name, range_start, (range_start + INTERVAL '1 month')::date
+    );
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    month_start DATE := date_trunc('month', COALESCE((SELECT MIN(created_at) FROM messages_unpartitioned), CURRENT_TIMESTAMP))::date;
+BEGIN
+    WHILE month_start <= date_trunc('month', CURRENT_TIMESTAMP + INTERVAL '12 months') LOOP
+        PERFORM create_messages_partition(month_start);
+        month_start := (month_start + INTERVAL '1 month')::date;
+    END LOOP;
+END;
+$$;
+
+INSERT INTO messages (id, message_id, channel_id, user_id, content, created_at, attachments, embeds, reactions, edited_at, referenced_message_id)
+SELECT id, message_id, channel_id, user_id, content, COALESCE(created_at, CURRENT_TIMESTAMP), attachments, embeds, reactions, edited_at, referenced_message_id
+FROM messages_unpartitioned;
+
+DROP TABLE messages_unpartitioned;
+
+-- Indexes are created on every partition
+CREATE INDEX IF NOT EXISTS idx_messages_channel_created ON messages(channel_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_content_tsv ON messages USING GIN(content_tsv);
+
+-- Detached partitions whose rows live in compressed files under MESSAGES_ARCHIVE_DIR
+CREATE TABLE IF NOT EXISTS messages_archive (
+    partition_name VARCHAR(64) PRIMARY KEY,
+    range_start TIMESTAMP NOT NULL,
+    range_end TIMESTAMP NOT NULL,
+    row_count BIGINT NOT NULL DEFAULT 0,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,9 @@
+-- Per-user, per-channel read marker (position of the last read message)
+CREATE TABLE IF NOT EXISTS read_states (
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    channel_id INTEGER NOT NULL REFERENCES channels(id),
+    last_read_at TIMESTAMP NOT NULL,
+    last_read_message_id INTEGER NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, channel_id)
+);
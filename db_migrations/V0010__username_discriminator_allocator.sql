@@ -0,0 +1,14 @@
+-- Per-username discriminator counter for IncordesID allocation
+CREATE TABLE IF NOT EXISTS username_discriminators (
+    username VARCHAR(50) PRIMARY KEY,
+    next_discriminator INTEGER NOT NULL
+);
+
+INSERT INTO username_discriminators (username, next_discriminator)
+SELECT username, MAX(discriminator::int) + 1
+FROM users
+WHERE discriminator ~ '^[0-9]{1,4}$'
+GROUP BY username
+ON CONFLICT (username) DO NOTHING;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username_discriminator ON users(username, discriminator);
@@ -0,0 +1,30 @@
+-- One row per DM channel with the participant pair in canonical (least, greatest) order
+CREATE TABLE IF NOT EXISTS dm_participants (
+    channel_id INTEGER PRIMARY KEY REFERENCES channels(id),
+    user_low INTEGER NOT NULL REFERENCES users(id),
+    user_high INTEGER NOT NULL REFERENCES users(id),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CHECK (user_low < user_high)
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_dm_participants_pair ON dm_participants(user_low, user_high);
+CREATE INDEX IF NOT EXISTS idx_dm_participants_high ON dm_participants(user_high);
+
+-- Legacy DM rows kept the creator in channels.user_id and the friend in channels.server_id
+ALTER TABLE channels ADD COLUMN IF NOT EXISTS user_id INTEGER;
+
+-- Oldest channel wins when duplicates were created by concurrent opens
+INSERT INTO dm_participants (channel_id, user_low, user_high)
+SELECT c.id, LEAST(c.user_id, c.server_id), GREATEST(c.user_id, c.server_id)
+FROM channels c
+WHERE c.is_dm = TRUE
+AND c.user_id IS NOT NULL AND c.server_id IS NOT NULL AND c.user_id <> c.server_id
+AND EXISTS (SELECT 1 FROM users u WHERE u.id = c.user_id)
+AND EXISTS (SELECT 1 FROM users u WHERE u.id = c.server_id)
+ORDER BY c.id
+ON CONFLICT DO NOTHING;
+
+-- DM channels no longer borrow server_id, so server channel queries cannot pick them up
+UPDATE channels SET server_id = NULL WHERE is_dm = TRUE AND server_id IS NOT NULL;
+
+DROP INDEX IF EXISTS idx_channels_dm;
@@ -0,0 +1,18 @@
+-- One row per user reaction; messages is partitioned, so message_id is not a foreign key
+CREATE TABLE IF NOT EXISTS message_reactions (
+    message_id INTEGER NOT NULL,
+    emoji VARCHAR(64) NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (message_id, emoji, user_id)
+);
+
+-- Per-(message, emoji) counter split into shards; the total is SUM(count) over the shards
+CREATE TABLE IF NOT EXISTS reaction_counts (
+    message_id INTEGER NOT NULL,
+    emoji VARCHAR(64) NOT NULL,
+    shard SMALLINT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (message_id, emoji, shard)
+);
@@ -0,0 +1,10 @@
+-- One row per 10-bit snowflake worker id; each function instance leases a free id so no two live instances share one
+CREATE TABLE IF NOT EXISTS snowflake_workers (
+    worker_id SMALLINT PRIMARY KEY,
+    holder VARCHAR(64),
+    leased_until TIMESTAMP NOT NULL DEFAULT '-infinity'
+);
+
+INSERT INTO snowflake_workers (worker_id)
+SELECT generate_series(0, 1023)
+ON CONFLICT (worker_id) DO NOTHING;
@@ -0,0 +1,47 @@
+-- Member list keyset (presence_rank, sort_name, user_id) stored on server_members so a page is an index range scan
+ALTER TABLE server_members ADD COLUMN IF NOT EXISTS sort_name VARCHAR(100);
+ALTER TABLE server_members ADD COLUMN IF NOT EXISTS presence_rank SMALLINT NOT NULL DEFAULT 1;
+
+UPDATE server_members sm
+SET sort_name = lower(u.username),
+    presence_rank = CASE WHEN u.status IS NULL OR u.status IN ('offline', 'invisible') THEN 1 ELSE 0 END
+FROM users u
+WHERE u.id = sm.user_id;
+
+CREATE INDEX IF NOT EXISTS idx_server_members_list
+    ON server_members (server_id, presence_rank, sort_name, user_id);
+
+CREATE OR REPLACE FUNCTION fill_member_sort_keys() RETURNS TRIGGER AS $$
+BEGIN
+    SELECT lower(u.username),
+           CASE WHEN u.status IS NULL OR u.status IN ('offline', 'invisible') THEN 1 ELSE 0 END
+    INTO NEW.sort_name, NEW.presence_rank
+    FROM users u WHERE u.id = NEW.user_id;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_server_members_sort_keys ON server_members;
+CREATE TRIGGER trg_server_members_sort_keys
+    BEFORE INSERT ON server_members
+    FOR EACH ROW EXECUTE FUNCTION fill_member_sort_keys();
+
+-- Presence flushes only change users.status on transitions, so this fires once per user per online/offline switch
+CREATE OR REPLACE FUNCTION sync_member_sort_keys() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE server_members
+    SET sort_name = lower(NEW.username),
+        presence_rank = CASE WHEN NEW.status IS NULL OR NEW.status IN ('offline', 'invisible') THEN 1 ELSE 0 END
+    WHERE user_id = NEW.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_users_member_sort_keys ON users;
+CREATE TRIGGER trg_users_member_sort_keys
+    AFTER UPDATE OF username, status ON users
+    FOR EACH ROW
+    WHEN (lower(OLD.username) IS DISTINCT FROM lower(NEW.username)
+          OR (OLD.status IS NULL OR OLD.status IN ('offline', 'invisible'))
+             IS DISTINCT FROM (NEW.status IS NULL OR NEW.status IN ('offline', 'invisible')))
+    EXECUTE FUNCTION sync_member_sort_keys();
@@ -0,0 +1,2 @@
+-- Server snapshots no longer embed members; membership changes stop invalidating the snapshot ETag
+DROP TRIGGER IF EXISTS trg_server_members_snapshot_version ON server_members;
@@ -0,0 +1,49 @@
+-- Catch-all partition so sends keep working when no one has run archive_messages.py ensure
+CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT;
+
+-- Creates the partition holding month_start (idempotent). Rows that already landed in
+-- messages_default for that month are moved into the new partition
+CREATE OR REPLACE FUNCTION create_messages_partition(month_start DATE) RETURNS TEXT AS $$
+DECLARE
+    range_start DATE := date_trunc('month', month_start)::date;
+    range_end DATE := (date_trunc('month', month_start) + INTERVAL '1 month')::date;
+    partition_name TEXT := 'messages_' || to_char(range_start, '"y"YYYY"m"MM');
+    moved BIGINT;
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN partition_name;
+    END IF;
+
+    -- Blocks sends into the default partition while its rows for the month are moved
+    LOCK TABLE messages_default IN ACCESS EXCLUSIVE MODE;
+    CREATE TEMP TABLE messages_moving AS
+        SELECT id, message_id, channel_id, user_id, content, created_at, attachments, embeds,
+               reactions, edited_at, referenced_message_id
+        FROM messages_default WHERE created_at >= range_start AND created_at < range_end;
+    SELECT count(*) INTO moved FROM messages_moving;
+    IF moved > 0 THEN
+        DELETE FROM messages_default WHERE created_at >= range_start AND created_at < range_end;
+    END IF;
+
+    EXECUTE format(
+        'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+        partition_name, range_start, range_end
+    );
+
+    INSERT INTO messages (id, message_id, channel_id, user_id, content, created_at, attachments, embeds,
+                          reactions, edited_at, referenced_message_id)
+    SELECT id, message_id, channel_id, user_id, content, created_at, attachments, embeds,
+           reactions, edited_at, referenced_message_id
+    FROM messages_moving;
+    DROP TABLE messages_moving;
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Which channels have rows in each archived partition, so history only opens archive files that exist
+CREATE TABLE IF NOT EXISTS messages_archive_channels (
+    channel_id INTEGER NOT NULL,
+    partition_name VARCHAR(64) NOT NULL REFERENCES messages_archive(partition_name) ON DELETE CASCADE,
+    row_count BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (channel_id, partition_name)
+);
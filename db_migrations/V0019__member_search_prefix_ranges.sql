@@ -0,0 +1,6 @@
+-- Member names compare bytewise: usernames are [a-z0-9_] once lowercased, and with C collation a
+-- sort_name LIKE prefix is an index range inside one presence rank of idx_server_members_list
+ALTER TABLE server_members ALTER COLUMN sort_name TYPE VARCHAR(100) COLLATE "C";
+
+-- Name search reads server_members.sort_name; only the IncordesID prefix index is still used
+DROP INDEX IF EXISTS idx_users_username_prefix;
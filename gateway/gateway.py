@@ -0,0 +1,320 @@
+'''
+Business: Standalone asyncio WebSocket gateway pushing new messages to subscribed clients
+Args: DATABASE_URL, GATEWAY_HOST, GATEWAY_PORT, GATEWAY_QUEUE_SIZE, GATEWAY_IDENTIFY_TIMEOUT, GATEWAY_REVOCATION_INTERVAL env variables
+Returns: MESSAGE_CREATE dispatches for every channel of the user's servers and DMs, fed by LISTEN gateway_messages
+'''
+
+import asyncio
+import json
+import logging
+import os
+import resource
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Set
+
+import jwt
+import psycopg2
+from psycopg2.extras import RealDictCursor
+import websockets
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'messages'))
+
+from db import get_connection, release_connection, POOL_MAX
+from tokens import verify_token
+
+GATEWAY_HOST = os.environ.get('GATEWAY_HOST', '0.0.0.0')
+GATEWAY_PORT = int(os.environ.get('GATEWAY_PORT', 8765))
+GATEWAY_QUEUE_SIZE = int(os.environ.get('GATEWAY_QUEUE_SIZE', 256))
+GATEWAY_IDENTIFY_TIMEOUT = float(os.environ.get('GATEWAY_IDENTIFY_TIMEOUT', 10))
+# Connected sockets are re-checked against users.token_version this often
+GATEWAY_REVOCATION_INTERVAL = float(os.environ.get('GATEWAY_REVOCATION_INTERVAL', 30))
+NOTIFY_CHANNEL = 'gateway_messages'
+PING_INTERVAL = 30
+STATS_INTERVAL = 60
+RECONNECT_DELAY = 2
+
+CLOSE_AUTH_FAILED = 4004
+CLOSE_SLOW_CONSUMER = 4008
+
+SUBSCRIPTIONS_QUERY = """SELECT c.id FROM server_members sm
+                         JOIN channels c ON c.server_id = sm.server_id
+                         WHERE sm.user_id = %(user_id)s
+                         UNION ALL
+                         SELECT p.channel_id FROM dm_participants p
+                         WHERE p.user_low = %(user_id)s OR p.user_high = %(user_id)s"""
+
+TOKEN_VERSIONS_QUERY = """SELECT id, token_version FROM users WHERE id = ANY(%s)"""
+
+MESSAGE_QUERY = """SELECT m.id, m.message_id, m.channel_id, m.user_id, m.content, m.created_at,
+                          json_build_object('username', u.username, 'discriminator', u.discriminator,
+                                            'incordes_id', u.incordes_id, 'avatar_url', u.avatar_url) AS author
+                   FROM messages m JOIN users u ON u.id = m.user_id
+                   WHERE m.id = %s AND m.channel_id = %s"""
+
+log = logging.getLogger('gateway')
+
+# Blocking DB work (token version checks, subscription loads) never exceeds the pool size
+_db_executor = ThreadPoolExecutor(max_workers=POOL_MAX, thread_name_prefix='gateway-db')
+
+def run_db(fn, *args):
+    return asyncio.get_running_loop().run_in_executor(_db_executor, fn, *args)
+
+def dumps(data: Any) -> str:
+    if orjson:
+        return orjson.dumps(data).decode('utf-8')
+    return json.dumps(data, separators=(',', ':'), default=str)
+
+def _query(query: str, params) -> list:
+    conn = get_connection()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+        conn.commit()
+    finally:
+        release_connection(conn)
+    return rows
+
+def load_subscriptions(user_id: int) -> Set[int]:
+    return {row['id'] for row in _query(SUBSCRIPTIONS_QUERY, {'user_id': user_id})}
+
+def load_message(message_id: int, channel_id: int) -> Optional[Dict[str, Any]]:
+    rows = _query(MESSAGE_QUERY, (message_id, channel_id))
+    return dict(rows[0]) if rows else None
+
+def load_token_versions(user_ids) -> Dict[int, int]:
+    return {row['id']: row['token_version'] for row in _query(TOKEN_VERSIONS_QUERY, (list(user_ids),))}
+
+class Client:
+    '''
+    One WebSocket connection. Frames are queued without blocking the fan-out;
+    a client whose queue is full is too slow and gets disconnected.
+    '''
+
+    def __init__(self, websocket, user_id: int, token_version: int):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.token_version = token_version
+        self.channels: Set[int] = set()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=GATEWAY_QUEUE_SIZE)
+        self.dropped = False
+
+    async def pump(self) -> None:
+        try:
+            while True:
+                frame = await self.queue.get()
+                await self.websocket.send(frame)
+        except websockets.ConnectionClosed:
+            pass
+
+class Hub:
+    def __init__(self):
+        self.clients: Set[Client] = set()
+        self.by_channel: Dict[int, Set[Client]] = {}
+        self.stats = {'events': 0, 'frames': 0, 'slow_consumers_dropped': 0,
+                      'revoked_dropped': 0, 'bad_notifications': 0}
+
+    def subscribe(self, client: Client, channels: Set[int]) -> None:
+        self.unsubscribe(client)
+        client.channels = channels
+        self.clients.add(client)
+        for channel_id in channels:
+            self.by_channel.setdefault(channel_id, set()).add(client)
+
+    def unsubscribe(self, client: Client) -> None:
+        self.clients.discard(client)
+        for channel_id in client.channels:
+            subscribers = self.by_channel.get(channel_id)
+            if subscribers is not None:
+                subscribers.discard(client)
+                if not subscribers:
+                    del self.by_channel[channel_id]
+        client.channels = set()
+
+    def publish(self, channel_id: int, frame: str) -> None:
+        '''
+        Serialized once, enqueued to every subscriber without awaiting any of them.
+        '''
+        self.stats['events'] += 1
+        for client in list(self.by_channel.get(channel_id, ())):
+            try:
+                client.queue.put_nowait(frame)
+                self.stats['frames'] += 1
+            except asyncio.QueueFull:
+                self.drop(client)
+
+    def drop(self, client: Client, code: int = CLOSE_SLOW_CONSUMER, reason: str = 'slow consumer',
+             stat: str = 'slow_consumers_dropped') -> None:
+        if client.dropped:
+            return
+        client.dropped = True
+        self.stats[stat] += 1
+        self.unsubscribe(client)
+        asyncio.ensure_future(client.websocket.close(code, reason))
+
+hub = Hub()
+
+def dispatch_frame(message: Dict[str, Any]) -> str:
+    return dumps({'op': 'dispatch', 't': 'MESSAGE_CREATE', 'd': message})
+
+def handle_notification(payload: str) -> None:
+    '''
+    Runs inside the LISTEN reader callback: a bad payload is logged and skipped so
+    the notifications queued behind it are still delivered.
+    '''
+    try:
+        event = json.loads(payload)
+        channel_id = event['channel_id']
+        if channel_id not in hub.by_channel:
+            return
+        if 'message' in event:
+            hub.publish(channel_id, dispatch_frame(event['message']))
+        else:
+            # Payload was too large for NOTIFY and only carries the id
+            asyncio.ensure_future(publish_loaded(event['id'], channel_id))
+    except Exception:
+        hub.stats['bad_notifications'] += 1
+        log.exception('could not dispatch notification %.200s', payload)
+
+async def publish_loaded(message_id: int, channel_id: int) -> None:
+    message = await run_db(load_message, message_id, channel_id)
+    if message:
+        hub.publish(channel_id, dispatch_frame(message))
+
+async def listen_forever() -> None:
+    '''
+    LISTEN on a dedicated autocommit connection whose socket is watched by the
+    event loop; reconnects after any connection failure.
+    '''
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        except psycopg2.OperationalError as e:
+            log.warning('listen connection failed: %s', e)
+            await asyncio.sleep(RECONNECT_DELAY)
+            continue
+
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f'LISTEN {NOTIFY_CHANNEL}')
+        lost = asyncio.Event()
+
+        def on_readable():
+            try:
+                conn.poll()
+            except psycopg2.Error as e:
+                log.warning('listen connection lost: %s', e)
+                lost.set()
+                return
+            while conn.notifies:
+                handle_notification(conn.notifies.pop(0).payload)
+
+        loop.add_reader(conn.fileno(), on_readable)
+        try:
+            await lost.wait()
+        finally:
+            loop.remove_reader(conn.fileno())
+            conn.close()
+        await asyncio.sleep(RECONNECT_DELAY)
+
+async def identify(websocket) -> Optional[Dict[str, Any]]:
+    '''
+    First frame must be {"op": "identify", "token": "<jwt>"} - the token issued by auth.
+    Returns the verified token payload.
+    '''
+    try:
+        frame = json.loads(await asyncio.wait_for(websocket.recv(), GATEWAY_IDENTIFY_TIMEOUT))
+    except (asyncio.TimeoutError, ValueError, websockets.ConnectionClosed):
+        return None
+    if not isinstance(frame, dict) or frame.get('op') != 'identify':
+        return None
+
+    try:
+        payload = await run_db(verify_token, frame.get('token') or '')
+    except jwt.InvalidTokenError:
+        return None
+    return payload
+
+async def serve_client(websocket, path=None) -> None:
+    payload = await identify(websocket)
+    if not payload:
+        await websocket.close(CLOSE_AUTH_FAILED, 'authentication failed')
+        return
+
+    user_id = payload['user_id']
+    client = Client(websocket, user_id, payload.get('ver', 0))
+    hub.subscribe(client, await run_db(load_subscriptions, user_id))
+    await websocket.send(dumps({'op': 'ready', 'd': {'user_id': user_id, 'channels': len(client.channels)}}))
+
+    pump = asyncio.ensure_future(client.pump())
+    try:
+        async for raw in websocket:
+            try:
+                frame = json.loads(raw)
+            except ValueError:
+                continue
+            # Clients re-request subscriptions after joining a server or opening a DM
+            if isinstance(frame, dict) and frame.get('op') == 'resubscribe' and not client.dropped:
+                hub.subscribe(client, await run_db(load_subscriptions, user_id))
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        pump.cancel()
+        hub.unsubscribe(client)
+
+async def check_revocations() -> None:
+    '''
+    Tokens are only verified at identify; a logout-everywhere bumps
+    users.token_version, and sockets identified with an older version are closed.
+    '''
+    while True:
+        await asyncio.sleep(GATEWAY_REVOCATION_INTERVAL)
+        user_ids = {client.user_id for client in hub.clients}
+        if not user_ids:
+            continue
+        try:
+            versions = await run_db(load_token_versions, user_ids)
+        except psycopg2.Error as e:
+            log.warning('token version check failed: %s', e)
+            continue
+        # Clients that identified after the read are left for the next round; deleted users have no row
+        for client in list(hub.clients):
+            if client.user_id in user_ids and versions.get(client.user_id, client.token_version + 1) > client.token_version:
+                hub.drop(client, CLOSE_AUTH_FAILED, 'token revoked', 'revoked_dropped')
+
+async def report_stats() -> None:
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        log.info('clients=%d channels=%d %s', len(hub.clients), len(hub.by_channel), hub.stats)
+
+def raise_fd_limit() -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+async def main() -> None:
+    raise_fd_limit()
+    # Per-message deflate costs tens of KB per connection; idle fan-out wants it off
+    async with websockets.serve(serve_client, GATEWAY_HOST, GATEWAY_PORT,
+                                ping_interval=PING_INTERVAL, ping_timeout=PING_INTERVAL,
+                                compression=None, max_size=64 * 1024):
+        log.info('gateway listening on %s:%d', GATEWAY_HOST, GATEWAY_PORT)
+        await asyncio.gather(listen_forever(), check_revocations(), report_stats())
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if uvloop:
+        uvloop.install()
+    asyncio.run(main())
@@ -0,0 +1,165 @@
+'''
+Business: Local load generator for the WebSocket gateway - many idle connections, then sustained fan-out
+Args: --url, --user-id, --channel-id, --connections, --processes, --idle, --rate, --duration; DATABASE_URL
+      (run the gateway pinned to one core, e.g. taskset -c 0 python gateway/gateway.py)
+Returns: connections held, frames delivered vs expected, delivery latency percentiles, slow consumers dropped
+'''
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+import websockets
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'messages'))
+
+from tokens import issue_token
+
+NOTIFY_CHANNEL = 'gateway_messages'
+CONNECT_CONCURRENCY = 200
+LATENCY_SAMPLE = 10000
+CLOSE_SLOW_CONSUMER = 4008
+
+def raise_fd_limit() -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+async def hold_connection(url: str, token: str, stats, latencies, gate) -> None:
+    try:
+        async with gate:
+            websocket = await websockets.connect(url, compression=None, open_timeout=60, max_queue=None)
+            await websocket.send(json.dumps({'op': 'identify', 'token': token}))
+            ready = json.loads(await websocket.recv())
+        if ready.get('op') != 'ready':
+            stats['failed'] += 1
+            await websocket.close()
+            return
+        stats['connected'] += 1
+    except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+        stats['failed'] += 1
+        return
+
+    try:
+        async for raw in websocket:
+            frame = json.loads(raw)
+            content = (frame.get('d') or {}).get('content') or ''
+            if content.startswith('loadgen '):
+                stats['frames'] += 1
+                latencies.append(time.time() - float(content.split(' ', 1)[1]))
+    except websockets.ConnectionClosed as e:
+        if e.rcvd and e.rcvd.code == CLOSE_SLOW_CONSUMER:
+            stats['dropped'] += 1
+
+async def run_clients(url: str, token: str, connections: int, connected_queue, stop) -> dict:
+    stats = {'connected': 0, 'failed': 0, 'frames': 0, 'dropped': 0, 'alive_at_end': 0}
+    latencies = []
+    gate = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    tasks = [asyncio.ensure_future(hold_connection(url, token, stats, latencies, gate)) for _ in range(connections)]
+
+    while stats['connected'] + stats['failed'] < connections:
+        await asyncio.sleep(0.2)
+    connected_queue.put(stats['connected'])
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, stop.wait)
+    alive = sum(1 for task in tasks if not task.done())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    stats['alive_at_end'] = alive
+
+    stats['latencies'] = random.sample(latencies, min(len(latencies), LATENCY_SAMPLE))
+    return stats
+
+def client_process(url, token, connections, connected_queue, stop, results) -> None:
+    raise_fd_limit()
+    results.put(asyncio.run(run_clients(url, token, connections, connected_queue, stop)))
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def main():
+    parser = argparse.ArgumentParser(description='Hold idle gateway connections, then fan out synthetic messages')
+    parser.add_argument('--url', default='ws://127.0.0.1:8765')
+    parser.add_argument('--user-id', type=int, required=True)
+    parser.add_argument('--channel-id', type=int, required=True, help='a channel the user is subscribed to')
+    parser.add_argument('--connections', type=int, default=10000)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--idle', type=float, default=30, help='seconds to hold idle connections before publishing')
+    parser.add_argument('--rate', type=float, default=5, help='messages per second published to the channel')
+    parser.add_argument('--duration', type=float, default=30)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute("SELECT id, incordes_id, token_version FROM users WHERE id = %s", (args.user_id,))
+        token = issue_token(dict(cursor.fetchone()))
+
+    connected_queue = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    per_process = [args.connections // args.processes + (1 if i < args.connections % args.processes else 0)
+                   for i in range(args.processes)]
+    processes = [
+        multiprocessing.Process(target=client_process, args=(args.url, token, count, connected_queue, stop, results))
+        for count in per_process
+    ]
+
+    started = time.monotonic()
+    for process in processes:
+        process.start()
+    connected = sum(connected_queue.get() for _ in processes)
+    print(f"connected {connected}/{args.connections} in {time.monotonic() - started:.1f}s")
+
+    print(f"holding idle connections for {args.idle:.0f}s")
+    time.sleep(args.idle)
+
+    published = 0
+    interval = 1.0 / args.rate
+    publish_started = time.monotonic()
+    with conn.cursor() as cursor:
+        while time.monotonic() - publish_started < args.duration:
+            payload = json.dumps({
+                'channel_id': args.channel_id,
+                'message': {'id': -published - 1, 'channel_id': args.channel_id, 'user_id': args.user_id,
+                            'content': f"loadgen {time.time()}"}
+            })
+            cursor.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, payload))
+            published += 1
+            time.sleep(max(0.0, publish_started + published * interval - time.monotonic()))
+    time.sleep(2)
+    conn.close()
+
+    stop.set()
+    totals = {'connected': 0, 'failed': 0, 'frames': 0, 'dropped': 0, 'alive_at_end': 0}
+    latencies = []
+    for _ in processes:
+        stats = results.get()
+        latencies += stats.pop('latencies')
+        for key, value in stats.items():
+            totals[key] += value
+    for process in processes:
+        process.join()
+
+    expected = published * totals['connected']
+    print(f"published {published} messages at {args.rate:.0f}/s to {totals['connected']} connections")
+    print(f"delivered {totals['frames']}/{expected} frames ({totals['frames'] / max(expected, 1):.1%}), "
+          f"{totals['frames'] / args.duration:.0f} frames/s")
+    print(f"latency p50 {percentile(latencies, 0.5) * 1000:.1f}ms p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+    print(f"failed {totals['failed']}, slow consumers dropped {totals['dropped']}, alive at end {totals['alive_at_end']}")
+
+if __name__ == '__main__':
+    main()
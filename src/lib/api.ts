@@ -50,11 +50,22 @@ const getToken = (): string | null => {
   return localStorage.getItem('incordes_token');
 };
 
+// WAL position of this client's last write; reads carrying it skip replicas that have not replayed it yet
+let readToken: string | null = null;
+
+const rememberReadToken = (response: Response) => {
+  const token = response.headers.get('X-Read-Token');
+  if (token) {
+    readToken = token;
+  }
+};
+
 const getAuthHeaders = () => {
   const token = getToken();
   return {
     'Content-Type': 'application/json',
     ...(token && { Authorization: `Bearer ${token}` }),
+    ...(readToken && { 'X-Read-Token': readToken }),
   };
 };
 
@@ -176,6 +187,7 @@ export const createServer = async (name: string, icon?: string): Promise<Server
         ...(icon && { icon_url: icon }),
       }),
     });
+    rememberReadToken(response);
 
     const data = await response.json();
     if (data.id || data.server_id) {
@@ -222,6 +234,7 @@ export const createChannel = async (
         type,
       }),
     });
+    rememberReadToken(response);
 
     const data = await response.json();
     if (data.id || data.channel_id) {
@@ -234,6 +247,30 @@ export const createChannel = async (
   }
 };
 
+export interface InvitePreview {
+  code: string;
+  server_id: number;
+  name: string;
+  icon_url?: string;
+  member_count: number;
+}
+
+export const getInvitePreview = async (code: string): Promise<InvitePreview | null> => {
+  try {
+    const response = await fetch(`${SERVERS_API}?invite=${encodeURIComponent(code)}`, {
+      method: 'GET',
+    });
+
+    if (!response.ok) {
+      return null;
+    }
+    return await response.json();
+  } catch (error) {
+    console.error('Get invite preview error:', error);
+    return null;
+  }
+};
+
 export const getMessages = async (channelId: string): Promise<Message[]> => {
   try {
     const response = await fetch(`${MESSAGES_API}?channel_id=${channelId}`, {
@@ -252,6 +289,36 @@ export const getMessages = async (channelId: string): Promise<Message[]> => {
   }
 };
 
+export interface MessageSyncResponse {
+  messages: Message[];
+  next_cursor: string | null;
+}
+
+export const syncMessages = async (
+  channelId: string,
+  since: string,
+  wait = 25
+): Promise<MessageSyncResponse> => {
+  try {
+    const response = await fetch(
+      `${MESSAGES_API}?channel_id=${channelId}&since=${encodeURIComponent(since)}&wait=${wait}`,
+      {
+        method: 'GET',
+        headers: getAuthHeaders(),
+      }
+    );
+
+    const data = await response.json();
+    if (data.messages) {
+      return data;
+    }
+    return { messages: [], next_cursor: since };
+  } catch (error) {
+    console.error('Sync messages error:', error);
+    return { messages: [], next_cursor: since };
+  }
+};
+
 export const sendMessage = async (channelId: string, content: string): Promise<Message | null> => {
   try {
     const response = await fetch(MESSAGES_API, {
@@ -263,6 +330,7 @@ export const sendMessage = async (channelId: string, content: string): Promise<M
         content,
       }),
     });
+    rememberReadToken(response);
 
     const data = await response.json();
     if (data.id || data.message_id) {
@@ -275,6 +343,73 @@ export const sendMessage = async (channelId: string, content: string): Promise<M
   }
 };
 
+export interface DirectMessageChannel {
+  id: number;
+  channel_id: string;
+  recipient: {
+    id: number;
+    username: string;
+    discriminator: string;
+    incordes_id: string;
+    avatar_url?: string;
+  };
+  last_message: {
+    id: number;
+    message_id: string;
+    user_id: number;
+    content: string;
+    created_at: string;
+  } | null;
+}
+
+export const getDirectMessages = async (): Promise<DirectMessageChannel[]> => {
+  try {
+    const response = await fetch(`${MESSAGES_API}?dms=1`, {
+      method: 'GET',
+      headers: getAuthHeaders(),
+    });
+
+    const data = await response.json();
+    if (data.dms) {
+      return data.dms;
+    }
+    return [];
+  } catch (error) {
+    console.error('Get direct messages error:', error);
+    return [];
+  }
+};
+
+export interface ReadyPayload {
+  user: User;
+  settings: Record<string, unknown> | null;
+  servers: Server[];
+  dms: { id: number; channel_id: string; recipient: Partial<User> }[];
+  read_states: { channel_id: number; last_read_message_id: number; last_read_at: string }[];
+}
+
+export const getReady = async (): Promise<ReadyPayload | null> => {
+  try {
+    const response = await fetch(AUTH_API, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({
+        action: 'ready',
+        token: getToken(),
+      }),
+    });
+
+    const data = await response.json();
+    if (data.user) {
+      return data;
+    }
+    return null;
+  } catch (error) {
+    console.error('Ready error:', error);
+    return null;
+  }
+};
+
 export const updateUserProfile = async (updates: Partial<User>): Promise<User | null> => {
   try {
     const response = await fetch(AUTH_API, {
@@ -0,0 +1,192 @@
+'''
+Business: Maintenance for monthly messages partitions - pre-create upcoming months, archive cold ones
+Args: ensure [--months-ahead N] | archive [--keep-months N] [--dry-run] | reindex; DATABASE_URL, MESSAGES_ARCHIVE_DIR
+Returns: Created partitions (rows caught by messages_default are moved in), cold partitions exported to
+         <dir>/<partition>/<channel_id>.ndjson.gz and dropped, or the per-channel archive index rebuilt from those files
+'''
+
+import argparse
+import gzip
+import os
+import re
+import shutil
+import sys
+from datetime import date
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import RealDictCursor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'messages'))
+
+import archive
+
+PARTITION_NAME = re.compile(r'^messages_y(\d{4})m(\d{2})$')
+CHANNEL_FILE = re.compile(r'^(\d+)\.ndjson\.gz$')
+
+EXPORT_QUERY = """SELECT m.id, m.message_id, m.channel_id, m.user_id, m.content, m.created_at,
+                         m.attachments, m.embeds, m.reactions, m.edited_at, m.referenced_message_id,
+                         u.username, u.discriminator, u.incordes_id, u.avatar_url
+                  FROM {partition} m
+                  LEFT JOIN users u ON u.id = m.user_id
+                  ORDER BY m.channel_id, m.created_at DESC, m.id DESC"""
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def list_partitions(cursor):
+    cursor.execute(
+        """SELECT c.relname FROM pg_inherits i
+           JOIN pg_class c ON c.oid = i.inhrelid
+           WHERE i.inhparent = 'messages'::regclass"""
+    )
+    partitions = []
+    for row in cursor.fetchall():
+        match = PARTITION_NAME.match(row['relname'])
+        if match:
+            partitions.append((row['relname'], date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+def ensure(conn, months_ahead: int):
+    current = date.today().replace(day=1)
+    with conn.cursor() as cursor:
+        for offset in range(months_ahead + 1):
+            cursor.execute("SELECT create_messages_partition(%s)", (add_months(current, offset),))
+            print(f"ensured {cursor.fetchone()[0]}")
+    conn.commit()
+
+def index_channels(cursor, partition_name: str, channel_counts):
+    cursor.execute("DELETE FROM messages_archive_channels WHERE partition_name = %s", (partition_name,))
+    cursor.executemany(
+        "INSERT INTO messages_archive_channels (channel_id, partition_name, row_count) VALUES (%s, %s, %s)",
+        [(channel_id, partition_name, count) for channel_id, count in channel_counts.items()]
+    )
+
+def export_partition(conn, partition_name: str):
+    '''
+    Stream the partition through a server-side cursor into one gzip file per
+    channel. Files are written to a temporary directory and renamed into place
+    so a failed run never leaves a half-written archive behind. A directory left
+    at the target is only replaced when no messages_archive row claims it.
+    Runs in the caller's transaction, which must hold the partition locked.
+    Returns rows written per channel id.
+    '''
+    target_dir = os.path.join(archive.ARCHIVE_DIR, partition_name)
+    tmp_dir = f"{target_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    channel_counts = {}
+    channel_id = None
+    out = None
+    with conn.cursor(name=f"export_{partition_name}", cursor_factory=RealDictCursor) as cursor:
+        cursor.itersize = 5000
+        cursor.execute(sql.SQL(EXPORT_QUERY).format(partition=sql.Identifier(partition_name)))
+        for row in cursor:
+            if row['channel_id'] != channel_id:
+                if out:
+                    out.close()
+                channel_id = row['channel_id']
+                out = gzip.open(os.path.join(tmp_dir, f"{channel_id}.ndjson.gz"), 'wt', encoding='utf-8')
+            out.write(archive.encode_row(dict(row)) + '\n')
+            channel_counts[channel_id] = channel_counts.get(channel_id, 0) + 1
+    if out:
+        out.close()
+
+    shutil.rmtree(target_dir, ignore_errors=True)
+    os.rename(tmp_dir, target_dir)
+    return channel_counts
+
+def archive_cold(conn, keep_months: int, dry_run: bool):
+    if not archive.ARCHIVE_DIR:
+        raise SystemExit('MESSAGES_ARCHIVE_DIR is not set')
+
+    cutoff = add_months(date.today().replace(day=1), -keep_months)
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        cold = [(name, start) for name, start in list_partitions(cursor) if start < cutoff]
+    conn.commit()
+
+    for partition_name, range_start in cold:
+        # A live partition for an archived month means rows were written after archiving;
+        # exporting it would replace the archive with only those rows
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM messages_archive WHERE partition_name = %s", (partition_name,))
+            already_archived = cursor.fetchone() is not None
+        conn.commit()
+        if already_archived:
+            raise SystemExit(f"{partition_name} is live again but already archived; merge it by hand, "
+                             "refusing to overwrite the existing archive")
+
+        if dry_run:
+            print(f"would archive {partition_name}")
+            continue
+
+        # Export, detach and drop in one transaction; SHARE blocks writes to the partition
+        # in between, so no row inserted or edited after the export is dropped unseen
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL('LOCK TABLE {} IN SHARE MODE').format(sql.Identifier(partition_name)))
+        channel_counts = export_partition(conn, partition_name)
+        row_count = sum(channel_counts.values())
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL('ALTER TABLE messages DETACH PARTITION {}').format(sql.Identifier(partition_name)))
+            cursor.execute(
+                """INSERT INTO messages_archive (partition_name, range_start, range_end, row_count)
+                   VALUES (%s, %s, %s, %s)
+                   ON CONFLICT (partition_name) DO UPDATE SET row_count = EXCLUDED.row_count, archived_at = CURRENT_TIMESTAMP""",
+                (partition_name, range_start, add_months(range_start, 1), row_count)
+            )
+            index_channels(cursor, partition_name, channel_counts)
+            cursor.execute(sql.SQL('DROP TABLE {}').format(sql.Identifier(partition_name)))
+        conn.commit()
+        print(f"archived {partition_name}: {row_count} messages")
+
+def reindex(conn):
+    '''
+    Rebuild messages_archive_channels from the files on disk, for partitions
+    archived before the index existed.
+    '''
+    if not archive.ARCHIVE_DIR:
+        raise SystemExit('MESSAGES_ARCHIVE_DIR is not set')
+
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT partition_name FROM messages_archive ORDER BY range_start")
+        for (partition_name,) in cursor.fetchall():
+            partition_dir = os.path.join(archive.ARCHIVE_DIR, partition_name)
+            channel_counts = {}
+            for file_name in os.listdir(partition_dir) if os.path.isdir(partition_dir) else ():
+                match = CHANNEL_FILE.match(file_name)
+                if match:
+                    channel_id = int(match.group(1))
+                    channel_counts[channel_id] = sum(1 for _ in archive.channel_rows(partition_name, channel_id))
+            index_channels(cursor, partition_name, channel_counts)
+            conn.commit()
+            print(f"indexed {partition_name}: {len(channel_counts)} channels")
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain monthly messages partitions')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ensure_parser = commands.add_parser('ensure', help='create partitions for upcoming months')
+    ensure_parser.add_argument('--months-ahead', type=int, default=3)
+
+    archive_parser = commands.add_parser('archive', help='export and drop partitions older than --keep-months')
+    archive_parser.add_argument('--keep-months', type=int, default=12)
+    archive_parser.add_argument('--dry-run', action='store_true')
+
+    commands.add_parser('reindex', help='rebuild the per-channel archive index from archived files')
+
+    args = parser.parse_args()
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        if args.command == 'ensure':
+            ensure(conn, args.months_ahead)
+        elif args.command == 'reindex':
+            reindex(conn)
+        else:
+            archive_cold(conn, args.keep_months, args.dry_run)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+'''
+Business: Bulk export and import of channel/server message history as gzip-compressed NDJSON
+Args: export (--channel-id N | --server-id N) --output FILE | import (--channel-id N | --server-id N)
+      [--allow-unresolved] FILE; DATABASE_URL, MESSAGES_ARCHIVE_DIR (when partitions have been archived)
+Returns: One archive-format JSON row per message, archived months included; imports COPY rows into messages
+         with authors resolved by incordes_id. Both directions stream in fixed-size batches, so memory stays flat.
+'''
+
+import argparse
+import gzip
+import io
+import json
+import os
+import resource
+import sys
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timezone
+from typing import Dict, Any, Iterator, List, Optional
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'messages'))
+
+import archive
+from snowflake import next_key, key_at
+
+BATCH_SIZE = 10000
+GZIP_LEVEL = 6
+AUTHOR_CACHE_SIZE = 100000
+PROGRESS_EVERY = 500000
+
+CHANNELS_QUERY = "SELECT id, name FROM channels WHERE server_id = %s AND type = 'text' ORDER BY position, id"
+
+# Walks idx_messages_channel_created backwards for oldest-first order, no sort
+EXPORT_QUERY = """SELECT m.id, m.message_id, m.channel_id, c.name AS channel_name, m.user_id, m.content, m.created_at,
+                         m.attachments, m.embeds, m.reactions, m.edited_at, m.referenced_message_id,
+                         u.username, u.discriminator, u.incordes_id, u.avatar_url
+                  FROM messages m
+                  JOIN channels c ON c.id = m.channel_id
+                  LEFT JOIN users u ON u.id = m.user_id
+                  WHERE m.channel_id = %s
+                  ORDER BY m.created_at, m.id"""
+
+AUTHORS_QUERY = "SELECT incordes_id, id FROM users WHERE incordes_id = ANY(%s)"
+
+# Author of imported messages whose original author has no account here; it can never log in
+PLACEHOLDER_AUTHOR = {
+    'incordes_id': 'imported_user#0000', 'email': 'imported-user@incordes.invalid', 'password_hash': '!',
+    'username': 'imported_user', 'tag': '0000', 'discriminator': '0000', 'status': 'offline'
+}
+PLACEHOLDER_QUERY = """WITH created AS (
+                         INSERT INTO users (incordes_id, email, password_hash, username, tag, discriminator, status)
+                         VALUES (%(incordes_id)s, %(email)s, %(password_hash)s, %(username)s, %(tag)s,
+                                 %(discriminator)s, %(status)s)
+                         ON CONFLICT (incordes_id) DO NOTHING
+                         RETURNING id
+                     )
+                     SELECT id FROM created
+                     UNION ALL
+                     SELECT id FROM users WHERE incordes_id = %(incordes_id)s"""
+
+FIND_CHANNEL_QUERY = "SELECT id FROM channels WHERE server_id = %s AND name = %s AND type = 'text' ORDER BY id LIMIT 1"
+
+CREATE_CHANNEL_QUERY = """INSERT INTO channels (channel_id, server_id, name, type, position)
+                          SELECT %(key)s, %(server_id)s, %(name)s, 'text', COUNT(*)
+                          FROM channels WHERE server_id = %(server_id)s
+                          RETURNING id"""
+
+COPY_COLUMNS = ('message_id', 'channel_id', 'user_id', 'content', 'created_at', 'attachments', 'embeds', 'edited_at')
+COPY_QUERY = f"COPY messages ({', '.join(COPY_COLUMNS)}) FROM STDIN"
+
+# COPY text format: backslash escapes for the delimiter, row separator and backslash itself
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def export_archived(cursor, channel_id: int, out) -> int:
+    '''
+    Months already moved out of the database by archive_messages.py, oldest month
+    first. Each archive file is streamed as stored: newest first within the month.
+    '''
+    cursor.execute("SELECT partition_name FROM messages_archive ORDER BY range_start")
+    partitions = [row[0] for row in cursor.fetchall()]
+    if partitions and not archive.ARCHIVE_DIR:
+        raise SystemExit(f"{len(partitions)} partitions are archived but MESSAGES_ARCHIVE_DIR is not set; "
+                         "refusing an export that would silently leave them out")
+
+    row_count = 0
+    cursor.execute("SELECT name FROM channels WHERE id = %s", (channel_id,))
+    found = cursor.fetchone()
+    channel_name = found[0] if found else None
+    for partition_name in partitions:
+        for row in archive.channel_rows(partition_name, channel_id):
+            row['channel_name'] = channel_name
+            out.write(archive.encode_row(row) + '\n')
+            row_count += 1
+    return row_count
+
+def export_channel(conn, channel_id: int, out) -> int:
+    with conn.cursor() as cursor:
+        row_count = export_archived(cursor, channel_id, out)
+    with conn.cursor(name=f"export_channel_{channel_id}", cursor_factory=RealDictCursor) as cursor:
+        cursor.itersize = BATCH_SIZE
+        cursor.execute(EXPORT_QUERY, (channel_id,))
+        while True:
+            rows = cursor.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            out.write(''.join(archive.encode_row(dict(row)) + '\n' for row in rows))
+            row_count += len(rows)
+    return row_count
+
+def export_history(conn, channel_id: Optional[int], server_id: Optional[int], output: str) -> None:
+    '''
+    One named cursor per channel inside a single read-only REPEATABLE READ
+    transaction, so a server export is a consistent snapshot across channels.
+    Archived months of each channel are read from MESSAGES_ARCHIVE_DIR first.
+    Written to <output>.tmp and renamed into place once complete.
+    '''
+    started = time.monotonic()
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    if server_id:
+        with conn.cursor() as cursor:
+            cursor.execute(CHANNELS_QUERY, (server_id,))
+            channel_ids = [row[0] for row in cursor.fetchall()]
+    else:
+        channel_ids = [channel_id]
+
+    tmp_path = f"{output}.tmp"
+    row_count = 0
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=GZIP_LEVEL) as out:
+        for channel in channel_ids:
+            exported = export_channel(conn, channel, out)
+            row_count += exported
+            print(f"channel {channel}: {exported} messages")
+    conn.commit()
+    os.replace(tmp_path, output)
+
+    elapsed = time.monotonic() - started
+    print(f"exported {row_count} messages to {output} in {elapsed:.1f}s "
+          f"({row_count / max(elapsed, 0.001):.0f}/s, peak RSS {peak_rss_mb():.0f} MB)")
+
+def read_batches(path: str) -> Iterator[List[Dict[str, Any]]]:
+    batch = []
+    with gzip.open(path, 'rt', encoding='utf-8') as source:
+        for line in source:
+            if line.strip():
+                batch.append(json.loads(line))
+                if len(batch) >= BATCH_SIZE:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
+
+class AuthorResolver:
+    '''
+    incordes_id -> users.id, looked up once per batch for the ids not cached yet.
+    Bounded LRU: a history with millions of authors still uses flat memory.
+    '''
+
+    def __init__(self, cursor, placeholder_id: Optional[int]):
+        self.cursor = cursor
+        self.placeholder_id = placeholder_id
+        self.cache: OrderedDict = OrderedDict()
+        self.unresolved = 0
+
+    def resolve(self, rows: List[Dict[str, Any]]) -> List[Optional[int]]:
+        missing = {row.get('incordes_id') for row in rows if row.get('incordes_id')} - self.cache.keys()
+        if missing:
+            self.cursor.execute(AUTHORS_QUERY, (list(missing),))
+            found = dict(self.cursor.fetchall())
+            for incordes_id in missing:
+                self.cache[incordes_id] = found.get(incordes_id)
+            while len(self.cache) > AUTHOR_CACHE_SIZE:
+                self.cache.popitem(last=False)
+
+        user_ids = []
+        for row in rows:
+            user_id = self.cache.get(row.get('incordes_id'))
+            if row.get('incordes_id') in self.cache:
+                self.cache.move_to_end(row['incordes_id'])
+            if user_id is None:
+                # History and unread counts inner-join users: a NULL author would hide the message
+                self.unresolved += 1
+                if self.placeholder_id is None:
+                    raise SystemExit(f"no user with incordes_id {row.get('incordes_id')!r}; "
+                                     "rerun with --allow-unresolved to attribute such messages to "
+                                     f"{PLACEHOLDER_AUTHOR['incordes_id']}")
+                user_id = self.placeholder_id
+            user_ids.append(user_id)
+        return user_ids
+
+def target_channel(cursor, channels: Dict[Any, int], server_id: int, row: Dict[str, Any]) -> int:
+    '''
+    Server imports keep the source channel split: rows go to the target server's
+    text channel of the same name, created when it does not exist yet.
+    '''
+    name = row.get('channel_name') or f"imported-{row.get('channel_id')}"
+    if name not in channels:
+        cursor.execute(FIND_CHANNEL_QUERY, (server_id, name))
+        found = cursor.fetchone()
+        if found is None:
+            cursor.execute(CREATE_CHANNEL_QUERY, {'key': next_key("C"), 'server_id': server_id, 'name': name})
+            found = cursor.fetchone()
+        channels[name] = found[0]
+    return channels[name]
+
+def copy_value(value) -> str:
+    if value is None:
+        return '\\N'
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, ensure_ascii=False)
+    return str(value).translate(COPY_ESCAPES)
+
+def scan_months(path: str) -> List[date]:
+    '''
+    Months the file has messages in, found by a streaming pass before the import.
+    '''
+    months = set()
+    for batch in read_batches(path):
+        months.update(datetime.fromisoformat(row['created_at']).date().replace(day=1) for row in batch)
+    return sorted(months)
+
+def refuse_archived(conn, months: List[date]) -> None:
+    '''
+    An archived month has no live partition; importing into it would re-create one
+    that the next archive run cannot merge with the files already on disk.
+    '''
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT partition_name FROM messages_archive WHERE range_start::date = ANY(%s) ORDER BY range_start",
+            (months,)
+        )
+        archived = [row[0] for row in cursor.fetchall()]
+    conn.commit()
+    if archived:
+        raise SystemExit(f"the file has messages in archived months ({', '.join(archived)}); "
+                         "refusing to import into them")
+
+def ensure_partitions(conn, months: List[date]) -> None:
+    '''
+    Creating a partition locks messages and messages_default; each one is its own
+    short transaction, committed before the long COPY transaction starts.
+    '''
+    for month in months:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT create_messages_partition(%s)", (month,))
+        conn.commit()
+
+def placeholder_author(cursor) -> int:
+    cursor.execute(PLACEHOLDER_QUERY, PLACEHOLDER_AUTHOR)
+    return cursor.fetchone()[0]
+
+def import_history(conn, channel_id: Optional[int], server_id: Optional[int], path: str,
+                   allow_unresolved: bool = False) -> None:
+    '''
+    Streams the file in BATCH_SIZE rows, each batch COPYed into messages. The
+    whole import is one transaction: a failure leaves nothing behind to dedupe.
+    Partitions for every month in the file are created up front, so the import
+    transaction itself never takes a lock sends wait on. Rows get fresh message_ids (the source keys may already exist here) built
+    from their own created_at, so key order matches history order, and drop
+    referenced_message_id, whose ids only meant something at the source.
+    Files with messages in archived months are refused before anything is written.
+    Unknown authors abort the import unless allow_unresolved, which maps them
+    to a placeholder user.
+    '''
+    started = time.monotonic()
+    months = scan_months(path)
+    refuse_archived(conn, months)
+    ensure_partitions(conn, months)
+    row_count = 0
+    next_progress = PROGRESS_EVERY
+    channels: Dict[Any, int] = {}
+    with conn.cursor() as cursor:
+        authors = AuthorResolver(cursor, placeholder_author(cursor) if allow_unresolved else None)
+        for batch in read_batches(path):
+            user_ids = authors.resolve(batch)
+            buffer = io.StringIO()
+            for row, user_id in zip(batch, user_ids):
+                created_at = datetime.fromisoformat(row['created_at'])
+                target = channel_id or target_channel(cursor, channels, server_id, row)
+                key = key_at("M", created_at.replace(tzinfo=timezone.utc).timestamp())
+                values = (key, target, user_id, row.get('content') or '', created_at.isoformat(),
+                          row.get('attachments') or [], row.get('embeds') or [], row.get('edited_at'))
+                buffer.write('\t'.join(copy_value(value) for value in values) + '\n')
+            buffer.seek(0)
+            cursor.copy_expert(COPY_QUERY, buffer)
+            row_count += len(batch)
+            if row_count >= next_progress:
+                print(f"  imported {row_count} messages")
+                next_progress += PROGRESS_EVERY
+    conn.commit()
+
+    elapsed = time.monotonic() - started
+    print(f"imported {row_count} messages from {path} in {elapsed:.1f}s "
+          f"({row_count / max(elapsed, 0.001):.0f}/s, {authors.unresolved} attributed to the placeholder author, "
+          f"peak RSS {peak_rss_mb():.0f} MB)")
+
+def main():
+    parser = argparse.ArgumentParser(description='Export or import message history as gzip NDJSON')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help='stream a channel or a whole server to a .ndjson.gz file')
+    export_target = export_parser.add_mutually_exclusive_group(required=True)
+    export_target.add_argument('--channel-id', type=int)
+    export_target.add_argument('--server-id', type=int)
+    export_parser.add_argument('--output', required=True)
+
+    import_parser = commands.add_parser('import', help='COPY an exported (or converted) .ndjson.gz file into messages')
+    import_target = import_parser.add_mutually_exclusive_group(required=True)
+    import_target.add_argument('--channel-id', type=int, help='put every message into this channel')
+    import_target.add_argument('--server-id', type=int, help='map rows to same-named text channels of this server')
+    import_parser.add_argument('--allow-unresolved', action='store_true',
+                               help='attribute messages by unknown authors to a placeholder user instead of failing')
+    import_parser.add_argument('path')
+
+    args = parser.parse_args()
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        if args.command == 'export':
+            export_history(conn, args.channel_id, args.server_id, args.output)
+        else:
+            import_history(conn, args.channel_id, args.server_id, args.path, args.allow_unresolved)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()